@@ -0,0 +1 @@
+"""Loopback benchmarks that drive the file server with configurable workloads."""
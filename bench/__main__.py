@@ -0,0 +1,94 @@
+import argparse  # Import argparse to read the command line options
+import json  # Import json to report the results
+import platform  # Import platform to describe the machine in the report
+import shlex  # Import shlex to split the extra server options
+import shutil  # Import shutil to remove the benchmark files afterwards
+import subprocess  # Import subprocess to record the commit being measured
+import sys  # Import sys to write the report
+import tempfile  # Import tempfile for the server and client directories
+
+from common.compression import SUPPORTED_CODECS
+
+from .workload import OPERATIONS, Workload, parse_size, parse_weights, start_server, summarize
+
+DEFAULT_MIX = "upload=1,download=1,list=1"
+DEFAULT_SIZES = "1K=40,64K=30,1M=20,16M=9,256M=1"
+
+
+def git_commit():
+    """Return the commit being benchmarked, None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    """Benchmark the file server over loopback and print the results as JSON."""
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the file server over loopback.")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent client connections")
+    parser.add_argument("--ops", type=int, help="operations per client (default 50 unless --duration is given)")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"weights of the operations {', '.join(OPERATIONS)} (default {DEFAULT_MIX})")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help=f"weights of the file sizes, K/M/G suffixes allowed (default {DEFAULT_SIZES})")
+    parser.add_argument("--content", choices=("random", "text"), default="random",
+                        help="incompressible random bytes or compressible text lines")
+    parser.add_argument("--no-compression", action="store_true", help="ask the server not to compress")
+    parser.add_argument("--seed", type=int, help="seed the random choices to repeat a run")
+    parser.add_argument("--server", metavar="HOST:PORT",
+                        help="benchmark a running server instead of starting one on loopback")
+    parser.add_argument("--server-args", default="", help="extra options for the started server, e.g. \"--rate 100M\"")
+    parser.add_argument("--output", help="write the JSON report to this file instead of standard output")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_weights(args.mix)
+        sizes = parse_weights(args.sizes, parse_size)
+    except ValueError as e:
+        parser.error(str(e))
+    if set(mix) - set(OPERATIONS):
+        parser.error(f"unknown operations in --mix: {', '.join(sorted(set(mix) - set(OPERATIONS)))}")
+    ops = args.ops if args.ops is not None or args.duration else 50
+
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    process = None
+    try:
+        if args.server:
+            host, _, port = args.server.rpartition(":")
+            port = int(port)
+        else:
+            host = "127.0.0.1"
+            process, port = start_server(f"{work_dir}/server", host, shlex.split(args.server_args))
+        workload = Workload(host, port, f"{work_dir}/client", args.clients, mix, sizes, ops, args.duration,
+                            args.content, 0 if args.no_compression else SUPPORTED_CODECS, args.seed)
+        workload.prepare()
+        samples = workload.run()
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {"clients": args.clients, "ops_per_client": ops, "duration": args.duration, "mix": mix,
+                   "sizes": {str(size): weight for size, weight in sizes.items()}, "content": args.content,
+                   "compression": not args.no_compression, "server": args.server or "loopback",
+                   "server_args": args.server_args, "seed": args.seed},
+        **summarize(samples, workload.elapsed),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os  # Import os to create and remove the benchmark files
+import random  # Import random to pick operations and file sizes
+import socket  # Import socket to find a free port and wait for the server
+import subprocess  # Import subprocess to run the server in a process of its own
+import sys  # Import sys to start the server with the same interpreter
+import threading  # Import threading to run the clients concurrently
+import time  # Import time to measure latencies
+from collections import namedtuple  # Import namedtuple for the recorded samples
+
+from client.session import TransferSession
+from common.compression import SUPPORTED_CODECS
+from common.framing import ProtocolError
+
+OPERATIONS = ("upload", "download", "list")  # Operations a workload can mix
+GENERATE_CHUNK = 1024 * 1024  # Bytes written at a time when generating files
+SERVER_START_TIMEOUT = 10  # Seconds to wait for the server process to accept connections
+LATENCY_PERCENTILES = (50, 90, 95, 99)  # Latency percentiles in the report
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# One finished operation: its kind, bytes moved, duration in seconds and whether it failed
+Sample = namedtuple("Sample", ["op", "bytes", "latency", "error"])
+
+
+def parse_size(text):
+    """Parse a byte count with an optional K, M or G suffix, e.g. 64K."""
+    text = text.strip().upper()
+    if text[-1:] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
+
+
+def parse_weights(text, parse_key=str):
+    """Parse "key=weight,key=weight" into a dict; a key without a weight counts 1."""
+    weights = {}
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        weights[parse_key(key)] = float(weight) if weight else 1.0
+    if not weights or any(weight < 0 for weight in weights.values()) or not sum(weights.values()):
+        raise ValueError(f"invalid weights {text!r}")
+    return weights
+
+
+def generate_file(path, size, content="random"):
+    """Write size bytes to path, random (incompressible) or repeated text lines (compressible)."""
+    line = b"2024-06-30,ACME Corp,Balance sheet,EUR,1234567.89,approved\n"
+    text_chunk = line * (GENERATE_CHUNK // len(line) + 1)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            n = min(remaining, GENERATE_CHUNK)
+            f.write(os.urandom(n) if content == "random" else text_chunk[:n])
+            remaining -= n
+
+
+def free_port(host):
+    """Return a port on host nothing is listening on right now."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(files_dir, host="127.0.0.1", server_args=()):
+    """Start python -m server on a free loopback port; returns (process, port) once it accepts."""
+    port = free_port(host)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, "-m", "server", "--host", host, "--port", str(port),
+                                "--files-dir", files_dir, *server_args],
+                               cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"The server did not start on {host}:{port}")
+            time.sleep(0.05)
+
+
+class Workload:
+    """A benchmark run: concurrent clients each issuing a random mix of operations.
+
+    Every client holds one framed connection and picks each operation from mix
+    and each file size from sizes (both weight dicts). Uploads send fresh names
+    with deduplication and deltas off, so every byte crosses the wire; downloads
+    fetch files seeded on the server beforehand, one per size.
+    """
+
+    def __init__(self, host, port, work_dir, clients=4, mix=None, sizes=None, ops=None, duration=None,
+                 content="random", codecs=SUPPORTED_CODECS, seed=None):
+        self.address = (host, port)
+        self.work_dir = work_dir
+        self.clients = clients
+        self.mix = mix or {"upload": 1.0, "download": 1.0, "list": 1.0}
+        self.sizes = sizes or {1024: 1.0}
+        # Stop after ops operations per client, or after duration seconds, whichever comes first
+        self.ops = ops
+        self.duration = duration
+        self.content = content
+        self.codecs = codecs
+        self.seed = seed
+        # Local copy of each file size, used as the source of uploads
+        self.sources = {}
+        self.samples = []
+        self._lock = threading.Lock()
+        self.elapsed = None
+
+    def prepare(self):
+        """Generate one local file per size and seed the server with a copy of each for downloads."""
+        os.makedirs(self.work_dir, exist_ok=True)
+        for size in self.sizes:
+            path = os.path.join(self.work_dir, f"seed-{size}.bin")
+            generate_file(path, size, self.content)
+            self.sources[size] = path
+        session = TransferSession(*self.address, codecs=self.codecs)
+        try:
+            for result in session.upload_batch(list(self.sources.values()), dedup=False, delta=False):
+                if result.error:
+                    raise RuntimeError(f"Could not seed {result.name}: {result.error}")
+        finally:
+            session.close()
+
+    def run(self):
+        """Run every client to completion and return the samples they recorded."""
+        started = time.perf_counter()
+        deadline = started + self.duration if self.duration else None
+        threads = [threading.Thread(target=self._client, args=(n, deadline), daemon=True)
+                   for n in range(self.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - started
+        return self.samples
+
+    def _client(self, n, deadline):
+        rng = random.Random(None if self.seed is None else self.seed + n)
+        client_dir = os.path.join(self.work_dir, f"client-{n}")
+        os.makedirs(client_dir, exist_ok=True)
+        ops, op_weights = zip(*self.mix.items())
+        sizes, size_weights = zip(*self.sizes.items())
+        samples = []
+        session = TransferSession(*self.address, codecs=self.codecs)
+        try:
+            count = 0
+            while (self.ops is None or count < self.ops) and (deadline is None or time.perf_counter() < deadline):
+                op = rng.choices(ops, op_weights)[0]
+                size = rng.choices(sizes, size_weights)[0] if op != "list" else 0
+                samples.append(self._operation(session, op, size, client_dir, f"c{n}-{count}"))
+                count += 1
+        finally:
+            session.close()
+            with self._lock:
+                self.samples.extend(samples)
+
+    def _operation(self, session, op, size, client_dir, tag):
+        """Perform one operation and return its Sample."""
+        path = None
+        started = time.perf_counter()
+        try:
+            if op == "upload":
+                # A hard link gives the upload a fresh name without copying the source
+                path = os.path.join(client_dir, f"{tag}-{size}.bin")
+                os.link(self.sources[size], path)
+                started = time.perf_counter()
+                error = session.upload_batch([path], resume=False, dedup=False, delta=False)[0].error
+            elif op == "download":
+                name = os.path.basename(self.sources[size])
+                error = session.download_batch([name], client_dir, resume=False)[0].error
+                path = os.path.join(client_dir, name)
+            else:
+                session.list_files()
+                error = None
+        except (OSError, ProtocolError) as e:
+            error = str(e)
+        latency = time.perf_counter() - started
+        if path and os.path.exists(path):
+            os.remove(path)
+        return Sample(op, 0 if error else size, latency, error is not None)
+
+
+def percentile(ordered, p):
+    """Return the p-th percentile (0..100) of an ascending list by nearest rank."""
+    if not ordered:
+        return None
+    return ordered[max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def summarize(samples, elapsed):
+    """Reduce samples into throughput and latency figures per operation and in total."""
+
+    def stats(group):
+        latencies = sorted(sample.latency for sample in group)
+        moved = sum(sample.bytes for sample in group)
+        return {
+            "ops": len(group),
+            "errors": sum(sample.error for sample in group),
+            "bytes": moved,
+            "ops_per_s": len(group) / elapsed if elapsed else 0.0,
+            "mb_per_s": moved / 1e6 / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                **{f"p{p}": None if not latencies else percentile(latencies, p) * 1000 for p in LATENCY_PERCENTILES},
+                "mean": sum(latencies) / len(latencies) * 1000 if latencies else None,
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+        }
+
+    return {
+        "elapsed_s": elapsed,
+        "total": stats(samples),
+        "operations": {op: stats([s for s in samples if s.op == op])
+                       for op in OPERATIONS if any(s.op == op for s in samples)},
+    }
@@ -0,0 +1 @@
+"""File client: the Tk front end and the code it uses to talk to the server."""
@@ -0,0 +1,144 @@
+import argparse  # Import argparse to read the command line options
+import fnmatch  # Import fnmatch to match server file names against patterns
+import glob  # Import glob to expand local file patterns
+import os  # Import os to tell files from directories
+import sys  # Import sys to report errors and set the exit status
+
+from common.compression import SUPPORTED_CODECS
+from common.framing import ProtocolError, ServerBusyError
+from common.paths import SEPARATOR, clean_folder
+
+from .api import DEFAULT_PORT, Client
+from .mux import TIMEOUT
+from .session import TransferError
+
+
+def local_files(patterns):
+    """Expand glob patterns (** included) into the files they match, without duplicates."""
+    paths = {}
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(path):
+                paths.setdefault(os.path.abspath(path), None)
+    return list(paths)
+
+
+def remote_files(client, patterns):
+    """Return the server's files matching any of the glob patterns, in listing order."""
+    return [name for name in client.list() if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+
+
+def report(verb, results):
+    """Print the failed files and a summary; returns the exit status."""
+    failed = [result for result in results if result.error]
+    for result in failed:
+        print(f"{result.name}: {result.error}", file=sys.stderr)
+    print(f"{verb} {len(results) - len(failed)} of {len(results)} files.")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    """Transfer files to and from the file server without a GUI."""
+    parser = argparse.ArgumentParser(prog="python -m client", description="Move files to and from the file server.")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the server")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port of the server")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="connections transferring files at the same time")
+    parser.add_argument("--no-compression", action="store_true", help="never compress transfers")
+    parser.add_argument("--multiplex", action="store_true",
+                        help="run the jobs as streams of one connection instead of connections of their own")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="seconds to wait on an unresponsive server before giving up; 0 waits for ever")
+    commands = parser.add_subparsers(dest="command", required=True)
+    listing = commands.add_parser("list", help="list the files on the server")
+    listing.add_argument("patterns", nargs="*", default=["*"], help="only list names matching these globs")
+    listing.add_argument("--folder", help="list only what is directly in this folder, subfolders ending in /")
+    mkdir = commands.add_parser("mkdir", help="create folders on the server")
+    mkdir.add_argument("folders", nargs="+", help="paths of the folders, e.g. reports/2024")
+    upload = commands.add_parser("upload", help="upload local files")
+    upload.add_argument("patterns", nargs="+", help="local files or globs, ** matches subdirectories")
+    upload.add_argument("--to", default="", help="folder on the server to upload into")
+    upload.add_argument("--recursive", "-r", action="store_true",
+                        help="upload directories with everything below them, keeping their layout")
+    upload.add_argument("--no-resume", action="store_true", help="upload interrupted files from the start")
+    upload.add_argument("--no-dedup", action="store_true", help="send files the server already has")
+    upload.add_argument("--no-delta", action="store_true", help="send changed files whole")
+    upload.add_argument("--bundle", action="store_true",
+                        help="send the files as tar streams of many files each, fastest for many small files")
+    download = commands.add_parser("download", help="download files from the server")
+    download.add_argument("patterns", nargs="+", help="names or globs of files on the server")
+    download.add_argument("--dest", default=".", help="directory to save the files in, each under its path")
+    download.add_argument("--recursive", "-r", action="store_true",
+                          help="the patterns name folders, download everything below them")
+    download.add_argument("--no-resume", action="store_true", help="download interrupted files from the start")
+    download.add_argument("--no-revalidate", action="store_true",
+                          help="download files in full even if the copy downloaded earlier is current")
+    download.add_argument("--bundle", action="store_true",
+                          help="receive the files as tar streams of many files each, fastest for many small files")
+    delete = commands.add_parser("delete", help="delete files from the server")
+    delete.add_argument("patterns", nargs="+", help="names or globs of files on the server")
+    args = parser.parse_args(argv)
+
+    try:
+        with Client(args.host, args.port, args.jobs, 0 if args.no_compression else SUPPORTED_CODECS,
+                    multiplex=args.multiplex, timeout=args.timeout) as client:
+            if args.command == "list":
+                if args.folder is not None:
+                    files, folders = client.list_folder(args.folder)
+                    names = [name.rpartition(SEPARATOR)[2] for name in files] + [f + SEPARATOR for f in folders]
+                    for name in sorted(names):
+                        if any(fnmatch.fnmatchcase(name, pattern) for pattern in args.patterns):
+                            print(name)
+                    return 0
+                for name in remote_files(client, args.patterns):
+                    print(name)
+                return 0
+            if args.command == "mkdir":
+                for folder in args.folders:
+                    client.mkdir(folder)
+                return 0
+            if args.command == "upload":
+                folder = clean_folder(args.to)
+                if args.recursive:
+                    results = []
+                    for pattern in args.patterns:
+                        for directory in sorted(glob.glob(pattern)):
+                            if os.path.isdir(directory):
+                                # Like cp -r, the directory itself lands inside the folder
+                                target = SEPARATOR.join(filter(None, [folder, os.path.basename(
+                                    os.path.abspath(directory))]))
+                                results += client.upload_tree(directory, target, args.bundle)
+                    return report("Uploaded", results)
+                paths = local_files(args.patterns)
+                if not paths:
+                    parser.error("no local files match")
+                names = {path: SEPARATOR.join(filter(None, [folder, os.path.basename(path)])) for path in paths}
+                if args.bundle:
+                    return report("Uploaded", client.upload_bundle(paths, names))
+                return report("Uploaded", client.upload(paths, not args.no_resume, not args.no_dedup,
+                                                        not args.no_delta, names))
+            if args.command == "download" and args.recursive:
+                results = []
+                for folder in args.patterns:
+                    results += client.download_tree(folder, args.dest, not args.no_resume, not args.no_revalidate,
+                                                    args.bundle)
+                return report("Downloaded", results)
+            names = remote_files(client, args.patterns)
+            if not names:
+                parser.error("no files on the server match")
+            if args.command == "download":
+                if args.bundle:
+                    return report("Downloaded", client.download_bundle(names, args.dest))
+                return report("Downloaded", client.download(names, args.dest, not args.no_resume,
+                                                              not args.no_revalidate))
+            return report("Deleted", client.delete(names))
+    except ServerBusyError as e:
+        print(f"The server is busy. Please try again in {e.retry_after} seconds.", file=sys.stderr)
+    except ConnectionRefusedError:
+        print(f"No server is listening on {args.host}:{args.port}.", file=sys.stderr)
+    except (OSError, ProtocolError, TransferError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+import asyncio  # Import asyncio for the asynchronous variant of the client
+import functools  # Import functools to hand calls with arguments to the executor
+import os  # Import os to name files and directories
+import queue  # Import queue to share batches between the connections
+import threading  # Import threading to run one worker per connection
+
+from common.compression import SUPPORTED_CODECS
+from common.framing import ProtocolError
+from common.paths import SEPARATOR, clean_folder, clean_path
+
+from .mux import TIMEOUT, MuxConnection
+from .session import PARALLEL_THRESHOLD, Result, TransferError, TransferSession, stored_name
+
+DEFAULT_PORT = 5001  # Port the server listens on unless told otherwise
+BATCH_SIZE = 64  # Files a connection takes from the queue at a time
+BUNDLE_SIZE = 1000  # Files a connection takes from the queue at a time when bundling them
+
+
+class Client:
+    """Scriptable client for the file server, no GUI needed.
+
+    The client holds jobs connections to the server. Batches of uploads,
+    downloads and deletes are cut into groups of BATCH_SIZE files that the
+    connections take from a shared queue, so every connection stays busy
+    whatever the mix of file sizes. Each group is pipelined over its
+    connection. Files that fail are reported in the Result list instead of
+    raising, and a connection that breaks is reopened for the next group.
+
+    With multiplex, the jobs are streams of one MuxConnection instead of
+    connections of their own, and listings, stats and the like go over a
+    priority stream of their own, so they answer at once even in the middle of
+    a large batch.
+
+        with Client("127.0.0.1", 5001, jobs=4) as client:
+            client.upload(glob.glob("exports/*.csv"))
+            client.upload_tree("photos", "backups/photos")
+
+    Files on the server are named by their path from the root of the store,
+    folders separated by "/", e.g. "backups/photos/cat.jpg".
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, jobs=1, codecs=SUPPORTED_CODECS, progress=None, multiplex=False,
+                 timeout=TIMEOUT):
+        self.host = host
+        self.port = port
+        self.jobs = max(1, jobs)
+        self.codecs = codecs
+        # Seconds a connection may wait on the server before it counts as lost, None for ever
+        self.timeout = timeout
+        # Called as progress(name, count, total) from the transferring threads, see TransferSession
+        self.progress = progress
+        self.multiplex = multiplex
+        # Connection the streams share when multiplexing, and the stream for requests that aren't split up
+        self.mux = None
+        self.control = None
+        # Open connections, one per job
+        self.sessions = []
+
+    def connect(self):
+        """Open the connections; raises OSError or ProtocolError if the server can't be reached."""
+        try:
+            if self.multiplex and self.control is None:
+                self.control = self._open(priority=True)
+            while len(self.sessions) < self.jobs:
+                self.sessions.append(self._open())
+        except (OSError, ProtocolError):
+            self.close()
+            raise
+        return self
+
+    def _open(self, priority=False):
+        """Open a connection, or a stream of the multiplexed connection, reconnecting that if it was lost."""
+        if not self.multiplex:
+            return TransferSession(self.host, self.port, self.codecs, self.progress, timeout=self.timeout)
+        if self.mux is None or self.mux.closed:
+            self.mux = MuxConnection(self.host, self.port, self.codecs, self.timeout)
+        return TransferSession(codecs=self.codecs, progress=self.progress, mux=self.mux, priority=priority)
+
+    def close(self):
+        """Close every connection."""
+        for session in self.sessions:
+            session.close()
+        if self.control:
+            self.control.close()
+        self.sessions = []
+        self.control = None
+        if self.mux:
+            self.mux.close()
+            self.mux = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def session(self):
+        """The connection for requests that aren't split up: the priority stream, or else the first connection."""
+        if not self.sessions:
+            self.connect()
+        if self.multiplex:
+            if self.mux.closed:
+                # The shared connection was lost, reopen it with every stream
+                self.close()
+                self.connect()
+            return self.control
+        return self.sessions[0]
+
+    def list(self, prefix=""):
+        """Return the names of the files on the server, optionally only those starting with prefix."""
+        return self.session.list_files(prefix)
+
+    def list_folder(self, folder=""):
+        """Return (files, folders): the paths of the files directly in folder and the names of its subfolders."""
+        return self.session.list_folder(clean_folder(folder))
+
+    def mkdir(self, folder):
+        """Create a folder on the server, and any missing folders above it."""
+        self.session.mkdir(folder)
+
+    def stat(self, names):
+        """Return the server's STAT reply metadata for every name, "error" set for missing files."""
+        return self.session.stat_batch(names)
+
+    def upload(self, paths, resume=True, dedup=True, delta=True, names=None):
+        """Upload every file in paths and return a Result for each, in the same order.
+
+        Files are stored under their file name, or the path names maps them to;
+        raises ValueError before sending anything if one of those is invalid.
+        """
+        names = {path: clean_path(name) for path, name in (names or {}).items()}
+        return self._spread(paths, lambda session, batch: session.upload_batch(batch, resume, dedup, delta, names),
+                            name=lambda path: stored_name(path, names))
+
+    def download(self, names, dest_dir, resume=True, revalidate=True):
+        """Download every file in names into dest_dir and return a Result for each, in the same order.
+
+        Files of at least PARALLEL_THRESHOLD bytes are fetched one at a time, split
+        into byte ranges over connections of their own. With revalidate, files
+        downloaded into dest_dir before are sent again only if they changed, see
+        Manifest.
+        """
+        names = [clean_path(name) for name in names]
+        stats = self.stat(names)
+        large = {name for name, stat in zip(names, stats) if (stat.get("size") or 0) >= PARALLEL_THRESHOLD}
+        small = [name for name in names if name not in large]
+        results = dict(zip(small, self._spread(small, lambda session, batch: session.download_batch(
+            batch, dest_dir, resume, revalidate))))
+        for name in large:
+            try:
+                results[name] = self.session.download_parallel(name, dest_dir, revalidate=revalidate)
+            except (OSError, ProtocolError) as e:
+                results[name] = Result(name, str(e))
+        return [results[name] for name in names]
+
+    def upload_bundle(self, paths, names=None):
+        """Upload every file in paths in tar bundles of BUNDLE_SIZE files; returns a Result for each, in order.
+
+        Far faster than upload() for many small files, but without resume, dedup or deltas.
+        """
+        names = {path: clean_path(name) for path, name in (names or {}).items()}
+        return self._spread(paths, lambda session, batch: session.upload_bundle(batch, names), BUNDLE_SIZE,
+                            lambda path: stored_name(path, names))
+
+    def download_bundle(self, names, dest_dir):
+        """Download every file in names into dest_dir in tar bundles; returns a Result for each, in order."""
+        return self._spread([clean_path(name) for name in names],
+                            lambda session, batch: session.download_bundle(dest_dir, batch), BUNDLE_SIZE)
+
+    def upload_tree(self, directory, folder="", bundle=False):
+        """Upload a local directory with everything below it into folder; returns a Result for each file.
+
+        directory's own name is not kept: its file a/b.txt is stored as folder/a/b.txt.
+        Empty subdirectories are created as folders. With bundle, the files go in
+        tar bundles, see upload_bundle().
+        """
+        base = clean_folder(folder).split(SEPARATOR) if clean_folder(folder) else []
+        paths, names, empty = [], {}, []
+        for parent, subdirs, files in os.walk(directory):
+            relative = os.path.relpath(parent, directory)
+            parts = base + ([] if relative == os.curdir else relative.split(os.sep))
+            if not subdirs and not files and parts:
+                empty.append(SEPARATOR.join(parts))
+            for file in sorted(files):
+                path = os.path.join(parent, file)
+                paths.append(path)
+                names[path] = SEPARATOR.join(parts + [file])
+        for name in empty:
+            self.mkdir(name)
+        if bundle:
+            return self.upload_bundle(paths, names)
+        return self.upload(paths, names=names)
+
+    def download_tree(self, folder, dest_dir, resume=True, revalidate=True, bundle=False):
+        """Download every file below folder on the server into dest_dir; returns a Result for each file.
+
+        Files keep their whole path under dest_dir, so folder "a" lands in dest_dir/a.
+        With bundle, the files come in tar bundles, see download_bundle().
+        """
+        folder = clean_folder(folder)
+        names = self.list(folder + SEPARATOR if folder else "")
+        if bundle:
+            return self.download_bundle(names, dest_dir)
+        return self.download(names, dest_dir, resume, revalidate)
+
+    def delete(self, names):
+        """Delete every file in names from the server and return a Result for each, in the same order."""
+
+        def delete_batch(session, batch):
+            results = []
+            for name in batch:
+                try:
+                    session.delete(name)
+                    results.append(Result(name, None))
+                except (TransferError, ValueError) as e:
+                    results.append(Result(name, str(e)))
+            return results
+
+        return self._spread(names, delete_batch)
+
+    def _spread(self, items, work, batch_size=BATCH_SIZE, name=None):
+        """Run work(session, batch) over every connection until items are done; returns the Results in order.
+
+        name(item) is the name an item is reported under if its batch fails, the item itself by default.
+        """
+        name = name or (lambda item: item)
+        if not items:
+            return []
+        if not self.sessions:
+            self.connect()
+        batches = queue.Queue()
+        for start in range(0, len(items), batch_size):
+            batches.put(start)
+        results = [None] * len(items)
+
+        def worker(index):
+            while True:
+                try:
+                    start = batches.get_nowait()
+                except queue.Empty:
+                    return
+                batch = items[start:start + batch_size]
+                try:
+                    results[start:start + len(batch)] = work(self.sessions[index], batch)
+                except Exception as e:
+                    # Fail the batch, not the whole call; a thread dying here would leave its batches unreported
+                    results[start:start + len(batch)] = [Result(name(item), str(e)) for item in batch]
+                    if not isinstance(e, (OSError, ProtocolError)):
+                        continue
+                    # The connection broke part way through the batch, reconnect
+                    self.sessions[index].close()
+                    try:
+                        self.sessions[index] = self._open()
+                    except (OSError, ProtocolError):
+                        # Leave the remaining batches to the other connections
+                        return
+
+        threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(len(self.sessions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Batches left behind when every connection was lost
+        return [result or Result(name(item), "Connection to the server lost")
+                for item, result in zip(items, results)]
+
+
+class AsyncClient:
+    """asyncio variant of Client with the same methods as coroutines.
+
+    The transfers run on a Client in worker threads, so awaiting them never
+    blocks the event loop.
+
+        async with AsyncClient("127.0.0.1", 5001, jobs=4) as client:
+            names = await client.list()
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, jobs=1, codecs=SUPPORTED_CODECS, progress=None, multiplex=False,
+                 timeout=TIMEOUT):
+        self.client = Client(host, port, jobs, codecs, progress, multiplex, timeout)
+
+    async def _run(self, method, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(method, *args, **kwargs))
+
+    async def connect(self):
+        await self._run(self.client.connect)
+        return self
+
+    async def close(self):
+        await self._run(self.client.close)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def list(self, prefix=""):
+        return await self._run(self.client.list, prefix)
+
+    async def list_folder(self, folder=""):
+        return await self._run(self.client.list_folder, folder)
+
+    async def mkdir(self, folder):
+        return await self._run(self.client.mkdir, folder)
+
+    async def stat(self, names):
+        return await self._run(self.client.stat, names)
+
+    async def upload(self, paths, resume=True, dedup=True, delta=True, names=None):
+        return await self._run(self.client.upload, paths, resume, dedup, delta, names)
+
+    async def download(self, names, dest_dir, resume=True, revalidate=True):
+        return await self._run(self.client.download, names, dest_dir, resume, revalidate)
+
+    async def upload_bundle(self, paths, names=None):
+        return await self._run(self.client.upload_bundle, paths, names)
+
+    async def download_bundle(self, names, dest_dir):
+        return await self._run(self.client.download_bundle, names, dest_dir)
+
+    async def upload_tree(self, directory, folder="", bundle=False):
+        return await self._run(self.client.upload_tree, directory, folder, bundle)
+
+    async def download_tree(self, folder, dest_dir, resume=True, revalidate=True, bundle=False):
+        return await self._run(self.client.download_tree, folder, dest_dir, resume, revalidate, bundle)
+
+    async def delete(self, names):
+        return await self._run(self.client.delete, names)
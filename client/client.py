@@ -1,16 +1,35 @@
 import socket  # Import the socket module to enable network communication
 import os  # Import the os module to interact with the operating system
+import sys  # Import the sys module to make the client package importable
 import tkinter as tk  # Import the tkinter module to create a GUI
 from tkinter import filedialog, messagebox, PhotoImage  # Import specific modules from tkinter
-import time  # Import the time module to use time-related functions
-import threading  # Import the threading module to handle multiple threads
+import threading  # Import the threading module to transfer files without freezing the window
 import re
 
-BUFFER_SIZE = 4096  # Buffer size for data transfer
-SEPARATOR = "<SEPARATOR>"  # Separator used to separate parts of a message
+# Make the project root importable when this file is run directly as a script
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
 
-# Global variable for client socket
-client_socket = None  # Initialize client socket as None
+from common.framing import ProtocolError, ServerBusyError
+from client.api import Client
+from client.manifest import MANIFEST_NAME
+from client.transfers import ConnectionPool, DownloadQueue
+from common.gui import EventBridge, TransferPanel
+
+# Global variable for the connection to the server
+client = None  # Initialize client as None
+# Queue of downloads, each running on a pooled connection of its own
+downloads = None
+# Selections of at least this many files are uploaded as tar bundles, one request per many files
+BUNDLE_MIN_FILES = 32
+
+def upload_progress(name, count, total):
+    """Called from the uploading thread; hands the progress to the Tk thread"""
+    events.post(transfer_panel.advance, ("upload", name), f"Uploading {name}", count, total)
+
+def download_progress(name, count, total):
+    """Called from a downloading thread; hands the progress to the Tk thread"""
+    events.post(transfer_panel.advance, ("download", name), f"Downloading {name}", count, total)
 
 def is_valid_ip(ip):
     """Validate an IPv4 address."""
@@ -31,7 +50,7 @@ def is_valid_port(port):
 
 def connect_to_server(show_message=True):
     """Function to connect to the server"""
-    global client_socket
+    global client, downloads
     # Get the server address and port from user input
     server_host = server_ip_entry.get()
     server_port = server_port_entry.get()
@@ -53,14 +72,13 @@ def connect_to_server(show_message=True):
         return
 
     try:
-        # Convert port to an integer
-        server_port = int(server_port)
-        
-        # Create a new socket object
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Connect to the server
-        client_socket.connect((server_host, server_port))
-        
+        # Open a persistent multiplexed connection; it stays up for every upload and download until logout
+        client = Client(server_host, int(server_port), progress=upload_progress, multiplex=True).connect()
+        # Downloads run in parallel on streams of their own, so listings still answer while they run
+        downloaded_files_dir = os.path.join(os.path.dirname(__file__), 'downloaded files')
+        downloads = DownloadQueue(ConnectionPool(server_host, int(server_port), progress=download_progress,
+                                                 mux=client.mux), downloaded_files_dir)
+
         # Show a success message if show_message is True
         if show_message:
             messagebox.showinfo("Success", "Connected to the server.")
@@ -75,14 +93,19 @@ def connect_to_server(show_message=True):
     except socket.gaierror:
         # Show an error message for invalid address
         messagebox.showerror("Connection Error", "The server address is invalid.")
+    except ServerBusyError as e:
+        # Show an error message if the server is too busy to take the connection
+        messagebox.showerror("Connection Error", f"The server is busy. Please try again in {e.retry_after} seconds.")
+    except ProtocolError as e:
+        # Show an error message if the server speaks a different protocol
+        messagebox.showerror("Connection Error", f"The server does not support this client: {e}")
     except socket.error as e:
         # Show an error message for any other socket errors
         messagebox.showerror("Error", f"An error occurred: {str(e)}")
 
 def upload_files():
     """Function to handle file uploads to the server"""
-    global client_socket
-    if not client_socket:
+    if not client:
         # Show an error message if not connected to the server
         messagebox.showerror("Connection Error", "You are not connected to the server.")
         return
@@ -92,44 +115,54 @@ def upload_files():
     if not filepaths:
         return
 
-    for filepath in filepaths:
-        filename = os.path.basename(filepath)  # Get the filename from the file path
-        filesize = os.path.getsize(filepath)  # Get the file size
-        try:
-            # Send upload command to the server
-            client_socket.send(f"UPLOAD{SEPARATOR}{filename}{SEPARATOR}{filesize}".encode())
-            print(f"Sent UPLOAD command for {filename}")
-
-            # Open the file in binary read mode
-            with open(filepath, "rb") as f:
-                while True:
-                    bytes_read = f.read(BUFFER_SIZE)  # Read bytes from the file
-                    if not bytes_read:  # If no more bytes are read
-                        break  # Break the loop
-                    client_socket.sendall(bytes_read)  # Send the bytes to the server
-                print(f"File {filename} uploaded successfully.")
-                # Add a small delay to allow the server to process each file individually
-                time.sleep(0.1)
-
-        except Exception as e:
-            print(f"Error uploading file {filename}: {e}")  # Print any errors
-
-    # Close the current socket connection
-    client_socket.close()
+    # Upload in the background so the window stays responsive however large the files are
+    threading.Thread(target=upload_in_background, args=(filepaths,), daemon=True).start()
 
-    # Reconnect to the server without showing the connection message
-    connect_to_server(show_message=False)
-
-    # Request the updated list of files after upload
-    list_files()
+def upload_in_background(filepaths):
+    """Function to upload files on a worker thread, reporting back through the event bridge"""
+    try:
+        if len(filepaths) >= BUNDLE_MIN_FILES:
+            # Many files go faster as a few tar streams than as one request each
+            results = client.upload_bundle(filepaths)
+        else:
+            # Send the whole batch over the open connection, one acknowledgement per file
+            results = client.upload(filepaths)
+    except Exception as e:
+        print(f"Error uploading files: {e}")  # Print any errors
+        events.post(messagebox.showerror, "Error", f"An error occurred while uploading: {str(e)}")
+        events.post(clear_transfers, "upload")
+        return
+    events.post(report_uploads, results)
+
+def clear_transfers(direction):
+    """Function to remove the progress bars of finished transfers in one direction"""
+    for key in transfer_panel.keys():
+        if key[0] == direction:
+            transfer_panel.remove(key)
+
+def report_uploads(results):
+    """Function to report the outcome of a batch of uploads"""
+    for result in results:
+        transfer_panel.remove(("upload", result.name))
+
+    # Report the outcome of every file
+    failed = [result for result in results if result.error]
+    for result in results:
+        if result.error:
+            print(f"Error uploading file {result.name}: {result.error}")
+        else:
+            print(f"File {result.name} uploaded successfully.")
 
-    # Show success message
-    messagebox.showinfo("Success", "All files uploaded successfully.")
+    if failed:
+        messagebox.showerror("Error", "Some files could not be uploaded:\n" +
+                             "\n".join(f"{result.name}: {result.error}" for result in failed))
+    else:
+        # Show success message
+        messagebox.showinfo("Success", "All files uploaded successfully.")
 
 def download_file():
     """Function to handle file download request from the server"""
-    global client_socket
-    if not client_socket:
+    if not client:
         # Show an error message if not connected to the server
         messagebox.showerror("Connection Error", "You are not connected to the server.")
         return
@@ -139,18 +172,10 @@ def download_file():
 
 def handle_file_selection():
     """Function to handle file selection for download"""
-    global client_socket
     print("Requesting list of available files...")
-    # Send list files command to the server
-    client_socket.send("LIST_FILES".encode())
-    # Receive response from the server
-    response = client_socket.recv(BUFFER_SIZE).decode()
-    print("Received response from server:", response)  # Print the response
-    # Split the response to get file names
-    files = response.split(SEPARATOR)
-
-    # Filter out empty strings and remove SEPARATOR from filenames
-    files = [file.strip(SEPARATOR) for file in files if file.strip()]
+    # Get the file names from the server
+    files = client.list()
+    print("Received response from server:", files)  # Print the response
 
     if not files:
         # Show message if no files available
@@ -159,14 +184,14 @@ def handle_file_selection():
 
     # Create a dialog window to display the list of files
     file_selection_dialog = tk.Toplevel()
-    file_selection_dialog.title("Select File to Download")
+    file_selection_dialog.title("Select Files to Download")
 
     # Create a frame to hold the listbox and scrollbar
     frame = tk.Frame(file_selection_dialog)
     frame.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
 
-    # Create a listbox to display the files
-    file_listbox = tk.Listbox(frame, width=50)
+    # Create a listbox to display the files; several can be downloaded as one batch
+    file_listbox = tk.Listbox(frame, width=50, selectmode=tk.EXTENDED)
     file_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
     # Create a scrollbar
@@ -184,11 +209,10 @@ def handle_file_selection():
         """Function to handle download button click event"""
         selection = file_listbox.curselection()
         if selection:
-            index = selection[0]
-            filename = file_listbox.get(index)
-            print("User selected file:", filename)
-            # Start a new thread to download the selected file
-            threading.Thread(target=download_selected_file, args=(filename,)).start()
+            filenames = [file_listbox.get(index) for index in selection]
+            print("User selected files:", filenames)
+            # Queue the selected files; they download in the background
+            download_selected_files(filenames)
             # Close the file selection dialog
             file_selection_dialog.destroy()
         else:
@@ -199,62 +223,23 @@ def handle_file_selection():
     download_button = tk.Button(file_selection_dialog, text="Download", command=on_download)
     download_button.pack(pady=10)
 
-def download_selected_file(filename):
-    """Function to download the selected file from the server"""
-    global client_socket
-    try:
-        # Send download command to the server
-        client_socket.send(f"DOWNLOAD{SEPARATOR}{filename}".encode())
-        # Receive response from the server
-        response = client_socket.recv(BUFFER_SIZE).decode()
-        print("Received response from server:", response)
-
-        # Print the selected filename
-        print("User selected file:", filename)
-
-        if response.startswith("File not found"):
-            # Show error if file not found
-            messagebox.showerror("Error", response)
-            return
-
-        # Split the response to get file information
-        file_info = response.split(SEPARATOR)
-        filenames_from_server = file_info[:-1]  # Exclude the last empty element
-        print("Filenames received from server:", filenames_from_server)
-
-        if filename not in filenames_from_server:
-            # Show error if file not found
-            messagebox.showerror("Error", f"Selected file '{filename}' not found on the server.")
-            return
-
-        # Extract file size
-        filename_index = filenames_from_server.index(filename)
-        filesize = int(file_info[filename_index + 1])
-
-        # Directory to save downloaded files
-        downloaded_files_dir = os.path.join(os.path.dirname(__file__), 'downloaded files')
-        os.makedirs(downloaded_files_dir, exist_ok=True)
-
-        # Create a file path for the downloaded file
-        filepath = os.path.join(downloaded_files_dir, filename)
-        # Open the file in binary write mode
-        with open(filepath, "wb") as f:
-            bytes_received = 0
-            while bytes_received < filesize:
-                bytes_read = client_socket.recv(BUFFER_SIZE)
-                if not bytes_read:
-                    break
-                f.write(bytes_read)
-                bytes_received += len(bytes_read)
+def download_selected_files(filenames):
+    """Function to queue the selected files for download from the server"""
+    # Several files download at once, each on its own connection; the outcome is reported when all are done
+    return downloads.add(filenames, on_finish=lambda results: events.post(report_downloads, results))
+
+def report_downloads(results):
+    """Function to report the outcome of a batch of downloads"""
+    filenames = [result.name for result in results]
+    for filename in filenames:
+        transfer_panel.remove(("download", filename))
+    failed = [result for result in results if result.error]
+    if failed:
+        # Show error for the files that could not be downloaded
+        messagebox.showerror("Error", "\n".join(f"{result.name}: {result.error}" for result in failed))
+    else:
         # Show success message
-        messagebox.showinfo("Success", f"File '{filename}' downloaded successfully.")
-    except Exception as e:
-        print(f"Error: {e}")
-
-    finally:
-        # Reconnect to the server without showing the connection message
-        client_socket.close()
-        connect_to_server(show_message=False)
+        messagebox.showinfo("Success", f"Downloaded {', '.join(filenames)} successfully.")
 
 def show_local_files():
     """List and display files in the downloaded files directory."""
@@ -263,8 +248,16 @@ def show_local_files():
     # Create the directory if it doesn't exist
     os.makedirs(downloaded_files_dir, exist_ok=True)
 
-    # List files in the directory
-    local_files = os.listdir(downloaded_files_dir)
+    # List files in the directory and its folders by stored path, without the manifest of what was downloaded
+    local_files = []
+    for parent, _, files in os.walk(downloaded_files_dir):
+        relative = os.path.relpath(parent, downloaded_files_dir)
+        for name in sorted(files):
+            if relative == os.curdir:
+                if name != MANIFEST_NAME:
+                    local_files.append(name)
+            else:
+                local_files.append("/".join(relative.split(os.sep) + [name]))
 
     # Create a new window to display the files
     file_window = tk.Toplevel(app)
@@ -295,7 +288,7 @@ def delete_local_file(file_listbox):
     try:
         # Get the selected file name
         file_to_delete = file_listbox.get(selected_files[0])
-        file_path = os.path.join(downloaded_files_dir, file_to_delete)
+        file_path = os.path.join(downloaded_files_dir, *file_to_delete.split("/"))
 
         # Delete the file
         os.remove(file_path)
@@ -308,11 +301,14 @@ def delete_local_file(file_listbox):
 
 def logout():
     """Function to disconnect from the server"""
-    global client_socket
-    if client_socket:
+    global client, downloads
+    if client:
         try:
-            client_socket.close()  # Close the socket connection
-            client_socket = None
+            # Stop handing out download streams, then close the connection they share with the client
+            downloads.pool.close()
+            downloads = None
+            client.close()  # Close the socket connection
+            client = None
             messagebox.showinfo("Success", "Disconnected from the server.")
         except socket.error as e:
             messagebox.showerror("Error", f"An error occurred while disconnecting: {str(e)}")
@@ -321,52 +317,60 @@ def logout():
         connect_btn.config(state=tk.NORMAL)
         logout_btn.config(state=tk.DISABLED)
 
-# Create the main application window
-app = tk.Tk()
-app.title("File Client")
+if __name__ == "__main__":
+    # Create the main application window
+    app = tk.Tk()
+    app.title("File Client")
+
+    # Set the width of the window
+    app.geometry("400x600")
 
-# Set the width of the window
-app.geometry("400x400")
+    # Set the background color of the root window
+    app.configure(bg="#a6daff")  # Example: Light blue background
 
-# Set the background color of the root window
-app.configure(bg="#a6daff")  # Example: Light blue background
+    # Get the absolute path to the image
+    icon_path = os.path.join(os.path.dirname(__file__), "logo.png")
+
+    # Load and set the window icon
+    try:
+        app.iconphoto(False, PhotoImage(file=icon_path))
+    except Exception as e:
+        print(f"Error loading icon: {e}")
 
-# Get the absolute path to the image
-icon_path = os.path.join(os.path.dirname(__file__), "logo.png")
+    # Create and place the input fields for server IP and port
+    tk.Label(app, text="Server IP:").pack(pady=5)
+    server_ip_entry = tk.Entry(app)
+    server_ip_entry.pack()
+    tk.Label(app, text="Server Port:").pack(pady=5)
+    server_port_entry = tk.Entry(app)
+    server_port_entry.pack()
 
-# Load and set the window icon
-try:
-    app.iconphoto(False, PhotoImage(file=icon_path))
-except Exception as e:
-    print(f"Error loading icon: {e}")
+    # Create and place the Connect button
+    connect_btn = tk.Button(app, text="Connect to Server", command=connect_to_server)
+    connect_btn.pack(pady=10)
 
-# Create and place the input fields for server IP and port
-tk.Label(app, text="Server IP:").pack(pady=5)
-server_ip_entry = tk.Entry(app)
-server_ip_entry.pack()
-tk.Label(app, text="Server Port:").pack(pady=5)
-server_port_entry = tk.Entry(app)
-server_port_entry.pack()
+    # Create and place the Upload button
+    upload_btn = tk.Button(app, text="Upload Files", command=upload_files)
+    upload_btn.pack(pady=10)
 
-# Create and place the Connect button
-connect_btn = tk.Button(app, text="Connect to Server", command=connect_to_server)
-connect_btn.pack(pady=10)
+    # Create and place the Download button
+    download_btn = tk.Button(app, text="Download File", command=download_file)
+    download_btn.pack(pady=10)
 
-# Create and place the Upload button
-upload_btn = tk.Button(app, text="Upload Files", command=upload_files)
-upload_btn.pack(pady=10)
+    # create and place the "Show Available File" button
+    show_files_button = tk.Button(app, text="Show Available Files", command=show_local_files)
+    show_files_button.pack(pady=10)
 
-# Create and place the Download button
-download_btn = tk.Button(app, text="Download File", command=download_file)
-download_btn.pack(pady=10)
+    # create and place the logout button
+    logout_btn = tk.Button(app, text="Logout", command=logout)
+    logout_btn.pack(pady=10)
 
-# create and place the "Show Available File" button
-show_files_button = tk.Button(app, text="Show Available Files", command=show_local_files)
-show_files_button.pack(pady=10)
+    # Progress bars of the running transfers
+    transfer_panel = TransferPanel(app)
+    transfer_panel.pack(padx=10, pady=5, fill=tk.X)
 
-# create and place the logout button
-logout_btn = tk.Button(app, text="Logout", command=logout)
-logout_btn.pack(pady=10)
+    # Lets the transfer threads update the window through the Tk thread
+    events = EventBridge(app)
 
-# Run the main event loop
-app.mainloop()
+    # Run the main event loop
+    app.mainloop()
@@ -0,0 +1,117 @@
+import json  # Import json to store the manifest entries
+import os  # Import os to look at the downloaded files
+import threading  # Import threading because several downloads record into one manifest at once
+
+from common.paths import local_path
+
+MANIFEST_NAME = ".manifest.jsonl"  # File in a download directory describing what was downloaded into it
+COMPACT_RATIO = 2  # Rewrite the manifest once it holds this many lines per live entry
+
+
+class Manifest:
+    """Size, modification time and hash of every file downloaded into a directory.
+
+    A download of a file the manifest knows asks the server to send it only if
+    its contents differ from the recorded hash; the server answers "not
+    modified" otherwise and the local copy is kept. An entry only counts while
+    the local file still has the recorded size and mtime, so a file that was
+    edited or replaced locally is downloaded in full again.
+
+    The manifest is a JSON line per recorded download, appended as downloads
+    finish, so recording one never rewrites the others. Use Manifest.of() to
+    share one instance between the threads downloading into a directory.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def of(cls, directory):
+        """Return the manifest of directory, the same instance for every caller."""
+        directory = os.path.abspath(directory)
+        with cls._instances_lock:
+            manifest = cls._instances.get(directory)
+            if manifest is None:
+                manifest = cls._instances[directory] = cls(directory)
+            return manifest
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        # Entry of every file by stored path: size, mtime in nanoseconds and sha256
+        self.entries = {}
+        # Lines in the manifest file, counting the ones later lines replaced
+        self._lines = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        entry = json.loads(line)
+                        name = entry["name"]
+                    except (ValueError, TypeError, KeyError):
+                        # A line cut short by a crash; the download it recorded will just happen again
+                        continue
+                    if entry.get("sha256"):
+                        self.entries[name] = entry
+                    else:
+                        self.entries.pop(name, None)
+        except OSError:
+            return
+        if self._lines > COMPACT_RATIO * len(self.entries):
+            try:
+                self._compact()
+            except OSError:
+                pass
+
+    def _compact(self):
+        """Rewrite the manifest with one line per live entry."""
+        temp = self.path + ".tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        os.replace(temp, self.path)
+        self._lines = len(self.entries)
+
+    def sha256(self, name):
+        """Return the hash of the local copy of name, None if it is unknown or changed since it was downloaded."""
+        with self._lock:
+            entry = self.entries.get(name)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(local_path(self.directory, name))
+        except OSError:
+            return None
+        if stat.st_size != entry.get("size") or stat.st_mtime_ns != entry.get("mtime"):
+            return None
+        return entry["sha256"]
+
+    def record(self, name, sha256):
+        """Note that name was just downloaded and has the given hash; None forgets what was known about it."""
+        entry = {"name": name, "sha256": sha256}
+        if sha256:
+            try:
+                stat = os.stat(local_path(self.directory, name))
+            except OSError:
+                entry["sha256"] = None
+            else:
+                entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+        with self._lock:
+            if not entry["sha256"] and name not in self.entries:
+                return
+            if entry["sha256"]:
+                self.entries[name] = entry
+            else:
+                del self.entries[name]
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                self._lines += 1
+            except OSError:
+                # Without the manifest the next download of the file is a full one, nothing worse
+                pass
@@ -0,0 +1,340 @@
+import os  # Import os to read file ranges for sendfile()
+import socket  # Import the socket module to enable network communication
+import threading  # Import threading to read the connection while other threads send on it
+
+from common.compression import SUPPORTED_CODECS
+from common.framing import (MUX_CHUNK, MUX_HEADER, MUX_VERSION, SINGLE_STREAM_VERSION, STREAM_WINDOW, WINDOW, Mux,
+                            ProtocolError, decode_mux, encode_mux, negotiate, recv_exactly)
+from common.sockets import configure_socket
+
+NEGOTIATION_TIMEOUT = 5  # Seconds to wait for the server to accept the framed protocol
+TIMEOUT = 300  # Seconds a send or a wait for the server's reply may take before the connection counts as lost
+
+
+def connect(address, version=SINGLE_STREAM_VERSION, codecs=SUPPORTED_CODECS, timeout=TIMEOUT):
+    """Connect to the server and negotiate the framed protocol.
+
+    Returns (sock, version, codecs) with the connected socket and what was agreed.
+    Sends and receives on the socket raise socket.timeout once they wait on the
+    server for timeout seconds; None waits for ever.
+    """
+    sock = socket.create_connection(address, timeout or None)
+    try:
+        configure_socket(sock)
+        # Old servers never answer the handshake
+        sock.settimeout(NEGOTIATION_TIMEOUT)
+        version, codecs = negotiate(sock, version, codecs)
+        sock.settimeout(timeout or None)
+    except (OSError, ProtocolError):
+        sock.close()
+        raise
+    return sock, version, codecs
+
+
+class WriteTurns:
+    """Turns at writing one mux frame to the connection, threads of priority streams first."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._busy = False
+        # Priority writers waiting for a turn
+        self._priority_waiting = 0
+
+    def acquire(self, priority):
+        with self._cond:
+            if priority:
+                self._priority_waiting += 1
+            while self._busy or (not priority and self._priority_waiting):
+                self._cond.wait()
+            if priority:
+                self._priority_waiting -= 1
+            self._busy = True
+
+    def release(self):
+        with self._cond:
+            self._busy = False
+            self._cond.notify_all()
+
+
+class Stream:
+    """One stream of a MuxConnection, with the blocking socket methods a TransferSession uses.
+
+    Data the server sends is buffered by the connection's reader thread; the
+    server may only send STREAM_WINDOW bytes ahead of what was read. Sends are
+    cut into DATA frames of at most MUX_CHUNK bytes that wait for the server to
+    allow more. Either wait raises socket.timeout after the connection's timeout.
+    """
+
+    def __init__(self, mux, stream_id, priority=False):
+        self.mux = mux
+        self.stream_id = stream_id
+        # Frames of a priority stream are written before bulk DATA of the others
+        self.priority = priority
+        # Guards everything below, and is notified whenever it changes
+        self._cond = threading.Condition()
+        # Bytes received but not read yet
+        self.buffer = bytearray()
+        # DATA bytes we may still send and the server may still send
+        self.send_window = STREAM_WINDOW
+        self.recv_window = STREAM_WINDOW
+        # Bytes read since we last allowed the server to send more
+        self.consumed = 0
+        # Set once the server sent END, and why the stream failed if it did
+        self.ended = False
+        self.error = None
+        self.closed = False
+        # Seconds a read or a send may wait on the server, None for ever
+        self.timeout = mux.timeout
+
+    # Called by the reader thread
+
+    def feed(self, data):
+        with self._cond:
+            if len(data) > self.recv_window:
+                raise ProtocolError(f"Server sent more than the window of stream {self.stream_id}")
+            self.recv_window -= len(data)
+            self.buffer += data
+            self._cond.notify_all()
+
+    def end(self):
+        with self._cond:
+            self.ended = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = self.error or error
+            self._cond.notify_all()
+
+    def allow(self, n):
+        with self._cond:
+            self.send_window += n
+            self._cond.notify_all()
+
+    # Socket interface
+
+    def _wait(self, ready):
+        # Called with the condition held
+        if not self._cond.wait_for(lambda: ready() or self.error, self.timeout):
+            raise socket.timeout(f"Timed out waiting for the server on stream {self.stream_id}")
+
+    def _wait_readable(self):
+        # Called with the condition held
+        self._wait(lambda: self.buffer or self.ended)
+        if not self.buffer and self.error:
+            raise ConnectionError(self.error)
+
+    def _consumed(self, n):
+        with self._cond:
+            self.consumed += n
+            if self.consumed < STREAM_WINDOW // 2 or self.ended or self.error:
+                return
+            n, self.consumed = self.consumed, 0
+            self.recv_window += n
+        # Let the server send as much again as was read
+        self.mux.send_frame(self.stream_id, Mux.WINDOW, WINDOW.pack(n), True)
+
+    def recv(self, size):
+        with self._cond:
+            self._wait_readable()
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        self._consumed(len(data))
+        return data
+
+    def recv_into(self, view, nbytes=0):
+        view = memoryview(view)
+        with self._cond:
+            self._wait_readable()
+            n = min(nbytes or len(view), len(self.buffer))
+            view[:n] = self.buffer[:n]
+            del self.buffer[:n]
+        self._consumed(n)
+        return n
+
+    def _credit(self, wanted):
+        """Wait until the server allows more data; return how much of wanted fits in the next frame."""
+        with self._cond:
+            self._wait(lambda: self.send_window > 0)
+            if self.error:
+                raise ConnectionError(self.error)
+            n = min(wanted, self.send_window, MUX_CHUNK)
+            self.send_window -= n
+            return n
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        while view:
+            n = self._credit(len(view))
+            self.mux.send_frame(self.stream_id, Mux.DATA, view[:n], self.priority)
+            view = view[n:]
+
+    def sendfile(self, file, offset=0, count=None):
+        """Send count bytes of file starting at offset, returning the number sent."""
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        sent = 0
+        file.seek(offset)
+        while sent < count:
+            data = file.read(min(count - sent, MUX_CHUNK))
+            if not data:
+                break
+            self.sendall(data)
+            sent += len(data)
+        return sent
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def shutdown(self, how):
+        """Abandon the stream: the server drops it and pending reads and writes fail."""
+        self.fail("Stream reset")
+        self.mux.reset(self)
+
+    def close(self):
+        """Tell the server nothing more will be sent on the stream and forget it."""
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            failed = self.error is not None
+        if not failed:
+            try:
+                self.mux.send_frame(self.stream_id, Mux.END, b"", True)
+            except OSError:
+                pass
+        self.mux.forget(self)
+
+
+class MuxConnection:
+    """One connection to the server carrying many streams at once, protocol version 4 on.
+
+    Every stream behaves like a connection of its own: open_stream() hands out a
+    socket-like Stream for a TransferSession, so a listing on one stream goes
+    through while a download streams on another, over the same TCP connection.
+    A server that can't multiplex gets a connection of its own per stream instead.
+
+        mux = MuxConnection("127.0.0.1", 5001)
+        control = TransferSession(mux=mux, priority=True)
+    """
+
+    def __init__(self, host, port, codecs=SUPPORTED_CODECS, timeout=TIMEOUT):
+        self.address = (host, port)
+        # Seconds a stream may wait on the server, see connect()
+        self.timeout = timeout or None
+        sock, self.version, self.codecs = connect(self.address, MUX_VERSION, codecs, timeout)
+        self.multiplexed = self.version >= MUX_VERSION
+        # Open streams by id, and the id of the last one opened
+        self.streams = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        # Held while a stream is numbered and opened
+        self._open_lock = threading.Lock()
+        self.turns = WriteTurns()
+        # Set once the connection is lost or closed
+        self.closed = False
+        # Old servers: this connection serves the first stream, later ones connect anew
+        self._spare = None
+        if not self.multiplexed:
+            self.sock = None
+            self._spare = sock
+            return
+        # connect() turned on TCP_NODELAY: WINDOW frames are tiny and must not wait to fill a packet
+        self.sock = sock
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def open_stream(self, priority=False):
+        """Return (sock, version, codecs) for a new stream, sock being a Stream or a plain socket."""
+        if not self.multiplexed:
+            with self._lock:
+                sock, self._spare = self._spare, None
+            if sock is not None:
+                return sock, self.version, self.codecs
+            return connect(self.address, self.version, self.codecs, self.timeout)
+        with self._open_lock:
+            with self._lock:
+                if self.closed:
+                    raise ConnectionError("Connection to the server lost")
+                self._next_id += 1
+                stream = self.streams[self._next_id] = Stream(self, self._next_id, priority)
+            # Open it on the server now: streams must be opened in the order of their ids
+            self.send_frame(stream.stream_id, Mux.DATA, b"", True)
+        return stream, self.version, self.codecs
+
+    def send_frame(self, stream_id, kind, payload=b"", priority=False):
+        """Write one mux frame, waiting for a turn at the connection."""
+        data = encode_mux(stream_id, kind, len(payload)) + payload
+        self.turns.acquire(priority)
+        try:
+            self.sock.sendall(data)
+        except socket.timeout:
+            # Part of the frame may have gone out, nothing more can be sent after it
+            self.close()
+            raise
+        finally:
+            self.turns.release()
+
+    def reset(self, stream):
+        """Abandon a stream."""
+        try:
+            self.send_frame(stream.stream_id, Mux.RESET, b"", True)
+        except OSError:
+            pass
+        self.forget(stream)
+
+    def forget(self, stream):
+        with self._lock:
+            self.streams.pop(stream.stream_id, None)
+
+    def _read(self):
+        error = "Connection to the server lost"
+        try:
+            while True:
+                try:
+                    header = self.sock.recv(MUX_HEADER.size)
+                except socket.timeout:
+                    # Silence between frames is no stall; streams waiting on the server time out on their own
+                    continue
+                if not header:
+                    raise ConnectionError("Connection closed by peer")
+                header += recv_exactly(self.sock, MUX_HEADER.size - len(header))
+                stream_id, kind, length = decode_mux(header)
+                payload = recv_exactly(self.sock, length) if length else b""
+                with self._lock:
+                    stream = self.streams.get(stream_id)
+                if stream is None:
+                    # A stream that was closed or reset meanwhile
+                    continue
+                if kind == Mux.DATA:
+                    stream.feed(payload)
+                elif kind == Mux.END:
+                    stream.end()
+                elif kind == Mux.WINDOW:
+                    stream.allow(WINDOW.unpack(payload)[0])
+                elif kind == Mux.RESET:
+                    stream.fail("Stream reset by the server")
+                    self.forget(stream)
+        except (OSError, ProtocolError) as e:
+            error = str(e) or error
+        finally:
+            with self._lock:
+                self.closed = True
+                streams = list(self.streams.values())
+            for stream in streams:
+                stream.fail(error)
+
+    def close(self):
+        """Close the connection and every stream on it."""
+        with self._lock:
+            self.closed = True
+            sock, self._spare = self._spare, None
+        if sock:
+            sock.close()
+        if self.sock:
+            try:
+                # Wakes the reader thread
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
@@ -0,0 +1,707 @@
+import hashlib  # Import hashlib to hash files sent as a delta
+import mmap  # Import mmap to scan files for delta uploads without reading them into memory
+import os  # Import the os module to interact with the operating system
+import queue  # Import queue to hand sent uploads over to the acknowledgement reader
+import socket  # Import the socket module to enable network communication
+import threading  # Import threading to send and receive on the socket at the same time
+from collections import namedtuple  # Import namedtuple for transfer results
+
+from common.bundle import (END_OF_ARCHIVE, EXTENDED, FILE, INLINE_SIZE, TAR_BLOCK, decode_member, decode_pax,
+                           encode_member, member_length, padding)
+from common.compression import (BLOCK, COMPRESS_CHUNK_SIZE, SUPPORTED_CODECS, Decoder, Encoder, block_length,
+                                choose_codec, compressible, frame_codec)
+from common.delta import COPY, INSTRUCTION, compute_delta, delta_length, parse_signatures
+from common.framing import (DELTA_VERSION, SINGLE_STREAM_VERSION, Op, ProtocolError, encode_frame, recv_exactly,
+                            recv_frame)
+from common.hashing import file_sha256
+from common.paths import clean_path, local_path
+
+from .manifest import Manifest
+from .mux import TIMEOUT, connect
+
+BUFFER_SIZE = 256 * 1024  # Buffer size for data transfer
+PARTIAL_SUFFIX = ".part"  # Suffix of downloads that have not finished yet
+PARALLEL_SUFFIX = ".parallel"  # Suffix of files being assembled from parallel ranges
+PARALLEL_STREAMS = 4  # Connections used to download one large file
+PARALLEL_THRESHOLD = 64 * 1024 * 1024  # Files at least this large are worth splitting
+MIN_RANGE_SIZE = 8 * 1024 * 1024  # Smallest byte range given to one connection
+DELTA_MIN_SIZE = 1024 * 1024  # Smaller files are uploaded whole, a delta would not save much
+DELTA_MAX_LITERAL_RATIO = 0.5  # Upload whole files whose delta would resend more than this fraction
+PROGRESS_CHUNK = 4 * 1024 * 1024  # Bytes sent with sendfile between two progress reports
+
+# Outcome of one file in a batch; error is None when the transfer succeeded
+Result = namedtuple("Result", ["name", "error"])
+
+
+class TransferError(Exception):
+    """Raised when the server refuses a transfer or the file changes during it."""
+
+
+def stored_name(filepath, names=None):
+    """Return the name a local file is uploaded as: its entry in names, else its file name."""
+    if names and filepath in names:
+        return clean_path(names[filepath])
+    return os.path.basename(filepath)
+
+
+def local_file(dest_dir, name, suffix=""):
+    """Return the local path of a downloaded file, with suffix, creating the folders it is in."""
+    path = local_path(dest_dir, clean_path(name)) + suffix
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class TransferSession:
+    """Persistent framed connection that carries whole batches of transfers.
+
+    Requests are pipelined: a batch goes out back to back and every file gets its
+    own acknowledgement, tagged with the id of the request it answers. Transfers
+    are compressed with one of codecs when the server supports it and the file
+    is not compressed already; pass codecs=0 to send everything raw.
+
+    If progress is given, it is called as progress(name, count, total) from the
+    transferring thread each time count more bytes of a total-byte file have
+    been sent or received.
+
+    With mux, a MuxConnection, the session runs on a stream of that connection
+    instead of a connection of its own; priority streams are written first.
+
+    A send or a wait for a reply that takes timeout seconds raises socket.timeout;
+    on a stream the timeout of its MuxConnection applies.
+    """
+
+    def __init__(self, host=None, port=None, codecs=SUPPORTED_CODECS, progress=None, mux=None, priority=False,
+                 timeout=TIMEOUT):
+        # Multiplexed connection the session is a stream of, None for a connection of its own
+        self.mux = mux
+        # Address of the server and how long to wait on it, used to open extra connections for parallel downloads
+        self.address = mux.address if mux else (host, port)
+        self.timeout = timeout
+        if mux:
+            self.sock, self.version, self.codecs = mux.open_stream(priority)
+        else:
+            # Connect to the server and agree on the framed protocol version
+            self.sock, self.version, self.codecs = connect(self.address, SINGLE_STREAM_VERSION, codecs, timeout)
+        # Called with the progress of every transfer
+        self.progress = progress
+        # Only one batch may use the connection at a time
+        self.lock = threading.Lock()
+        # Id of the next request
+        self._next_id = 0
+
+    def close(self):
+        """Close the connection to the server."""
+        self.sock.close()
+
+    def _report(self, name, count, total):
+        if self.progress and count:
+            self.progress(name, count, total)
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _reply(self, request_id):
+        """Receive the reply to request_id."""
+        reply = recv_frame(self.sock)
+        if reply.meta.get("id") != request_id:
+            raise ProtocolError(f"Expected the reply to request {request_id}, got {reply.meta.get('id')}")
+        return reply
+
+    def list_page(self, prefix="", sort="name", reverse=False, offset=0, limit=None, folder=None):
+        """Return one page of the server's file listing as the reply metadata.
+
+        The reply holds "files" (name, size and mtime of each file), "total" (files
+        matching prefix) and "next" (offset of the next page, None after the last).
+        Given a folder, "" for the root, only the files directly in it are listed
+        and the reply also holds "folders", the names of its subfolders.
+        """
+        with self.lock:
+            request_id = self._new_id()
+            meta = {"id": request_id, "prefix": prefix, "sort": sort, "reverse": reverse, "offset": offset}
+            if limit is not None:
+                meta["limit"] = limit
+            if folder is not None:
+                meta["folder"] = folder
+            self.sock.sendall(encode_frame(Op.LIST_FILES, meta))
+            reply = self._reply(request_id)
+            if reply.op == Op.ERROR:
+                raise TransferError(reply.meta.get("error", "Listing failed"))
+            return reply.meta
+
+    def list_files(self, prefix=""):
+        """Return the names of the files stored on the server, fetching every page."""
+        names = []
+        offset = 0
+        while offset is not None:
+            page = self.list_page(prefix, offset=offset)
+            names.extend(entry["name"] for entry in page["files"])
+            offset = page["next"]
+        return names
+
+    def list_folder(self, folder=""):
+        """Return (files, folders): the names of the files and subfolders directly in a folder on the server."""
+        files = []
+        offset = 0
+        while offset is not None:
+            page = self.list_page(offset=offset, folder=folder)
+            files.extend(entry["name"] for entry in page["files"])
+            offset = page["next"]
+        return files, page["folders"]
+
+    def delete(self, filename):
+        """Delete a file, or an empty folder, from the server."""
+        with self.lock:
+            request_id = self._new_id()
+            self.sock.sendall(encode_frame(Op.DELETE, {"id": request_id, "name": clean_path(filename)}))
+            reply = self._reply(request_id)
+            if reply.op == Op.ERROR:
+                raise TransferError(reply.meta.get("error", "Delete failed"))
+
+    def mkdir(self, folder):
+        """Create a folder on the server, with any folders above it that are missing."""
+        with self.lock:
+            request_id = self._new_id()
+            self.sock.sendall(encode_frame(Op.MKDIR, {"id": request_id, "name": clean_path(folder)}))
+            reply = self._reply(request_id)
+            if reply.op == Op.ERROR:
+                raise TransferError(reply.meta.get("error", "Creating the folder failed"))
+
+    def stat_batch(self, filenames):
+        """Return the server's STAT reply metadata for every name in filenames, "error" set on failure."""
+        with self.lock:
+            requests = [(self._new_id(), clean_path(name)) for name in filenames]
+            self.sock.sendall(b"".join(encode_frame(Op.STAT, {"id": request_id, "name": name})
+                                       for request_id, name in requests))
+            return [self._reply(request_id).meta for request_id, _ in requests]
+
+    def have_batch(self, hashes, names=None):
+        """Ask the server to store every file it already has the contents of.
+
+        hashes maps file paths to their SHA-256; returns the paths the server now
+        stores under their stored_name() without needing their contents.
+        """
+        with self.lock:
+            requests = [(self._new_id(), filepath, sha256) for filepath, sha256 in hashes.items()]
+            self.sock.sendall(b"".join(encode_frame(Op.HAVE, {"id": request_id, "name": stored_name(filepath, names),
+                                                              "sha256": sha256})
+                                       for request_id, filepath, sha256 in requests))
+            stored = set()
+            for request_id, filepath, _ in requests:
+                reply = self._reply(request_id)
+                if reply.op == Op.OK and reply.meta.get("have"):
+                    stored.add(filepath)
+            return stored
+
+    def upload_batch(self, filepaths, resume=True, dedup=True, delta=True, names=None):
+        """Upload every file in filepaths over this connection and return a Result for each.
+
+        Each file is stored under its file name, or the path names maps it to, e.g.
+        "reports/june.xlsx" to store it in the reports folder.
+
+        With resume, files the server holds a partial upload of are continued from
+        where the earlier attempt stopped instead of from byte 0. With dedup, files
+        are hashed first and those whose contents the server already stores are not
+        sent at all. With delta, large files the server holds another version of
+        are sent as the differences to that version.
+        """
+        hashes = {}
+        if dedup:
+            for filepath in filepaths:
+                try:
+                    hashes[filepath] = file_sha256(filepath)
+                except OSError:
+                    # Reported when the upload tries to open the file
+                    pass
+            stored = self.have_batch(hashes, names)
+        else:
+            stored = set()
+        # Results of the files that don't go through the pipelined batch
+        done = {filepath: Result(stored_name(filepath, names), None) for filepath in stored}
+        pending = [filepath for filepath in filepaths if filepath not in done]
+
+        stats = {}
+        if (resume or delta) and pending:
+            # One round trip asks for the stored and partial size of every file in the batch
+            stats = {stored_name(filepath, names): stat
+                     for filepath, stat in zip(pending, self.stat_batch([stored_name(f, names) for f in pending]))}
+        offsets = {name: stat.get("partial", 0) for name, stat in stats.items()} if resume else {}
+
+        if delta and self.version >= DELTA_VERSION:
+            for filepath in pending:
+                filename = stored_name(filepath, names)
+                # A partial upload is cheaper to finish than to diff
+                if (stats[filename].get("size") or 0) >= DELTA_MIN_SIZE and not offsets.get(filename):
+                    result = self.upload_delta(filepath, hashes.get(filepath), filename)
+                    if result:
+                        done[filepath] = result
+            pending = [filepath for filepath in pending if filepath not in done]
+
+        with self.lock:
+            # Uploads that went out, in order; None marks the end of the batch
+            sent = queue.Queue()
+            errors = []
+            sender = threading.Thread(target=self._send_uploads, args=(pending, offsets, hashes, sent, errors, names),
+                                      daemon=True)
+            sender.start()
+
+            # Read the acknowledgements while the sender is still streaming later files
+            results = []
+            while True:
+                item = sent.get()
+                if item is None:
+                    break
+                request_id, filename, error = item
+                if error is None:
+                    reply = self._reply(request_id)
+                    if reply.op == Op.ERROR:
+                        error = reply.meta.get("error", "Upload failed")
+                results.append(Result(filename, error))
+            sender.join()
+            if errors:
+                raise errors[0]
+        # Report in the order of filepaths
+        uploaded = iter(results)
+        return [done[filepath] if filepath in done else next(uploaded) for filepath in filepaths]
+
+    def upload_delta(self, filepath, sha256=None, filename=None):
+        """Upload filepath as the differences to the server's file of the same name, or filename.
+
+        The server sends signatures of its blocks and only the data it doesn't have
+        goes back. Returns a Result, or None without uploading anything if the file
+        can't be sent as a delta or the delta would save too little.
+        """
+        filename = filename or os.path.basename(filepath)
+        try:
+            f = open(filepath, "rb")
+        except OSError:
+            # The whole-file upload reports the error
+            return None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return None
+            with self.lock:
+                request_id = self._new_id()
+                self.sock.sendall(encode_frame(Op.SIGNATURE, {"id": request_id, "name": filename}))
+                reply = self._reply(request_id)
+                if reply.op == Op.ERROR:
+                    return None
+                sigs = parse_signatures(recv_exactly(self.sock, reply.body_length))
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                base = reply.meta
+                instructions = compute_delta(data, base["size"], base["block_size"], sigs,
+                                             int(size * DELTA_MAX_LITERAL_RATIO))
+                if instructions is None:
+                    return None
+                meta = {"name": filename, "base": base["sha256"],
+                        "sha256": sha256 or hashlib.sha256(data).hexdigest()}
+                with self.lock:
+                    request_id = self._new_id()
+                    meta["id"] = request_id
+                    self.sock.sendall(encode_frame(Op.DELTA, meta, delta_length(instructions)))
+                    # Gather small instructions into larger sends
+                    out = bytearray()
+                    for kind, first, length in instructions:
+                        if kind == COPY:
+                            out += INSTRUCTION.pack(kind, first, length)
+                        else:
+                            # Literal data is taken from the given offset of the file
+                            out += INSTRUCTION.pack(kind, 0, length)
+                            out += data[first:first + length]
+                        if len(out) >= BUFFER_SIZE:
+                            self.sock.sendall(out)
+                            out.clear()
+                    self.sock.sendall(out)
+                    reply = self._reply(request_id)
+        if reply.op == Op.ERROR:
+            return Result(filename, reply.meta.get("error", "Upload failed"))
+        # Only the differences crossed the network, but the whole file is now on the server
+        self._report(filename, size, size)
+        return Result(filename, None)
+
+    def _send_uploads(self, filepaths, offsets, hashes, sent, errors, names=None):
+        try:
+            for filepath in filepaths:
+                filename = stored_name(filepath, names)
+                try:
+                    # Open the file in binary read mode
+                    f = open(filepath, "rb")
+                except OSError as e:
+                    # Report the file as failed without sending anything
+                    sent.put((None, filename, str(e)))
+                    continue
+
+                with f:
+                    filesize = os.fstat(f.fileno()).st_size
+                    # Continue a partial upload only if it can still be a prefix of this file
+                    offset = offsets.get(filename, 0)
+                    if offset > filesize:
+                        offset = 0
+                    request_id = self._new_id()
+                    # The header carries the exact size of the file data that follows
+                    meta = {"id": request_id, "name": filename, "offset": offset}
+                    if filepath in hashes:
+                        # Lets the server check the upload arrived intact
+                        meta["sha256"] = hashes[filepath]
+                    # Skip compression for small and already compressed files
+                    codec = choose_codec(self.codecs) if filesize > offset else 0
+                    if codec and not compressible(f, filesize, filename):
+                        codec = 0
+                    self.sock.sendall(encode_frame(Op.UPLOAD, meta, filesize - offset, codec))
+                    # The part sent by an earlier attempt counts as done
+                    self._report(filename, offset, filesize)
+                    if codec:
+                        sent_bytes = self._send_compressed(f, offset, filesize - offset, codec, filename, filesize)
+                    else:
+                        sent_bytes = 0
+                        while sent_bytes < filesize - offset:
+                            # Send in chunks so progress can be reported between them
+                            n = self.sock.sendfile(f, offset + sent_bytes,
+                                                   min(filesize - offset - sent_bytes, PROGRESS_CHUNK))
+                            if not n:
+                                break
+                            sent_bytes += n
+                            self._report(filename, n, filesize)
+                    if sent_bytes < filesize - offset:
+                        raise OSError(f"{filename} shrank while it was being uploaded")
+                sent.put((request_id, filename, None))
+        except Exception as e:
+            errors.append(e)
+            # The stream is broken mid-frame; unblock the acknowledgement reader
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        finally:
+            sent.put(None)
+
+    def _send_compressed(self, f, offset, count, codec, name=None, total=None):
+        """Send count bytes of f starting at offset as a compressed body, returning the bytes read."""
+        encoder = Encoder(codec)
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            data = f.read(min(count - sent, COMPRESS_CHUNK_SIZE))
+            if not data:
+                break
+            blocks = encoder.encode(data)
+            if blocks:
+                self.sock.sendall(blocks)
+            sent += len(data)
+            self._report(name, len(data), total)
+        self.sock.sendall(encoder.finish())
+        return sent
+
+    def upload_bundle(self, filepaths, names=None):
+        """Upload every file in filepaths as one tar stream and return a Result for each.
+
+        A bundle is a single request however many files it holds, which is what
+        counts for many small files. It does not resume, dedup or send deltas.
+        Files are stored as in upload_batch().
+        """
+        results = {}
+        # (path, name, size, tar header) of every file that can be read
+        members = []
+        for filepath in filepaths:
+            filename = stored_name(filepath, names)
+            try:
+                with open(filepath, "rb") as f:
+                    stat = os.fstat(f.fileno())
+            except OSError as e:
+                results[filepath] = Result(filename, str(e))
+                continue
+            members.append((filepath, filename, stat.st_size, encode_member(filename, stat.st_size, stat.st_mtime)))
+        length = sum(member_length(header, size) for _, _, size, header in members) + len(END_OF_ARCHIVE)
+
+        with self.lock:
+            request_id = self._new_id()
+            self.sock.sendall(encode_frame(Op.BUNDLE_UPLOAD, {"id": request_id, "count": len(members)}, length))
+            try:
+                self._send_bundle(members)
+            except OSError:
+                # The stream is broken mid-frame
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise
+            reply = self._reply(request_id)
+        if reply.op == Op.ERROR:
+            # E.g. a server that predates bundles
+            error = reply.meta.get("error", "Upload failed")
+            errors = {filename: error for _, filename, _, _ in members}
+        else:
+            errors = reply.meta.get("errors", {})
+        for filepath, filename, _, _ in members:
+            results[filepath] = Result(filename, errors.get(filename))
+        return [results[filepath] for filepath in filepaths]
+
+    def _send_bundle(self, members):
+        """Stream the tar archive of members, gathering small files into larger sends."""
+        out = bytearray()
+        for filepath, filename, size, header in members:
+            out += header
+            with open(filepath, "rb") as f:
+                if size <= INLINE_SIZE:
+                    data = f.read(size)
+                    if len(data) < size:
+                        raise OSError(f"{filename} shrank while it was being uploaded")
+                    out += data
+                    self._report(filename, size, size)
+                else:
+                    self.sock.sendall(out)
+                    out.clear()
+                    sent = 0
+                    while sent < size:
+                        n = self.sock.sendfile(f, sent, min(size - sent, PROGRESS_CHUNK))
+                        if not n:
+                            break
+                        sent += n
+                        self._report(filename, n, size)
+                    if sent < size:
+                        raise OSError(f"{filename} shrank while it was being uploaded")
+            out += padding(size)
+            if len(out) >= BUFFER_SIZE:
+                self.sock.sendall(out)
+                out.clear()
+        self.sock.sendall(out + END_OF_ARCHIVE)
+
+    def download_bundle(self, dest_dir, names=None, prefix=""):
+        """Download files as one tar stream into dest_dir and return a Result for each.
+
+        names selects the files, otherwise every file whose name starts with prefix
+        is sent. Results follow the order of names, or the order the files arrived in.
+        """
+        with self.lock:
+            os.makedirs(dest_dir, exist_ok=True)
+            manifest = Manifest.of(dest_dir)
+            request_id = self._new_id()
+            meta = {"id": request_id}
+            if names is not None:
+                meta["names"] = [clean_path(name) for name in names]
+            else:
+                meta["prefix"] = prefix
+            self.sock.sendall(encode_frame(Op.BUNDLE_DOWNLOAD, meta))
+            reply = self._reply(request_id)
+            if reply.op == Op.ERROR:
+                error = reply.meta.get("error", "Download failed")
+                if names is None:
+                    raise TransferError(error)
+                return [Result(clean_path(name), error) for name in names]
+            results = {name: Result(name, "File not found") for name in reply.meta.get("missing", [])}
+            remaining = reply.body_length
+            buf = bytearray(BUFFER_SIZE)
+
+            def read(size):
+                nonlocal remaining
+                if size > remaining:
+                    raise ProtocolError("Bundle member runs past the end of the body")
+                remaining -= size
+                return recv_exactly(self.sock, size)
+
+            extended = None
+            while remaining:
+                member = decode_member(read(TAR_BLOCK), extended)
+                extended = None
+                if member is None:
+                    # End of the archive; anything after it is padding
+                    read(remaining)
+                    break
+                stored_length = member.size + -member.size % TAR_BLOCK
+                if member.kind == EXTENDED:
+                    extended = decode_pax(read(stored_length)[:member.size])
+                    continue
+                try:
+                    # Never trust a name from the archive to stay inside dest_dir
+                    filename = clean_path(member.name) if member.kind == FILE else ""
+                except ValueError:
+                    filename = ""
+                if not filename:
+                    read(stored_length)
+                    continue
+                path = local_file(dest_dir, filename)
+                partial_path = path + PARTIAL_SUFFIX
+                with open(partial_path, "wb") as f:
+                    if member.size <= INLINE_SIZE:
+                        f.write(read(stored_length)[:member.size])
+                        self._report(filename, member.size, member.size)
+                    else:
+                        if stored_length > remaining:
+                            raise ProtocolError("Bundle member runs past the end of the body")
+                        remaining -= stored_length
+                        self._receive_raw(f, member.size, buf, filename, member.size)
+                        recv_exactly(self.sock, stored_length - member.size)
+                os.replace(partial_path, path)
+                # Keep the modification time the file has on the server
+                os.utime(path, (member.mtime, member.mtime))
+                # The archive carries no hash to revalidate the new copy with
+                manifest.record(filename, None)
+                results[filename] = Result(filename, None)
+        if names is None:
+            return list(results.values())
+        return [results.get(clean_path(name), Result(clean_path(name), "File not sent")) for name in names]
+
+    def download_batch(self, filenames, dest_dir, resume=True, revalidate=True):
+        """Download every file in filenames into dest_dir and return a Result for each.
+
+        Each file is received into a PARTIAL_SUFFIX file that is renamed once it is
+        complete. With resume, a partial file left by an interrupted download is
+        continued from its current size, and the whole file is checked against the
+        server's hash before it is put in place. With revalidate, a file downloaded before
+        and unchanged since, according to the Manifest of dest_dir, is sent again
+        only if the server's copy differs.
+        """
+        with self.lock:
+            os.makedirs(dest_dir, exist_ok=True)
+            manifest = Manifest.of(dest_dir)
+            requests = []
+            for name in filenames:
+                filename = clean_path(name)
+                partial_path = local_file(dest_dir, filename, PARTIAL_SUFFIX)
+                offset = os.path.getsize(partial_path) if resume and os.path.exists(partial_path) else 0
+                meta = {"id": self._new_id(), "name": filename, "offset": offset}
+                sha256 = manifest.sha256(filename) if revalidate and not offset else None
+                if sha256:
+                    meta["if_none_match"] = sha256
+                requests.append(meta)
+            # Send every request at once; the replies come back in the same order
+            self.sock.sendall(b"".join(encode_frame(Op.DOWNLOAD, meta) for meta in requests))
+
+            results = []
+            buf = bytearray(BUFFER_SIZE)
+            for request in requests:
+                filename = request["name"]
+                reply = self._reply(request["id"])
+                if reply.op == Op.ERROR:
+                    results.append(Result(filename, reply.meta.get("error", "Download failed")))
+                    continue
+                if reply.meta.get("not_modified"):
+                    # The local copy is the server's file already
+                    size = reply.meta.get("size", 0)
+                    self._report(filename, size, size)
+                    results.append(Result(filename, None))
+                    continue
+                partial_path = local_file(dest_dir, filename, PARTIAL_SUFFIX)
+                # The server says where the body starts, which is 0 if it could not resume
+                offset = reply.meta.get("offset", 0)
+                with open(partial_path, "r+b" if offset else "wb") as f:
+                    # Drop anything past the offset before appending the rest of the file
+                    f.truncate(offset)
+                    f.seek(offset)
+                    # The part received by an earlier attempt counts as done
+                    size = reply.meta.get("size", offset + reply.body_length)
+                    self._report(filename, offset, size)
+                    self._receive_body(f, reply, buf, filename, size)
+                sha256 = reply.meta.get("sha256")
+                if offset and sha256 and file_sha256(partial_path) != sha256:
+                    # The partial file began as an older version; start over next time
+                    os.remove(partial_path)
+                    results.append(Result(filename, f"{filename} changed on the server since the download began"))
+                    continue
+                os.replace(partial_path, local_path(dest_dir, filename))
+                manifest.record(filename, sha256)
+                results.append(Result(filename, None))
+            return results
+
+    def download_range(self, filename, path, offset, length, size):
+        """Download bytes offset..offset+length of a file of size bytes into the same place in path."""
+        with self.lock:
+            request_id = self._new_id()
+            meta = {"id": request_id, "name": filename, "offset": offset, "length": length}
+            self.sock.sendall(encode_frame(Op.DOWNLOAD, meta))
+            reply = self._reply(request_id)
+            if reply.op == Op.ERROR:
+                raise TransferError(reply.meta.get("error", "Download failed"))
+            if reply.meta.get("size") != size or reply.meta.get("offset") != offset or reply.body_length != length:
+                # Every range must come from the same version of the file
+                self.sock.close()
+                raise TransferError(f"{filename} changed on the server during the download")
+            with open(path, "r+b") as f:
+                f.seek(offset)
+                self._receive_body(f, reply, bytearray(min(length, BUFFER_SIZE) or 1), filename, size)
+
+    def download_parallel(self, filename, dest_dir, streams=PARALLEL_STREAMS, revalidate=True):
+        """Download one large file over several connections, or streams of the mux, at once, one byte range each."""
+        filename = clean_path(filename)
+        stat = self.stat_batch([filename])[0]
+        size = stat.get("size")
+        if size is None:
+            return Result(filename, stat.get("error", "File not found"))
+        manifest = Manifest.of(dest_dir)
+        if revalidate and stat.get("sha256") and manifest.sha256(filename) == stat["sha256"]:
+            # The local copy is the server's file already
+            self._report(filename, size, size)
+            return Result(filename, None)
+
+        # Size the local file up front so every range can be written straight into place
+        partial_path = local_file(dest_dir, filename, PARALLEL_SUFFIX)
+        with open(partial_path, "wb") as f:
+            f.truncate(size)
+
+        # Split the file into one range per connection
+        range_size = max(MIN_RANGE_SIZE, -(-size // streams))
+        ranges = [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)]
+        errors = []
+
+        def fetch(offset, length):
+            try:
+                session = TransferSession(*self.address, codecs=self.codecs, progress=self.progress, mux=self.mux,
+                                          timeout=self.timeout)
+                try:
+                    session.download_range(filename, partial_path, offset, length, size)
+                finally:
+                    session.close()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch, args=r, daemon=True) for r in ranges]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if not errors and stat.get("sha256") and file_sha256(partial_path) != stat["sha256"]:
+            # The ranges agree on the size but came from different versions of the file
+            errors.append(TransferError(f"{filename} changed on the server during the download"))
+        if errors:
+            # A file with holes in it must never be mistaken for a complete one
+            os.remove(partial_path)
+            return Result(filename, str(errors[0]))
+        # Every range has arrived, put the file in place
+        os.replace(partial_path, local_path(dest_dir, filename))
+        manifest.record(filename, stat.get("sha256"))
+        return Result(filename, None)
+
+    def _receive_body(self, f, reply, buf, name=None, total=None):
+        """Receive the body of reply and write it to f at its current position.
+
+        Progress is reported as part of name, a file of total bytes.
+        """
+        size = reply.body_length
+        codec = frame_codec(reply.flags, self.codecs)
+        if codec:
+            decoder = Decoder(codec, size)
+            while True:
+                length = block_length(recv_exactly(self.sock, BLOCK.size))
+                if not length:
+                    break
+                data = decoder.decode(recv_exactly(self.sock, length))
+                f.write(data)
+                self._report(name, len(data), total)
+            decoder.finish()
+            return
+        self._receive_raw(f, size, buf, name, total)
+
+    def _receive_raw(self, f, size, buf, name=None, total=None):
+        """Receive size bytes that aren't compressed and write them to f at its current position."""
+        view = memoryview(buf)
+        remaining = size
+        while remaining:
+            n = self.sock.recv_into(view, min(remaining, len(view)))
+            if not n:
+                raise ConnectionError(f"Connection closed after {size - remaining} of {size} bytes")
+            f.write(view[:n])
+            remaining -= n
+            self._report(name, n, total)
@@ -0,0 +1,246 @@
+import contextlib  # Import contextlib to lend out pooled connections with a with statement
+import threading  # Import threading to run the queued downloads in parallel
+
+from common.compression import SUPPORTED_CODECS
+from common.framing import ProtocolError
+from common.paths import clean_path
+
+from .mux import TIMEOUT, MuxConnection
+from .session import PARALLEL_THRESHOLD, Result, TransferSession
+
+DOWNLOAD_CONCURRENCY = 4  # Downloads running at once unless configured otherwise
+
+# States of a queued download
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class ConnectionPool:
+    """Connections to the server lent out to one transfer at a time.
+
+    At most size connections are open at once; a borrower waits for one to be
+    returned when they are all in use. Connections that break are closed and
+    replaced by a new one the next time one is needed.
+
+    Given a MuxConnection, the pool lends out streams of it instead of
+    connections, and opens a new one should it be lost.
+    """
+
+    def __init__(self, host, port, size=DOWNLOAD_CONCURRENCY, codecs=SUPPORTED_CODECS, progress=None, mux=None,
+                 timeout=TIMEOUT):
+        self.address = (host, port)
+        self.size = size
+        self.codecs = codecs
+        # Seconds a connection may wait on the server before it counts as lost, None for ever
+        self.timeout = timeout
+        # Progress callback of every connection, see TransferSession
+        self.progress = progress
+        # Multiplexed connection the streams are opened on, None for connections of their own
+        self.mux = mux
+        # Open connections nobody is using, and the number open in total
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._changed = threading.Condition()
+
+    def acquire(self):
+        """Return a connection, opening one if the pool is not full, waiting if it is."""
+        with self._changed:
+            while not self._closed and not self._idle and self._open >= self.size:
+                self._changed.wait()
+            if self._closed:
+                raise ConnectionError("The connection pool is closed")
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+        try:
+            if self.mux is None:
+                return TransferSession(*self.address, codecs=self.codecs, progress=self.progress, timeout=self.timeout)
+            if self.mux.closed:
+                self.mux = MuxConnection(*self.address, codecs=self.codecs, timeout=self.timeout)
+            return TransferSession(codecs=self.codecs, progress=self.progress, mux=self.mux)
+        except BaseException:
+            self._discard()
+            raise
+
+    def release(self, session, broken=False):
+        """Return a connection from acquire(); a broken one is closed instead of reused."""
+        with self._changed:
+            if not broken and not self._closed and self._open <= self.size:
+                self._idle.append(session)
+                self._changed.notify()
+                return
+        session.close()
+        self._discard()
+
+    def _discard(self):
+        with self._changed:
+            self._open -= 1
+            self._changed.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block."""
+        session = self.acquire()
+        try:
+            yield session
+        except (OSError, ProtocolError):
+            # The stream may be left mid-frame, never hand it out again
+            self.release(session, broken=True)
+            raise
+        except BaseException:
+            self.release(session)
+            raise
+        self.release(session)
+
+    def resize(self, size):
+        """Allow size connections; extra ones close as they are returned."""
+        with self._changed:
+            self.size = max(1, size)
+            self._changed.notify_all()
+
+    def close(self):
+        """Close the idle connections, and the others as they are returned."""
+        with self._changed:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._changed.notify_all()
+        for session in idle:
+            session.close()
+
+
+class Download:
+    """One file in a DownloadQueue."""
+
+    def __init__(self, name, dest_dir, group):
+        self.name = name
+        self.dest_dir = dest_dir
+        self.state = QUEUED
+        # Result of the download once it has finished
+        self.result = None
+        # Downloads added together, reported together when the last one finishes
+        self._group = group
+
+    def __repr__(self):
+        return f"<Download {self.name} {self.state}>"
+
+
+class DownloadQueue:
+    """Queue of downloads served by a ConnectionPool, concurrency of them at a time.
+
+    Every running download has a connection of its own, so several files arrive
+    in parallel instead of one after another. Downloads that have not started
+    can be moved forward or back in the queue, or cancelled. Files of at least
+    PARALLEL_THRESHOLD bytes are fetched as byte ranges over extra connections.
+    """
+
+    def __init__(self, pool, dest_dir, concurrency=DOWNLOAD_CONCURRENCY):
+        self.pool = pool
+        self.dest_dir = dest_dir
+        self.concurrency = max(1, concurrency)
+        # Downloads waiting to start, the first one starts next
+        self.pending = []
+        self._running = 0
+        self._workers = 0
+        self._changed = threading.Condition()
+        self.pool.resize(max(self.pool.size, self.concurrency))
+
+    def add(self, names, dest_dir=None, on_finish=None):
+        """Queue names for download and return their Download objects.
+
+        on_finish, if given, is called from a worker thread with the Result of
+        every file in names once the last of them has finished.
+        """
+        group = {"downloads": [], "remaining": len(names), "on_finish": on_finish}
+        downloads = [Download(clean_path(name), dest_dir or self.dest_dir, group) for name in names]
+        group["downloads"] = downloads
+        with self._changed:
+            self.pending.extend(downloads)
+            self._start_workers()
+        if not downloads and on_finish:
+            on_finish([])
+        return downloads
+
+    def move(self, download, index):
+        """Move a download that has not started to position index of the queue; False if it already started."""
+        with self._changed:
+            if download not in self.pending:
+                return False
+            self.pending.remove(download)
+            self.pending.insert(index, download)
+            return True
+
+    def move_to_front(self, download):
+        """Make download the next one to start."""
+        return self.move(download, 0)
+
+    def move_to_back(self, download):
+        """Make download the last one to start."""
+        return self.move(download, len(self.pending))
+
+    def cancel(self, download):
+        """Take a download that has not started off the queue; False if it already started."""
+        with self._changed:
+            if download not in self.pending:
+                return False
+            self.pending.remove(download)
+        self._finish(download, CANCELLED, Result(download.name, "Cancelled"))
+        return True
+
+    def set_concurrency(self, concurrency):
+        """Run up to concurrency downloads at once from now on."""
+        with self._changed:
+            self.concurrency = max(1, concurrency)
+            self.pool.resize(max(self.pool.size, self.concurrency))
+            self._start_workers()
+
+    def wait(self, timeout=None):
+        """Wait until the queue is empty and nothing is running; returns False on timeout."""
+        with self._changed:
+            return self._changed.wait_for(lambda: not self.pending and not self._running, timeout)
+
+    def _start_workers(self):
+        # Called with the lock held
+        while self._workers < min(self.concurrency, len(self.pending)):
+            self._workers += 1
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            with self._changed:
+                # Workers over a lowered limit stop as soon as their download is done
+                if not self.pending or self._workers > self.concurrency:
+                    self._workers -= 1
+                    self._changed.notify_all()
+                    return
+                download = self.pending.pop(0)
+                download.state = RUNNING
+                self._running += 1
+            result = self._download(download)
+            with self._changed:
+                self._running -= 1
+            self._finish(download, FAILED if result.error else DONE, result)
+
+    def _download(self, download):
+        """Fetch one file over a pooled connection and return its Result."""
+        try:
+            with self.pool.connection() as session:
+                stat = session.stat_batch([download.name])[0]
+                if stat.get("size") is None:
+                    return Result(download.name, stat.get("error", "File not found"))
+                if stat["size"] >= PARALLEL_THRESHOLD:
+                    return session.download_parallel(download.name, download.dest_dir)
+                return session.download_batch([download.name], download.dest_dir)[0]
+        except (OSError, ProtocolError) as e:
+            return Result(download.name, str(e))
+
+    def _finish(self, download, state, result):
+        download.state = state
+        download.result = result
+        group = download._group
+        with self._changed:
+            group["remaining"] -= 1
+            done = not group["remaining"]
+            self._changed.notify_all()
+        if done and group["on_finish"]:
+            group["on_finish"]([item.result for item in group["downloads"]])
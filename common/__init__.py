@@ -0,0 +1 @@
+"""Code shared by the file server and the file client."""
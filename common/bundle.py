@@ -0,0 +1,89 @@
+"""Streaming tar archives carried by the BUNDLE_UPLOAD and BUNDLE_DOWNLOAD operations.
+
+A bundle moves many files in one frame whose body is a POSIX tar archive, built
+and unpacked while it streams, so nothing is staged in memory or on disk. Every
+member is a header, the file contents and padding up to the next TAR_BLOCK
+boundary; the archive ends with END_OF_ARCHIVE. The sender builds each header
+from the file's size before sending anything, which makes the length of the
+whole body known up front. Names that don't fit a ustar header get a pax
+extended header of their own.
+"""
+
+import tarfile  # Import tarfile to build and parse tar headers
+from collections import namedtuple  # Import namedtuple to hold decoded members
+
+from .framing import ProtocolError
+
+TAR_BLOCK = tarfile.BLOCKSIZE  # Tar headers and member data are laid out in blocks of this size
+END_OF_ARCHIVE = bytes(2 * TAR_BLOCK)  # Two empty blocks close an archive
+INLINE_SIZE = 1024 * 1024  # Members up to this size are read and written whole instead of streamed
+FILE, EXTENDED, OTHER = "file", "extended", "other"  # Kinds of member
+
+# A decoded member header; its size bytes of data and their padding follow it
+Member = namedtuple("Member", ["name", "size", "mtime", "kind"])
+
+
+def encode_member(name, size, mtime=0):
+    """Return the header of a regular file member."""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def padding(size):
+    """Return the padding that follows size bytes of member data."""
+    return bytes(-size % TAR_BLOCK)
+
+
+def member_length(header, size):
+    """Return how many bytes of the archive a member with this header and size bytes of data takes."""
+    return len(header) + size + -size % TAR_BLOCK
+
+
+def decode_member(block, extended=None):
+    """Return the Member the header block describes, None for the empty block that ends the archive.
+
+    extended holds the records of the pax header that came before this one, if any.
+    The data of an EXTENDED member is decoded with decode_pax().
+    """
+    if not any(block):
+        return None
+    try:
+        info = tarfile.TarInfo.frombuf(block, "utf-8", "surrogateescape")
+    except tarfile.HeaderError as e:
+        raise ProtocolError(f"Corrupt bundle header: {e}") from None
+    if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE):
+        return Member(None, info.size, 0, EXTENDED)
+    extended = extended or {}
+    try:
+        size = int(extended.get("size", info.size))
+        mtime = float(extended.get("mtime", info.mtime))
+    except ValueError:
+        raise ProtocolError("Corrupt bundle header: invalid pax record") from None
+    if size < 0:
+        raise ProtocolError("Corrupt bundle header: negative size")
+    kind = FILE if info.type in tarfile.REGULAR_TYPES else OTHER
+    return Member(extended.get("path", info.name), size, mtime, kind)
+
+
+def decode_pax(data):
+    """Return the records of a pax extended header, given its data without the padding."""
+    records = {}
+    position = 0
+    try:
+        while position < len(data) and data[position]:
+            # Each record is "<length> <key>=<value>\n", the length counting the whole record
+            space = data.index(b" ", position)
+            length = int(data[position:space])
+            if length <= space - position:
+                raise ValueError
+            key, equals, value = data[space + 1:position + length - 1].partition(b"=")
+            if not equals:
+                raise ValueError
+            records[key.decode("utf-8")] = value.decode("utf-8", "surrogateescape")
+            position += length
+    except ValueError:
+        raise ProtocolError("Corrupt bundle header: invalid pax record") from None
+    return records
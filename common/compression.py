@@ -0,0 +1,136 @@
+"""Streaming compression of frame bodies.
+
+Both sides announce the codecs they support during the handshake. A frame whose
+flags carry a codec bit has a compressed body: a sequence of blocks, each a BLOCK
+length followed by that many bytes of compressed data, ending with an empty
+block. Its body_length is still the size of the decoded data.
+"""
+
+import enum  # Import enum to name the codecs
+import lzma  # Import lzma for the slow, strong codec
+import os  # Import os module to look at file name suffixes
+import struct  # Import struct to pack the block lengths
+import zlib  # Import zlib for the fast codec
+
+from .framing import ProtocolError
+
+BLOCK = struct.Struct("!I")  # Length prefix of each compressed block
+COMPRESS_CHUNK_SIZE = 256 * 1024  # Bytes of file data compressed into one block
+MAX_BLOCK_SIZE = 16 * 1024 * 1024  # Refuse compressed blocks larger than this
+ZLIB_LEVEL = 1  # zlib level; higher levels cost far more time than they save on the wire
+LZMA_PRESET = 0  # lzma preset; 0 already compresses text about as well as 6, several times faster
+MIN_COMPRESS_SIZE = 4096  # Smaller files aren't worth compressing
+SAMPLE_SIZE = 64 * 1024  # Bytes read from each sampled spot of a file
+SAMPLE_RATIO = 0.9  # Compress only if the samples shrink below this fraction
+# Formats that are compressed already; sampling them would only confirm it
+COMPRESSED_SUFFIXES = frozenset((
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".avi", ".mov",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst",
+    ".xlsx", ".docx", ".pptx", ".odt", ".ods", ".jar", ".apk", ".pdf",
+))
+
+
+class Codec(enum.IntFlag):
+    """Compression codec; the values double as frame flags and handshake bits."""
+
+    ZLIB = 1
+    LZMA = 2
+
+
+SUPPORTED_CODECS = Codec.ZLIB | Codec.LZMA  # Every codec this code can encode and decode
+CODEC_MASK = int(SUPPORTED_CODECS)  # Frame flag bits that select a codec
+
+
+def choose_codec(codecs):
+    """Return the codec to compress with out of the agreed codecs, 0 if there is none."""
+    # zlib keeps up with the network, lzma is used only when it is the sole choice
+    for codec in (Codec.ZLIB, Codec.LZMA):
+        if codecs & codec:
+            return codec
+    return 0
+
+
+def frame_codec(flags, codecs):
+    """Return the codec a received frame's flags select, checking it was agreed on."""
+    codec = flags & CODEC_MASK
+    if codec and (codec not in (Codec.ZLIB, Codec.LZMA) or not codecs & codec):
+        raise ProtocolError(f"Frame uses a codec that was not negotiated ({codec})")
+    return Codec(codec) if codec else 0
+
+
+def compressible(f, size, name=""):
+    """Guess whether the file f of size bytes is worth compressing.
+
+    Known compressed formats are skipped by name; anything else is sampled at the
+    start, middle and end and compressed only if the samples shrink.
+    """
+    if size < MIN_COMPRESS_SIZE or os.path.splitext(name)[1].lower() in COMPRESSED_SUFFIXES:
+        return False
+    position = f.tell()
+    try:
+        sample = bytearray()
+        for offset in {0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}:
+            f.seek(offset)
+            sample += f.read(SAMPLE_SIZE)
+    finally:
+        f.seek(position)
+    return len(zlib.compress(sample, 1)) < len(sample) * SAMPLE_RATIO
+
+
+class Encoder:
+    """Compress a body chunk by chunk into blocks."""
+
+    def __init__(self, codec):
+        if codec == Codec.ZLIB:
+            self._compressor = zlib.compressobj(ZLIB_LEVEL)
+        else:
+            self._compressor = lzma.LZMACompressor(preset=LZMA_PRESET)
+
+    def encode(self, data):
+        """Return the blocks for the next chunk of data, possibly none yet."""
+        return self._block(self._compressor.compress(data))
+
+    def finish(self):
+        """Return the remaining compressed data followed by the empty end block."""
+        return self._block(self._compressor.flush()) + BLOCK.pack(0)
+
+    @staticmethod
+    def _block(data):
+        return BLOCK.pack(len(data)) + data if data else b""
+
+
+class Decoder:
+    """Decompress the blocks of a body that decodes to exactly size bytes."""
+
+    def __init__(self, codec, size):
+        if codec == Codec.ZLIB:
+            self._decompressor = zlib.decompressobj()
+        else:
+            self._decompressor = lzma.LZMADecompressor()
+        # Decoded bytes still expected
+        self.remaining = size
+
+    def decode(self, block):
+        """Return the data decoded from one block."""
+        try:
+            # Never decode more than the body may hold, so a hostile block can't exhaust memory
+            data = self._decompressor.decompress(block, self.remaining + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ProtocolError(f"Corrupt compressed body: {e}") from None
+        if len(data) > self.remaining:
+            raise ProtocolError("Compressed body is longer than announced")
+        self.remaining -= len(data)
+        return data
+
+    def finish(self):
+        """Check that the whole body has been decoded."""
+        if self.remaining:
+            raise ProtocolError(f"Compressed body ended {self.remaining} bytes short")
+
+
+def block_length(header):
+    """Return the length of the block whose BLOCK prefix is header."""
+    (length,) = BLOCK.unpack(header)
+    if length > MAX_BLOCK_SIZE:
+        raise ProtocolError(f"Compressed block too large ({length} bytes)")
+    return length
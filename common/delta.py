@@ -0,0 +1,147 @@
+"""Delta uploads of files the server holds an older copy of, after rsync.
+
+The server splits its copy into blocks and sends a SIGNATURE for each: a weak
+rolling checksum and a strong hash. The client slides a window over its own
+file, recognises blocks the server has already and sends instructions instead
+of the whole file: COPY a run of the server's blocks, or LITERAL bytes that
+follow the instruction.
+"""
+
+import hashlib  # Import hashlib for the strong block hashes
+import math  # Import math to size blocks by the square root of the file size
+import struct  # Import struct to pack signatures and instructions
+import zlib  # Import zlib for the adler32 weak checksum
+
+SIGNATURE = struct.Struct("!I16s")  # weak checksum and strong hash of one block
+# kind, then first block and block count for COPY, or 0 and the data length for LITERAL
+INSTRUCTION = struct.Struct("!BII")
+COPY = 1  # Instruction kind: repeat blocks of the server's copy
+LITERAL = 2  # Instruction kind: the data follows the instruction
+MIN_BLOCK_SIZE = 2048  # Smallest block a file is split into
+MAX_BLOCK_SIZE = 128 * 1024  # Largest block a file is split into
+MAX_LITERAL_SIZE = 1024 * 1024  # Longer literal runs are split into several instructions
+ADLER_MOD = 65521  # Modulus of the adler32 checksum
+
+
+def block_size_for(size):
+    """Return the block size used for the signatures of a file of size bytes."""
+    # sqrt(size) keeps the signature list and the per-block overhead both small
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, -(-math.isqrt(size) // 1024) * 1024))
+
+
+def strong_hash(data):
+    """Return the strong hash of one block."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signatures(f, block_size):
+    """Return the packed signatures of every block of f and the SHA-256 of the whole file."""
+    digest = hashlib.sha256()
+    packed = bytearray()
+    for block in iter(lambda: f.read(block_size), b""):
+        digest.update(block)
+        packed += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(packed), digest.hexdigest()
+
+
+def parse_signatures(data):
+    """Return the (weak, strong) pairs of packed signatures."""
+    if len(data) % SIGNATURE.size:
+        raise ValueError("Signature list has a truncated entry")
+    return list(SIGNATURE.iter_unpack(data))
+
+
+def compute_delta(data, base_size, block_size, sigs, max_literal=None):
+    """Return the instructions that rebuild data from the server's copy.
+
+    data is a bytes-like view of the new file, base_size the size of the server's
+    copy and sigs its parsed signatures. Instructions are (COPY, first, count) and
+    (LITERAL, offset, length) tuples, offset being a position in data. Returns
+    None as soon as more than max_literal bytes would have to be sent as literals,
+    so a file that has little in common with the server's copy is not scanned
+    byte by byte to the end.
+    """
+    blocks = {}
+    for index, (weak, _) in enumerate(sigs):
+        blocks.setdefault(weak, []).append(index)
+    size = len(data)
+    instructions = []
+
+    def match(position, weak, length):
+        strong = strong_hash(data[position:position + length])
+        for index in blocks.get(weak, ()):
+            if sigs[index][1] == strong and block_length(index) == length:
+                return index
+        return None
+
+    def block_length(index):
+        return min(block_size, base_size - index * block_size)
+
+    def emit_copy(index):
+        if instructions and instructions[-1][0] == COPY and sum(instructions[-1][1:]) == index:
+            # Extend the run of consecutive blocks
+            instructions[-1] = (COPY, instructions[-1][1], instructions[-1][2] + 1)
+        else:
+            instructions.append((COPY, index, 1))
+
+    def emit_literal(start, stop):
+        nonlocal literal
+        literal += stop - start
+        for offset in range(start, stop, MAX_LITERAL_SIZE):
+            instructions.append((LITERAL, offset, min(MAX_LITERAL_SIZE, stop - offset)))
+
+    # Literal bytes emitted so far
+    literal = 0
+    literal_start = position = 0
+    weak = None
+    # Last position a whole block fits at
+    last = size - block_size
+    while position <= last:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+        index = match(position, weak, block_size) if weak in blocks else None
+        if index is not None:
+            emit_literal(literal_start, position)
+            emit_copy(index)
+            position += block_size
+            literal_start = position
+            weak = None
+            continue
+        # Slide the window a byte at a time, updating the checksum instead of recomputing it,
+        # up to the next position whose weak checksum is one of the server's blocks
+        stop = last
+        if max_literal is not None:
+            stop = min(stop, literal_start + max_literal - literal)
+        a, b = weak & 0xffff, weak >> 16
+        while position < stop:
+            out, new = data[position], data[position + block_size]
+            a = (a - out + new) % ADLER_MOD
+            b = (b - block_size * out + a - 1) % ADLER_MOD
+            position += 1
+            weak = b << 16 | a
+            if weak in blocks:
+                break
+        else:
+            if max_literal is not None and literal + position - literal_start >= max_literal:
+                return None
+            # No block starts anywhere before the end, the rest is literal
+            break
+
+    # The server's last block is usually shorter than the rest
+    tail = base_size % block_size
+    if sigs and tail and size - tail >= literal_start:
+        index = match(size - tail, zlib.adler32(data[size - tail:]), tail)
+        if index is not None:
+            emit_literal(literal_start, size - tail)
+            emit_copy(index)
+            literal_start = size
+    emit_literal(literal_start, size)
+    if max_literal is not None and literal > max_literal:
+        return None
+    return instructions
+
+
+def delta_length(instructions):
+    """Return the number of bytes the instructions take on the wire."""
+    return sum(INSTRUCTION.size + (length if kind == LITERAL else 0) for kind, _, length in instructions)
+
@@ -0,0 +1,207 @@
+"""Length-prefixed binary framing used between the file client and server.
+
+A framed connection starts with a negotiation step: the client sends MAGIC
+followed by the highest protocol version it speaks, and the server answers
+with MAGIC and the version both sides will use. Legacy clients send plain
+text commands instead, which never start with MAGIC. From version 2 on, the
+server follows its answer with a CODECS bit mask of the compression codecs
+it supports and the client replies with the mask of those it will use. A
+server that is too busy answers with the BUSY version followed by a RETRY
+delay in seconds and closes the connection.
+
+Every message after that is a frame: a fixed HEADER, a JSON metadata object
+of meta_length bytes, then body_length bytes of raw body (file contents).
+The body of a BUNDLE_UPLOAD request or BUNDLE_DOWNLOAD reply is a tar archive
+of many files, see common.bundle; servers that predate them answer ERROR.
+File names are paths from the root of the store separated by "/", e.g.
+"reports/june.xlsx", see common.paths; MKDIR creates a folder and a LIST_FILES
+request naming a "folder" lists what is directly in it.
+
+From MUX_VERSION on the connection carries many independent streams instead.
+Each stream is a byte stream of frames exactly like a whole connection of an
+earlier version, cut into chunks that travel as mux frames: a MUX_HEADER with
+the stream id, the Mux kind and the payload length, then the payload. The
+client opens a stream by sending its first DATA, which may be empty, under an
+id higher than any before. A side may only send as many DATA bytes on a stream
+as the other side allowed, starting with STREAM_WINDOW and raised by WINDOW
+frames as the data is consumed, so a stream nobody reads never holds up the
+others. END closes one direction of a stream and RESET abandons it.
+"""
+
+import enum  # Import enum to name the frame operations
+import json  # Import json to encode the frame metadata
+import struct  # Import struct to pack the fixed frame header
+from collections import namedtuple  # Import namedtuple to hold decoded frames
+
+MAGIC = b"\x00FTP"  # Preamble that selects the framed protocol
+PROTOCOL_VERSION = 4  # Highest protocol version this code speaks
+COMPRESSION_VERSION = 2  # First protocol version that negotiates compression codecs
+DELTA_VERSION = 3  # First protocol version with the SIGNATURE and DELTA operations
+MUX_VERSION = 4  # First protocol version that multiplexes streams over the connection
+SINGLE_STREAM_VERSION = 3  # Highest version of a connection that carries a single stream
+FRAME_VERSION = 1  # Version of the frame header layout
+VERSION = struct.Struct("!B")  # Version byte sent after MAGIC
+CODECS = struct.Struct("!B")  # Bit mask of compression codecs exchanged after the handshake
+BUSY = 255  # Version answered by a server that is turning the connection away
+RETRY = struct.Struct("!H")  # Seconds to wait before retrying, sent after BUSY
+HANDSHAKE_SIZE = len(MAGIC) + VERSION.size  # Size of the negotiation message
+# version, op, flags, metadata length, body length
+HEADER = struct.Struct("!BBHIQ")
+MAX_META_SIZE = 16 * 1024 * 1024  # Refuse metadata larger than this
+# stream id, kind, payload length
+MUX_HEADER = struct.Struct("!IBI")
+MUX_CHUNK = 128 * 1024  # Largest DATA payload, so other streams get a turn between chunks
+STREAM_WINDOW = 4 * 1024 * 1024  # DATA bytes a side may send on a stream before the other side allows more
+WINDOW = struct.Struct("!I")  # Payload of a WINDOW frame: bytes the sender may send in addition
+
+
+class Op(enum.IntEnum):
+    """Operation carried by a frame."""
+
+    UPLOAD = 1
+    LIST_FILES = 2
+    DOWNLOAD = 3
+    STAT = 4
+    DELETE = 5
+    HAVE = 6
+    SIGNATURE = 7
+    DELTA = 8
+    BUNDLE_UPLOAD = 9
+    BUNDLE_DOWNLOAD = 10
+    MKDIR = 11
+    OK = 64
+    ERROR = 65
+
+
+class Mux(enum.IntEnum):
+    """Kind of a mux frame."""
+
+    DATA = 0
+    END = 1
+    WINDOW = 2
+    RESET = 3
+
+
+# A decoded frame header; the body still has to be read from the connection
+Frame = namedtuple("Frame", ["op", "flags", "meta", "body_length"])
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends something that is not a valid frame."""
+
+
+class ServerBusyError(ProtocolError):
+    """Raised when the server turns a connection away because it is overloaded."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy, retry after {retry_after} seconds")
+        # Seconds the server asked us to wait before connecting again
+        self.retry_after = retry_after
+
+
+def encode_handshake(version=PROTOCOL_VERSION):
+    """Return the negotiation message announcing version."""
+    return MAGIC + VERSION.pack(version)
+
+
+def encode_busy(retry_after):
+    """Return the negotiation answer turning a client away for retry_after seconds."""
+    return MAGIC + VERSION.pack(BUSY) + RETRY.pack(min(retry_after, 0xFFFF))
+
+
+def decode_handshake(data):
+    """Return the version announced by a negotiation message."""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ProtocolError("Peer does not speak the framed protocol")
+    return VERSION.unpack_from(data, len(MAGIC))[0]
+
+
+def encode_frame(op, meta=None, body_length=0, flags=0, version=FRAME_VERSION):
+    """Return the header and metadata of a frame; the body is sent separately."""
+    meta_bytes = json.dumps(meta or {}, separators=(",", ":")).encode()
+    return HEADER.pack(version, op, flags, len(meta_bytes), body_length) + meta_bytes
+
+
+def decode_header(data):
+    """Return (op, flags, meta_length, body_length) from a packed header."""
+    version, op, flags, meta_length, body_length = HEADER.unpack(data)
+    if version != FRAME_VERSION:
+        raise ProtocolError(f"Unsupported frame version {version}")
+    if meta_length > MAX_META_SIZE:
+        raise ProtocolError(f"Frame metadata too large ({meta_length} bytes)")
+    try:
+        op = Op(op)
+    except ValueError:
+        raise ProtocolError(f"Unknown frame operation {op}") from None
+    return op, flags, meta_length, body_length
+
+
+def encode_mux(stream_id, kind, length=0):
+    """Return the header of a mux frame; the payload is sent separately."""
+    return MUX_HEADER.pack(stream_id, kind, length)
+
+
+def decode_mux(data):
+    """Return (stream_id, kind, length) from a packed mux frame header."""
+    stream_id, kind, length = MUX_HEADER.unpack(data)
+    try:
+        kind = Mux(kind)
+    except ValueError:
+        raise ProtocolError(f"Unknown mux frame kind {kind}") from None
+    if length > max(MUX_CHUNK, WINDOW.size):
+        raise ProtocolError(f"Mux frame too large ({length} bytes)")
+    return stream_id, kind, length
+
+
+def decode_meta(data):
+    """Return the metadata dictionary of a frame."""
+    try:
+        meta = json.loads(data) if data else {}
+    except ValueError:
+        raise ProtocolError("Frame metadata is not valid JSON") from None
+    if not isinstance(meta, dict):
+        raise ProtocolError("Frame metadata must be a JSON object")
+    return meta
+
+
+def recv_exactly(sock, size):
+    """Receive exactly size bytes from a blocking socket."""
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def negotiate(sock, version=PROTOCOL_VERSION, codecs=0):
+    """Negotiate the framed protocol on a freshly connected blocking socket.
+
+    codecs is the bit mask of compression codecs the client is willing to use.
+    Returns (version, codecs) with the agreed version and codec mask.
+    """
+    sock.sendall(encode_handshake(version))
+    agreed = decode_handshake(recv_exactly(sock, HANDSHAKE_SIZE))
+    if agreed == BUSY:
+        raise ServerBusyError(RETRY.unpack(recv_exactly(sock, RETRY.size))[0])
+    if agreed == 0:
+        raise ProtocolError("Server rejected every offered protocol version")
+    if agreed < COMPRESSION_VERSION:
+        return agreed, 0
+    # Use the codecs both sides support
+    codecs &= CODECS.unpack(recv_exactly(sock, CODECS.size))[0]
+    sock.sendall(CODECS.pack(codecs))
+    return agreed, codecs
+
+
+def send_frame(sock, op, meta=None, body=b"", flags=0):
+    """Send a whole frame over a blocking socket."""
+    sock.sendall(encode_frame(op, meta, len(body), flags) + body)
+
+
+def recv_frame(sock):
+    """Receive a frame header and metadata from a blocking socket."""
+    op, flags, meta_length, body_length = decode_header(recv_exactly(sock, HEADER.size))
+    meta = decode_meta(recv_exactly(sock, meta_length))
+    return Frame(op, flags, meta, body_length)
@@ -0,0 +1,118 @@
+import collections  # Import collections for the recent progress samples
+import queue  # Import queue to pass events from worker threads to the Tk thread
+import time  # Import time to measure transfer rates
+import tkinter as tk  # Import tkinter for the progress widgets
+from tkinter import ttk  # Import ttk for the progress bars
+
+PUMP_INTERVAL_MS = 50  # How often the Tk thread runs the events posted by other threads
+RATE_WINDOW = 3.0  # Seconds of progress the displayed transfer rate is averaged over
+
+
+def format_bytes(count):
+    """Format a byte count with a binary unit."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024 or unit == "GiB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+
+
+def format_eta(seconds):
+    """Format a number of seconds as h:mm:ss or m:ss."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class EventBridge:
+    """Run callables posted from any thread on the Tk thread.
+
+    Tk widgets may only be touched from the thread running the main loop.
+    Network threads post() what they want done and the Tk thread runs it on
+    its next pump, every PUMP_INTERVAL_MS milliseconds via after().
+    """
+
+    def __init__(self, root, interval=PUMP_INTERVAL_MS):
+        self.root = root
+        self.interval = interval
+        self.events = queue.SimpleQueue()
+        self.root.after(self.interval, self.pump)
+
+    def post(self, func, *args):
+        """Ask the Tk thread to call func(*args); safe from any thread."""
+        self.events.put((func, args))
+
+    def pump(self):
+        """Run every posted event, then schedule the next pump."""
+        try:
+            while True:
+                func, args = self.events.get_nowait()
+                func(*args)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(self.interval, self.pump)
+
+
+class TransferPanel:
+    """One progress bar per running transfer, labelled with bytes, rate and ETA.
+
+    Only call it from the Tk thread; network threads go through an EventBridge.
+    """
+
+    def __init__(self, parent, text="Transfers"):
+        self.frame = tk.LabelFrame(parent, text=text)
+        # Widgets and progress of each transfer, by key
+        self.rows = {}
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def advance(self, key, name, count, total):
+        """Add count bytes to the progress of transfer key, a total-byte transfer of name."""
+        row = self._row(key, name)
+        self.update(key, name, row["done"] + count, total)
+
+    def update(self, key, name, done, total, rate=None):
+        """Show done of total bytes of transfer key; the rate is measured unless given."""
+        row = self._row(key, name)
+        now = time.monotonic()
+        row["done"] = done
+        samples = row["samples"]
+        samples.append((now, done))
+        # Keep just enough samples to cover the rate window
+        while len(samples) > 2 and now - samples[1][0] >= RATE_WINDOW:
+            samples.popleft()
+        if rate is None:
+            elapsed = now - samples[0][0]
+            rate = (done - samples[0][1]) / elapsed if elapsed > 0 else 0.0
+        text = f"{name}  {format_bytes(done)}"
+        if total:
+            text += f" of {format_bytes(total)}"
+            row["bar"].config(value=min(100.0, done * 100.0 / total))
+        if rate > 0:
+            text += f"  {format_bytes(rate)}/s"
+            if total and done < total:
+                text += f"  ETA {format_eta((total - done) / rate)}"
+        row["label"].config(text=text)
+
+    def remove(self, key):
+        """Take the row of transfer key off the panel."""
+        row = self.rows.pop(key, None)
+        if row:
+            row["frame"].destroy()
+
+    def keys(self):
+        return list(self.rows)
+
+    def _row(self, key, name):
+        row = self.rows.get(key)
+        if row is None:
+            frame = tk.Frame(self.frame)
+            frame.pack(fill=tk.X, padx=5, pady=2)
+            label = tk.Label(frame, text=name, anchor="w")
+            label.pack(fill=tk.X)
+            bar = ttk.Progressbar(frame, maximum=100.0, length=300)
+            bar.pack(fill=tk.X)
+            row = self.rows[key] = {"frame": frame, "label": label, "bar": bar, "done": 0,
+                                    "samples": collections.deque()}
+        return row
@@ -0,0 +1,12 @@
+import hashlib  # Import hashlib for the content hashes
+
+HASH_CHUNK_SIZE = 1024 * 1024  # Bytes read at a time while hashing a file
+
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
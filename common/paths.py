@@ -0,0 +1,46 @@
+"""Names of stored files as they travel between client and server.
+
+A stored file is named by its path from the root of the store, folders
+separated by SEPARATOR whatever the platform, e.g. "reports/2024/june.xlsx".
+The root folder itself is "".
+"""
+
+import os  # Import os to turn stored paths into local ones
+
+SEPARATOR = "/"  # Separates the folders of a stored path
+# Names Windows keeps for devices, whatever the extension, e.g. "con.txt"
+RESERVED_NAMES = {"CON", "PRN", "AUX", "NUL", *(f"COM{i}" for i in range(1, 10)), *(f"LPT{i}" for i in range(1, 10))}
+
+
+def clean_path(name):
+    """Return name as a stored path, raising ValueError if it can't be one.
+
+    Backslashes count as separators and empty or "." parts are dropped, so
+    "reports\\june.xlsx" and "/reports//./june.xlsx" both become "reports/june.xlsx".
+    Drive letters such as "C:" and Windows device names such as "con.txt" are
+    refused, so a stored path never leads outside the directory it is stored in.
+    """
+    if not isinstance(name, str):
+        raise ValueError("File names must be strings")
+    parts = [part for part in name.replace("\\", SEPARATOR).split(SEPARATOR) if part not in ("", ".")]
+    if (not parts or ".." in parts or "\0" in name or ":" in name
+            or any(part.split(".")[0].strip().upper() in RESERVED_NAMES for part in parts)):
+        raise ValueError(f"Invalid file name {name!r}")
+    return SEPARATOR.join(parts)
+
+
+def clean_folder(name):
+    """Return name as a stored folder path, "" for the root folder."""
+    if isinstance(name, str) and all(part in ("", ".") for part in name.replace("\\", SEPARATOR).split(SEPARATOR)):
+        return ""
+    return clean_path(name)
+
+
+def parent(path):
+    """Return the folder a stored path is in, "" for the root folder."""
+    return path.rpartition(SEPARATOR)[0]
+
+
+def local_path(directory, path):
+    """Return where the stored path belongs under a local directory."""
+    return os.path.join(directory, *path.split(SEPARATOR))
@@ -0,0 +1,34 @@
+"""TCP options shared by the client and the server sockets.
+
+Keepalive probes find peers that vanished without closing the connection, a
+machine switched off or a network cable pulled, which otherwise leave a
+connection open for good. TCP_NODELAY sends small frames, replies and mux
+WINDOW updates at once instead of holding them back to fill a packet.
+"""
+
+import socket  # Import socket to set the TCP options
+
+KEEPALIVE_IDLE = 60  # Seconds a connection may be silent before the first keepalive probe
+KEEPALIVE_INTERVAL = 10  # Seconds between two unanswered keepalive probes
+KEEPALIVE_COUNT = 5  # Unanswered probes after which the connection is dropped
+
+
+def configure_socket(sock, nodelay=True, keepalive=KEEPALIVE_IDLE):
+    """Set TCP_NODELAY and keepalive on a connected socket; keepalive=0 turns probes off.
+
+    Options the platform lacks are left at its defaults.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(nodelay)))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(bool(keepalive)))
+        if not keepalive:
+            return
+        # Linux and Windows call the idle time TCP_KEEPIDLE, macOS TCP_KEEPALIVE
+        idle = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+        for option, value in ((idle, keepalive), (getattr(socket, "TCP_KEEPINTVL", None), KEEPALIVE_INTERVAL),
+                              (getattr(socket, "TCP_KEEPCNT", None), KEEPALIVE_COUNT)):
+            if option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, int(value))
+    except OSError:
+        # Not a TCP socket, or an option the platform refuses
+        pass
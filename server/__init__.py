@@ -0,0 +1 @@
+"""Headless file server engine and its Tk front end."""
@@ -0,0 +1,111 @@
+import argparse  # Import argparse to read the command line options
+import functools  # Import functools to hand the worker processes a server factory
+import logging  # Import logging to print server activity to the terminal
+
+from common.compression import SUPPORTED_CODECS
+from common.sockets import KEEPALIVE_IDLE
+
+from .admission import MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP, QUEUE_TIMEOUT, WORKERS, AdmissionControl
+from .cache import CACHE_SIZE
+from .engine import (DEFAULT_SERVER_HOST, DEFAULT_SERVER_PORT, FILES_DIR, IDLE_TIMEOUT, LISTEN_BACKLOG, READ_TIMEOUT,
+                     WRITE_TIMEOUT, FileServer)
+from .storage import PARTIAL_MAX_AGE
+from .shaping import Shaper
+from .supervisor import DRAIN_TIMEOUT, Supervisor
+from .writer import DEFAULT_CHUNK_SIZE
+
+
+def parse_bytes(text):
+    """Parse a byte count or a rate in bytes per second, with an optional K, M or G suffix."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper()
+    try:
+        if text[-1:] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {text!r}") from None
+
+
+def server_factory(args, processes=1):
+    """Return a picklable callable building the FileServer described by the command line options.
+
+    With several processes the server-wide connection limit and rate are split
+    evenly between them; every other limit applies to each process.
+    """
+    return functools.partial(
+        FileServer, args.host, args.port, args.files_dir, chunk_size=args.chunk_size,
+        codecs=0 if args.no_compression else SUPPORTED_CODECS, backlog=args.backlog,
+        admission=AdmissionControl(max(1, args.max_connections // processes), args.max_per_ip, args.workers,
+                                   args.queue_timeout),
+        shaper=Shaper(args.rate and max(1, args.rate // processes), args.rate_per_ip, args.rate_per_client),
+        metrics_port=None if processes > 1 else args.metrics_port, cache_size=args.cache_size,
+        read_timeout=args.read_timeout, write_timeout=args.write_timeout, idle_timeout=args.idle_timeout,
+        keepalive=args.keepalive, nodelay=not args.no_nodelay, partial_max_age=args.partial_max_age)
+
+
+def main(argv=None):
+    """Run the file server without a GUI."""
+    parser = argparse.ArgumentParser(prog="python -m server", description="Run the headless file server.")
+    parser.add_argument("--host", default=DEFAULT_SERVER_HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVER_PORT, help="port to listen on")
+    parser.add_argument("--files-dir", default=FILES_DIR, help="directory that holds the served files")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="size in bytes of the buffers uploads are received into")
+    parser.add_argument("--no-compression", action="store_true", help="never compress transfers")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG,
+                        help="connections the kernel queues before they are accepted")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="open connections the server holds before turning clients away")
+    parser.add_argument("--max-per-ip", type=int, default=MAX_CONNECTIONS_PER_IP,
+                        help="open connections a single address may hold")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="requests served at the same time")
+    parser.add_argument("--queue-timeout", type=float, default=QUEUE_TIMEOUT,
+                        help="seconds a request waits for a worker before the client is told to retry")
+    parser.add_argument("--rate", type=parse_bytes, help="bytes per second for the whole server, e.g. 100M")
+    parser.add_argument("--rate-per-ip", type=parse_bytes, help="bytes per second for each client address")
+    parser.add_argument("--rate-per-client", type=parse_bytes, help="bytes per second for each connection")
+    parser.add_argument("--cache-size", type=parse_bytes, default=CACHE_SIZE,
+                        help="memory for the contents of the most downloaded files, e.g. 512M; 0 turns it off")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT,
+                        help="seconds a client may leave the rest of a request unsent before it is dropped; 0 never")
+    parser.add_argument("--write-timeout", type=float, default=WRITE_TIMEOUT,
+                        help="seconds a send may wait for a client to take the data before it is dropped; 0 never")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds an idle connection stays open between requests; 0 for ever")
+    parser.add_argument("--keepalive", type=int, default=KEEPALIVE_IDLE,
+                        help="seconds of silence before TCP keepalive probes look for a vanished client; 0 for none")
+    parser.add_argument("--no-nodelay", action="store_true",
+                        help="let the kernel hold back small replies to fill packets (Nagle's algorithm)")
+    parser.add_argument("--partial-max-age", type=float, default=PARTIAL_MAX_AGE,
+                        help="seconds an abandoned unfinished upload is kept for resuming; 0 for ever")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="server processes sharing the port, 0 for one per CPU core; SIGHUP reloads them")
+    parser.add_argument("--shared-socket", action="store_true",
+                        help="have the processes accept from one socket instead of binding it with SO_REUSEPORT")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="seconds a reloaded process may spend finishing its requests")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.processes != 1:
+        supervisor = Supervisor(None, args.processes, args.host, args.port, args.backlog,
+                                reuse_port=False if args.shared_socket else None, metrics_port=args.metrics_port,
+                                drain_timeout=args.drain_timeout)
+        supervisor.factory = server_factory(args, supervisor.processes)
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            pass
+        return
+    server = server_factory(args)()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import asyncio  # Import asyncio for the worker slots
+import collections  # Import collections to count connections per address
+import contextlib  # Import contextlib to hand out worker slots with async with
+import logging  # Import logging to report turned away clients
+
+MAX_CONNECTIONS = 1024  # Open connections the server holds at once
+MAX_CONNECTIONS_PER_IP = 64  # Open connections a single address may hold
+WORKERS = 64  # Requests served at the same time, the rest wait for a free worker
+PRIORITY_WORKERS = 16  # Extra workers only listings and small transfers may use
+QUEUE_TIMEOUT = 10  # Seconds a request may wait for a worker before it is turned away
+RETRY_AFTER = 5  # Seconds a turned away client is told to wait before retrying
+MAX_REJECTIONS = 256  # Busy replies being sent at once; beyond this connections are just closed
+
+logger = logging.getLogger(__name__)
+
+
+class ServerBusy(Exception):
+    """Raised when a request waited QUEUE_TIMEOUT seconds without getting a worker."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy, retry after {retry_after} seconds")
+        # Seconds the client should wait before trying again
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """Decide which connections the server takes on and bound the work it does at once.
+
+    Connections over the global or per-address limit are turned away with a busy
+    reply as soon as they arrive. Admitted connections share a pool of worker
+    slots: every request holds one while it is served, so a burst of clients
+    queues for a bounded time instead of slowing everyone down without limit.
+    Priority requests have a pool of their own, so they never queue behind bulk
+    transfers.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_ip=MAX_CONNECTIONS_PER_IP, workers=WORKERS,
+                 queue_timeout=QUEUE_TIMEOUT, retry_after=RETRY_AFTER, priority_workers=PRIORITY_WORKERS):
+        # Connection limits, overall and per client address
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        # Number of worker slots and how long a request may wait for one
+        self.workers = workers
+        self.priority_workers = priority_workers
+        self.queue_timeout = queue_timeout
+        # Retry delay announced in busy replies
+        self.retry_after = retry_after
+        # Open connections by client address
+        self.connections = collections.Counter()
+        # Connections turned away since the server started
+        self.rejected = 0
+        # Worker slots for bulk and priority requests, created on the event loop that uses them
+        self._slots = None
+        self._priority_slots = None
+
+    @property
+    def active(self):
+        """Number of admitted connections that are still open."""
+        return sum(self.connections.values())
+
+    def admit(self, address):
+        """Return True and count the connection if address may connect now."""
+        ip = address[0]
+        if self.active >= self.max_connections or self.connections[ip] >= self.max_per_ip:
+            self.rejected += 1
+            logger.info("Turned away %s: %d connections open, %d from this address.",
+                        address, self.active, self.connections[ip])
+            return False
+        self.connections[ip] += 1
+        return True
+
+    def release(self, address):
+        """Forget a connection admitted with admit() once it closes."""
+        ip = address[0]
+        self.connections[ip] -= 1
+        if self.connections[ip] <= 0:
+            del self.connections[ip]
+
+    @contextlib.asynccontextmanager
+    async def worker(self, timeout=None, priority=False):
+        """Hold a worker slot, raising ServerBusy if none frees up within timeout seconds."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+            self._priority_slots = asyncio.Semaphore(self.priority_workers)
+        slots = self._priority_slots if priority else self._slots
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise ServerBusy(self.retry_after) from None
+        try:
+            yield
+        finally:
+            slots.release()
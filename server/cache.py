@@ -0,0 +1,155 @@
+import collections  # Import collections for the LRU order of the cached files
+import mmap  # Import mmap to serve large hot files from the page cache without copying them
+import os  # Import os to read the cached files
+import threading  # Import threading because uploads on worker threads invalidate entries
+
+CACHE_SIZE = 256 * 1024 * 1024  # Bytes of file contents the cache may hold
+MAX_ENTRY_FRACTION = 0.25  # Files larger than this share of the budget are never cached
+MMAP_THRESHOLD = 1024 * 1024  # Files at least this large are mapped instead of read into memory
+HOT_REQUESTS = 2  # Downloads of a file before it is worth caching
+TRACKED_NAMES = 4096  # Files not cached yet whose downloads are being counted
+
+
+class CachedFile:
+    """Contents of one hot file, either bytes or a read-only mmap of the file."""
+
+    def __init__(self, name, size, sha256, data):
+        self.name = name
+        # Size and hash of the blob the contents were read from, compared with the index
+        self.size = size
+        self.sha256 = sha256
+        self.data = data
+        # Whether the file is worth compressing, None until a download finds out
+        self.compressible = None
+
+    def reader(self):
+        """Return a file-like object over the contents with a position of its own."""
+        return BufferReader(self.data)
+
+
+class BufferReader:
+    """Minimal seek/read file interface over a buffer, so concurrent readers don't share a position."""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.position = 0
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            position += len(self.view)
+        elif whence == os.SEEK_CUR:
+            position += self.position
+        self.position = max(0, position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.position + size
+        data = bytes(self.view[self.position:end])
+        self.position += len(data)
+        return data
+
+
+class FileCache:
+    """Contents of the most downloaded files, least recently used evicted first.
+
+    The cache holds at most budget bytes. A file is loaded on its HOT_REQUESTS-th
+    download, so one-off downloads don't push the hot files out. Small files are
+    kept as bytes; files of MMAP_THRESHOLD bytes or more are mapped read-only,
+    so they stay in the page cache without a private copy on the heap. Entries
+    are checked against the size and hash in the file index on every lookup and
+    dropped by invalidate() as soon as an upload or delete changes the file.
+    """
+
+    def __init__(self, budget=CACHE_SIZE, mmap_threshold=MMAP_THRESHOLD):
+        self.budget = budget
+        self.mmap_threshold = mmap_threshold
+        # Cached files by name, least recently used first
+        self.entries = collections.OrderedDict()
+        # Bytes held by the entries
+        self.used = 0
+        # Downloads of files that are not cached yet, by name
+        self.requests = collections.OrderedDict()
+        # Lookups answered from the cache and not
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, name, meta):
+        """Return the cached contents of name if they match meta from the index, else None."""
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry and meta and (entry.size, entry.sha256) == (meta.size, meta.sha256):
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry
+            if entry:
+                # The file changed behind the cache's back
+                self._drop(name)
+            self.misses += 1
+            return None
+
+    def wanted(self, name, size):
+        """Count a download of name that missed the cache and return True if it should be loaded now."""
+        if not self.budget or size > self.budget * MAX_ENTRY_FRACTION:
+            return False
+        with self._lock:
+            count = self.requests.pop(name, 0) + 1
+            if count >= HOT_REQUESTS:
+                return True
+            self.requests[name] = count
+            if len(self.requests) > TRACKED_NAMES:
+                self.requests.popitem(last=False)
+            return False
+
+    def load(self, name, path, meta):
+        """Read or map the file at path into the cache; returns the entry, None if it changed meanwhile."""
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            # Blobs never change, but the name may have moved on to another one meanwhile
+            if not meta or stat.st_size != meta.size:
+                return None
+            if not stat.st_size:
+                data = b""
+            elif stat.st_size >= self.mmap_threshold:
+                # The mapping stays valid after the file is closed, and after it is replaced or deleted
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        entry = CachedFile(name, stat.st_size, meta.sha256, data)
+        with self._lock:
+            if name in self.entries:
+                self._drop(name)
+            self.entries[name] = entry
+            self.used += entry.size
+            # Evict the least recently used files until the budget holds
+            while self.used > self.budget and len(self.entries) > 1:
+                self._drop(next(iter(self.entries)))
+        return entry
+
+    def invalidate(self, name=None):
+        """Forget the cached contents of name, or of every file if name is None."""
+        with self._lock:
+            if name is None:
+                for cached in list(self.entries):
+                    self._drop(cached)
+                self.requests.clear()
+            elif name in self.entries:
+                self._drop(name)
+
+    def _drop(self, name):
+        # Called with the lock held. A mapping is not closed here: downloads still
+        # sending from it keep it alive, and it is unmapped when the last one is done.
+        entry = self.entries.pop(name)
+        self.used -= entry.size
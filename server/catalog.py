@@ -0,0 +1,123 @@
+import sqlite3  # Import sqlite3 to keep the catalog in a single file every server process can share
+import threading  # Import threading because the event loop and the disk threads share the connection
+
+from common.paths import SEPARATOR
+
+# Stored paths, their contents and the folders created empty
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_sha256 ON files (sha256);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+BUSY_TIMEOUT = 30  # Seconds to wait for another process to finish writing the catalog
+
+
+def subtree(path):
+    """Return the bounds of the paths below folder path, for a range query."""
+    # Nothing sorts between path + "/" and path + "0", "0" being the character after "/"
+    return path + SEPARATOR, path + chr(ord(SEPARATOR) + 1)
+
+
+class Catalog:
+    """The names of the stored files and folders, kept in an SQLite database.
+
+    The files themselves live in the blob store; the catalog maps every path
+    to the hash, size and modification time of its contents. Folders exist as
+    long as a file is stored below them, or for good once created with
+    add_folder(). Every change commits at once, and the write-ahead log lets
+    the server processes sharing a store read while one of them writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Commits survive a crash of the process; only a power failure may lose the last ones
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def version(self):
+        """Return a number that changes whenever another connection commits a change."""
+        with self._lock:
+            return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def files(self):
+        """Return (path, sha256, size, mtime) of every stored file."""
+        with self._lock:
+            return self._db.execute("SELECT path, sha256, size, mtime FROM files").fetchall()
+
+    def folders(self):
+        """Return the path of every folder that was created on its own."""
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT path FROM folders")]
+
+    def file(self, path):
+        """Return (path, sha256, size, mtime) of a stored file, None if there is none."""
+        with self._lock:
+            return self._db.execute("SELECT path, sha256, size, mtime FROM files WHERE path = ?",
+                                    (path,)).fetchone()
+
+    def is_folder(self, path):
+        """Check whether path is a folder, created on its own or holding files."""
+        low, high = subtree(path)
+        with self._lock:
+            return bool(self._db.execute("SELECT 1 FROM folders WHERE path = ? OR (path > ? AND path < ?)",
+                                         (path, low, high)).fetchone()
+                        or self._db.execute("SELECT 1 FROM files WHERE path > ? AND path < ? LIMIT 1",
+                                            (low, high)).fetchone())
+
+    def file_above(self, path):
+        """Return a stored file that is one of the folders path would be in, None if there is none."""
+        parts = path.split(SEPARATOR)[:-1]
+        folders = [SEPARATOR.join(parts[:i]) for i in range(1, len(parts) + 1)]
+        if not folders:
+            return None
+        with self._lock:
+            row = self._db.execute(f"SELECT path FROM files WHERE path IN ({','.join('?' * len(folders))})",
+                                   folders).fetchone()
+        return row[0] if row else None
+
+    def has_folder(self, path):
+        """Check whether path was created as a folder on its own."""
+        with self._lock:
+            return bool(self._db.execute("SELECT 1 FROM folders WHERE path = ?", (path,)).fetchone())
+
+    def links(self, sha256):
+        """Return how many stored files have the contents with the given hash."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM files WHERE sha256 = ?", (sha256,)).fetchone()[0]
+
+    def put(self, path, sha256, size, mtime):
+        """Store path as the contents with the given hash, replacing what it was."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files (path, sha256, size, mtime) VALUES (?, ?, ?, ?)",
+                             (path, sha256, size, mtime))
+
+    def remove(self, path):
+        """Forget a stored file."""
+        with self._lock:
+            self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def add_folder(self, path):
+        """Create a folder that exists even while it holds nothing."""
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO folders (path) VALUES (?)", (path,))
+
+    def remove_folder(self, path):
+        """Forget a folder created on its own, and those created inside it."""
+        low, high = subtree(path)
+        with self._lock:
+            self._db.execute("DELETE FROM folders WHERE path = ? OR (path > ? AND path < ?)", (path, low, high))
@@ -0,0 +1,289 @@
+import asyncio  # Import asyncio to drive sockets from the event loop
+import socket  # Import socket to shut down reaped connections
+
+from common.compression import COMPRESS_CHUNK_SIZE, Encoder
+
+from .shaping import SHAPED_CHUNK
+
+BUFFER_SIZE = 4096  # Minimum number of bytes requested from the socket at once
+SENDFILE_FALLBACK_CHUNK = 256 * 1024  # Read size when the platform has no sendfile
+SENDFILE_CHUNK = 8 * 1024 * 1024  # Bytes per sendfile call, so progress shows during large downloads
+
+
+class Connection:
+    """Client socket driven by the asyncio event loop instead of a thread.
+
+    With a throttle, every byte that goes through the socket is paced by its
+    bandwidth limits.
+
+    The connection notes since when it waits on the client to send or to take
+    data, so the server can reap it once stalled; see stalled().
+    """
+
+    def __init__(self, sock, address, throttle=None):
+        # The accepted client socket
+        self.sock = sock
+        # Address of the connected client
+        self.address = address
+        # Event loop sockets must be non-blocking
+        self.sock.setblocking(False)
+        # Event loop that owns this connection
+        self.loop = asyncio.get_running_loop()
+        # Bytes received from the socket but not consumed yet
+        self.buffer = bytearray()
+        # Bandwidth limits of this connection, None if it is not shaped
+        self.throttle = throttle
+        # Set by the session while the current request belongs in the priority lane
+        self.priority = False
+        # Bytes moved through the socket so far, for the metrics
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # Set while the session waits for the next request rather than the rest of one
+        self.idle = False
+        # Set while requests run on the streams of a multiplexed connection, which is not idle meanwhile
+        self.busy = False
+        # Since when a pending receive waits on the client, None while none is pending
+        self.read_since = None
+        # Set while the pending receive waits for the rest of a request that began arriving
+        self.read_partial = False
+        # Since when a pending send waits on the client, None while none is pending
+        self.write_since = None
+        # When bytes last moved through the socket either way
+        self.last_active = self.loop.time()
+        # Task serving the connection, and why it was reaped if it was
+        self.task = None
+        self.reaped = None
+
+    async def _reading(self, operation):
+        """Await a socket receive, noting that the connection waits on the client meanwhile."""
+        self.read_since = self.loop.time()
+        self.read_partial = bool(self.buffer)
+        try:
+            return await operation
+        finally:
+            self.read_since = None
+            self.last_active = self.loop.time()
+
+    async def _writing(self, operation):
+        """Await a socket send, noting that the connection waits on the client meanwhile."""
+        self.write_since = self.loop.time()
+        try:
+            return await operation
+        finally:
+            self.write_since = None
+            self.last_active = self.loop.time()
+
+    def stalled(self, now, read_timeout=None, write_timeout=None, idle_timeout=None):
+        """Return why the connection should be reaped at loop time now, None if it should not.
+
+        "write" if a send has waited longer than write_timeout, "read" if the rest
+        of a request has not arrived for read_timeout, "idle" if no request came
+        and nothing moved for idle_timeout. A timeout of None or 0 never expires.
+        """
+        if self.write_since is not None and write_timeout and now - self.write_since > write_timeout:
+            return "write"
+        if self.read_since is None:
+            return None
+        if not self.idle or self.read_partial:
+            if read_timeout and now - self.read_since > read_timeout:
+                return "read"
+        elif not self.busy and self.write_since is None and idle_timeout and now - self.last_active > idle_timeout:
+            return "idle"
+        return None
+
+    def reap(self):
+        """Abandon the connection: pending receives see the end of the data and pending sends fail.
+
+        The session then stops as if the client had disconnected, keeping what
+        arrived of an upload for the client to resume.
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    async def recv(self, size):
+        """Receive up to size bytes from the client."""
+        if self.buffer:
+            # Hand out buffered bytes before touching the socket again
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        data = await self._reading(self.loop.sock_recv(self.sock, size))
+        self.bytes_received += len(data)
+        if self.throttle:
+            await self.throttle.received(len(data))
+        return data
+
+    async def recv_into(self, view):
+        """Receive bytes from the client straight into a writable buffer, returning the count."""
+        if self.buffer:
+            # Hand out buffered bytes before touching the socket again
+            n = min(len(view), len(self.buffer))
+            view[:n] = self.buffer[:n]
+            del self.buffer[:n]
+            return n
+        n = await self._reading(self.loop.sock_recv_into(self.sock, view))
+        self.bytes_received += n
+        if self.throttle:
+            await self.throttle.received(n)
+        return n
+
+    async def recv_exactly(self, size):
+        """Receive exactly size bytes from the client."""
+        while len(self.buffer) < size:
+            chunk = await self._reading(self.loop.sock_recv(self.sock, max(size - len(self.buffer), BUFFER_SIZE)))
+            if not chunk:
+                raise ConnectionError("Connection closed by client")
+            self.bytes_received += len(chunk)
+            if self.throttle:
+                await self.throttle.received(len(chunk))
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def at_eof(self):
+        """Wait for more data and return True if the client closed the connection instead."""
+        if self.buffer:
+            return False
+        chunk = await self._reading(self.loop.sock_recv(self.sock, BUFFER_SIZE))
+        self.bytes_received += len(chunk)
+        if self.throttle:
+            await self.throttle.received(len(chunk))
+        self.buffer += chunk
+        return not chunk
+
+    def unread(self, data):
+        """Push data back so the next receive returns it first."""
+        self.buffer[:0] = data
+
+    async def sendall(self, data):
+        """Send all of data to the client."""
+        if self.throttle:
+            await self.throttle.sent(len(data))
+        await self._writing(self.loop.sock_sendall(self.sock, data))
+        self.bytes_sent += len(data)
+
+    async def sendfile(self, file, offset, count, transfer=None):
+        """Send count bytes of file starting at offset, zero-copy where the platform allows.
+
+        Returns the number of bytes sent and the method used, "sendfile" or "buffered".
+        The bytes of transfer, if given, follow the progress.
+        """
+        if count == 0:
+            # Nothing to send, and sock_sendfile() rejects a zero count
+            return 0, "sendfile"
+        if self.throttle and not self.throttle.priority:
+            return await self._sendfile_shaped(file, offset, count, transfer)
+        if self.throttle:
+            await self.throttle.sent(count)
+        sent = 0
+        try:
+            while sent < count:
+                # Let the kernel copy straight from the page cache to the socket
+                n = await self._writing(self.loop.sock_sendfile(self.sock, file, offset + sent,
+                                                                min(count - sent, SENDFILE_CHUNK), fallback=False))
+                if not n:
+                    break
+                sent += n
+                self.bytes_sent += n
+                if transfer:
+                    transfer.bytes = sent
+            return sent, "sendfile"
+        except asyncio.SendfileNotAvailableError:
+            pass
+
+        # No sendfile here, copy through a buffer instead
+        file.seek(offset)
+        while sent < count:
+            data = file.read(min(count - sent, SENDFILE_FALLBACK_CHUNK))
+            if not data:
+                break
+            await self._writing(self.loop.sock_sendall(self.sock, data))
+            sent += len(data)
+            self.bytes_sent += len(data)
+            if transfer:
+                transfer.bytes = sent
+        return sent, "buffered"
+
+    async def send_buffer(self, data, transfer=None):
+        """Send a bytes-like object, e.g. a cached file, in chunks so progress and shaping apply.
+
+        Returns the number of bytes sent.
+        """
+        view = memoryview(data)
+        chunk = SHAPED_CHUNK if self.throttle and not self.throttle.priority else SENDFILE_CHUNK
+        sent = 0
+        while sent < len(view):
+            await self.sendall(view[sent:sent + chunk])
+            sent += len(view[sent:sent + chunk])
+            if transfer:
+                transfer.bytes = sent
+        return sent
+
+    async def _sendfile_shaped(self, file, offset, count, transfer=None):
+        """Send a file in SHAPED_CHUNK turns, each paced by the throttle."""
+        method = "sendfile"
+        sent = 0
+        while sent < count:
+            chunk = min(count - sent, SHAPED_CHUNK)
+            await self.throttle.sent(chunk)
+            try:
+                n = await self._writing(self.loop.sock_sendfile(self.sock, file, offset + sent, chunk, fallback=False))
+            except asyncio.SendfileNotAvailableError:
+                method = "buffered"
+                file.seek(offset + sent)
+                data = file.read(chunk)
+                await self._writing(self.loop.sock_sendall(self.sock, data))
+                n = len(data)
+            if not n:
+                break
+            sent += n
+            self.bytes_sent += n
+            if transfer:
+                transfer.bytes = sent
+        return sent, method
+
+    async def send_compressed(self, file, offset, count, codec, executor=None, transfer=None):
+        """Send count bytes of file starting at offset as a compressed body.
+
+        Reading and compressing run on executor, one chunk ahead of the socket.
+        Returns the number of file bytes sent; the bytes of transfer, if given,
+        follow the progress.
+        """
+        encoder = Encoder(codec)
+
+        def encode(position, remaining):
+            file.seek(position)
+            data = file.read(min(remaining, COMPRESS_CHUNK_SIZE))
+            return len(data), encoder.encode(data)
+
+        sent = 0
+        pending = self.loop.run_in_executor(executor, encode, offset, count)
+        try:
+            while pending:
+                # Shielded, so a cancelled send leaves the read-ahead for the finally clause to wait out
+                n, blocks = await asyncio.shield(pending)
+                sent += n
+                if n and sent < count:
+                    # Start on the next chunk while this one is on its way
+                    pending = self.loop.run_in_executor(executor, encode, offset + sent, count - sent)
+                else:
+                    pending = None
+                if blocks:
+                    await self.sendall(blocks)
+                if transfer:
+                    transfer.bytes = sent
+        finally:
+            if pending is not None:
+                # The read-ahead still uses file, which the caller closes as soon as this returns
+                await asyncio.wait([pending])
+                if not pending.cancelled():
+                    pending.exception()
+        await self.sendall(await self.loop.run_in_executor(executor, encoder.finish))
+        return sent
+
+    def close(self):
+        """Close the client socket."""
+        self.sock.close()
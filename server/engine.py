@@ -0,0 +1,430 @@
+import asyncio  # Import asyncio to serve many clients from a single thread
+import contextlib  # Import contextlib to mark sessions waiting for their next request
+import logging  # Import logging to report server activity without a GUI
+import os  # Import os module for file system operations
+import socket  # Import socket module to handle network connections
+import sqlite3  # Import sqlite3 to report catalog errors met while watching it
+import threading  # Import threading to run the event loop next to a GUI
+
+from common.compression import SUPPORTED_CODECS
+from common.framing import (CODECS, COMPRESSION_VERSION, HANDSHAKE_SIZE, MAGIC, MUX_VERSION, PROTOCOL_VERSION,
+                            decode_handshake, encode_busy, encode_handshake)
+from common.sockets import KEEPALIVE_IDLE, configure_socket
+
+from .admission import MAX_REJECTIONS, AdmissionControl
+from .cache import CACHE_SIZE, FileCache
+from .connection import Connection
+from .legacy import LegacySession
+from .metrics import Metrics, TimedExecutor, bind_metrics, serve_metrics, watch_loop_lag
+from .mux import MuxSession
+from .session import Session
+from .shaping import Shaper
+from .storage import PARTIAL_MAX_AGE, FileStore
+from .writer import DEFAULT_CHUNK_SIZE, receive_compressed, receive_file
+
+# Define default server address and port
+DEFAULT_SERVER_HOST = '127.0.0.1'  # Listen on the loopback interface
+DEFAULT_SERVER_PORT = 5001  # Default port to listen on
+BUFFER_SIZE = 4096  # Size of the buffer for receiving data
+LISTEN_BACKLOG = 128  # Number of pending connections the kernel queues for us
+BUSY_READ_TIMEOUT = 2  # Seconds to wait for a turned away client to say which protocol it speaks
+DISK_WORKERS = 8  # Threads performing blocking file writes
+READ_TIMEOUT = 60  # Seconds a client may leave the rest of a request unsent before it is reaped
+WRITE_TIMEOUT = 60  # Seconds a single send may wait for the client to take the data before it is reaped
+IDLE_TIMEOUT = 600  # Seconds a connection may sit between requests with nothing moving before it is reaped
+REAP_INTERVAL = 5  # Longest time between two checks for stalled connections
+SWEEP_INTERVAL = 3600  # Seconds between two sweeps of abandoned unfinished uploads
+CATALOG_CHECK_INTERVAL = 0.5  # Seconds between two checks for catalog changes made by other processes
+
+# Directory that holds the served files
+FILES_DIR = os.path.join(os.path.dirname(__file__), 'files')
+
+logger = logging.getLogger(__name__)
+
+
+class FileServer:
+    """Headless asyncio file server for the UPLOAD, LIST_FILES and DOWNLOAD commands.
+
+    Clients that open with the framed protocol handshake get a Session, anything
+    else is served as a LegacySession speaking the original text commands.
+    """
+
+    def __init__(self, host=DEFAULT_SERVER_HOST, port=DEFAULT_SERVER_PORT, files_dir=FILES_DIR,
+                 on_upload=None, chunk_size=DEFAULT_CHUNK_SIZE, store=None, codecs=SUPPORTED_CODECS,
+                 backlog=LISTEN_BACKLOG, admission=None, shaper=None, metrics_port=None, cache_size=CACHE_SIZE,
+                 reuse_port=False, read_timeout=READ_TIMEOUT, write_timeout=WRITE_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 keepalive=KEEPALIVE_IDLE, nodelay=True, partial_max_age=PARTIAL_MAX_AGE):
+        # Address to listen on
+        self.host = host
+        self.port = port
+        # Storage for the served files, shared with the GUI when it passes its own
+        self.store = store or FileStore(files_dir)
+        # Contents of the most downloaded files, dropped whenever the index sees them change
+        self.cache = FileCache(cache_size)
+        # Conditional downloads answered "not modified" because the client's copy was current
+        self.not_modified = 0
+        # Optional callback invoked with the filename after every upload
+        self.on_upload = on_upload
+        # Size of the reusable buffers uploads are received into
+        self.chunk_size = chunk_size
+        # Compression codecs offered to clients, 0 turns compression off
+        self.codecs = codecs
+        # Counters and histograms describing the server's activity
+        self.metrics = Metrics()
+        # Local port of the Prometheus metrics endpoint, None to not serve one
+        self.metrics_port = metrics_port
+        self.metrics_socket = None
+        # Threads that write uploads to disk so the event loop never waits on it
+        self.disk_executor = TimedExecutor(self.metrics, DISK_WORKERS, thread_name_prefix="disk")
+        # Connections the kernel queues until they are accepted
+        self.backlog = backlog
+        # Share the port with other processes bound with SO_REUSEPORT, the kernel spreads clients among them
+        self.reuse_port = reuse_port
+        # Move files copied into the directory by hand, or kept as an older server did, into the store
+        self.migrate = True
+        # Connection limits and the pool of request workers
+        self.admission = admission or AdmissionControl()
+        # Bandwidth limits, none unless configured
+        self.shaper = shaper or Shaper()
+        # Seconds a connection may stall on the client, see Connection.stalled(); None or 0 never expires
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.idle_timeout = idle_timeout
+        # Seconds of silence before keepalive probes look for a vanished client, 0 for none
+        self.keepalive = keepalive
+        # Send small replies at once instead of waiting for more data to fill a packet
+        self.nodelay = nodelay
+        # Seconds an unfinished upload is kept for the client to resume it, None or 0 for ever
+        self.partial_max_age = partial_max_age
+        # Sessions reaped as stalled or idle, and abandoned unfinished uploads removed
+        self.reaped = 0
+        self.partials_removed = 0
+        # Listening socket, initially None
+        self.listen_socket = None
+        # Tasks of the connected clients
+        self.sessions = set()
+        # Connections being served, the streams of multiplexed ones included
+        self.connections = set()
+        # Tasks telling turned away clients that the server is busy
+        self.rejections = set()
+        # Session tasks waiting for their next request, which a drain may cut off
+        self.idle_sessions = set()
+        # Set once drain() stopped taking new clients and requests
+        self.draining = False
+        # Event loop and stop event, created when the server starts serving
+        self._loop = None
+        self._stopping = None
+        self._accept_task = None
+        # Set once the event loop is ready to accept a stop request
+        self._ready = threading.Event()
+        # Thread running the event loop when started with start()
+        self._thread = None
+
+    def bind(self):
+        """Create the listening socket."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if os.name != "nt":
+                # Allow quick restarts while old connections are in TIME_WAIT
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port and hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(self.backlog)
+        except OSError:
+            sock.close()
+            raise
+        sock.setblocking(False)
+        self.listen_socket = sock
+        # Pick up the real port when binding to port 0
+        self.port = sock.getsockname()[1]
+        if self.metrics_port is not None:
+            try:
+                self.metrics_socket = bind_metrics(self.metrics_port)
+            except OSError:
+                self.listen_socket = None
+                sock.close()
+                raise
+            self.metrics_port = self.metrics_socket.getsockname()[1]
+
+    async def serve(self):
+        """Accept and serve clients until stop() is called."""
+        if self.listen_socket is None:
+            self.bind()
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self.store.index.listeners.append(self.cache.invalidate)
+        self._ready.set()
+        logger.info("Server listening on %s:%s", self.host, self.port)
+
+        accept_task = self._accept_task = asyncio.create_task(self.accept_connections())
+        # Move files that were copied into the directory by hand into the store, without holding up clients
+        migrate_task = asyncio.create_task(self.migrate_store() if self.migrate else asyncio.sleep(0))
+        lag_task = asyncio.create_task(watch_loop_lag(self.metrics))
+        reap_task = asyncio.create_task(self.reap_connections())
+        watch_task = asyncio.create_task(self.watch_catalog())
+        metrics_server = None
+        if self.metrics_socket:
+            metrics_server = await serve_metrics(self.render_metrics, self.metrics_socket)
+            self.metrics_socket = None
+            logger.info("Metrics on http://127.0.0.1:%s/metrics", self.metrics_port)
+        try:
+            await self._stopping.wait()
+        finally:
+            # Stop accepting, then tear down every open session
+            accept_task.cancel()
+            migrate_task.cancel()
+            lag_task.cancel()
+            reap_task.cancel()
+            watch_task.cancel()
+            if metrics_server:
+                metrics_server.close()
+            self.listen_socket.close()
+            self.listen_socket = None
+            self.store.index.listeners.remove(self.cache.invalidate)
+            self.cache.invalidate()
+            for task in list(self.sessions) + list(self.rejections):
+                task.cancel()
+            await asyncio.gather(accept_task, migrate_task, lag_task, reap_task, watch_task, *self.sessions,
+                                 *self.rejections, return_exceptions=True)
+            self.disk_executor.shutdown()
+            self._accept_task = None
+            self._ready.clear()
+            logger.info("Server stopped.")
+
+    def serve_forever(self):
+        """Run the server in the calling thread until stop() is called."""
+        asyncio.run(self.serve())
+
+    def start(self):
+        """Bind and run the server in a background thread."""
+        # Bind here so address errors are raised to the caller
+        self.bind()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        """Stop the server and wait for it to shut down."""
+        if self._ready.is_set():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+
+    async def drain(self, timeout):
+        """Stop taking clients, give open requests up to timeout seconds to finish, then stop.
+
+        Sessions waiting for their next request are closed right away; clients
+        reconnect to whichever process still listens on the port.
+        """
+        self.draining = True
+        if self._accept_task:
+            self._accept_task.cancel()
+            await asyncio.gather(self._accept_task, return_exceptions=True)
+            # Release the port so the kernel stops queueing clients for this process
+            self.listen_socket.close()
+        for task in list(self.idle_sessions):
+            task.cancel()
+        if self.sessions:
+            await asyncio.wait(list(self.sessions), timeout=timeout)
+        self._stopping.set()
+
+    @contextlib.contextmanager
+    def idle(self, conn):
+        """Mark the calling session as waiting for its next request on conn while in the block."""
+        task = asyncio.current_task()
+        self.idle_sessions.add(task)
+        idle, conn.idle = conn.idle, True
+        try:
+            yield
+        finally:
+            conn.idle = idle
+            self.idle_sessions.discard(task)
+
+    async def reap_connections(self):
+        """Close connections stalled on their client or idle for too long, and sweep abandoned uploads.
+
+        A reaped connection is shut down, so its session stops as if the client
+        had disconnected and the upload it was receiving keeps what arrived for
+        the client to resume; one still running at the next check is cancelled.
+        Unfinished uploads nobody wrote to for partial_max_age are removed.
+        """
+        timeouts = [timeout for timeout in (self.read_timeout, self.write_timeout, self.idle_timeout) if timeout]
+        # Check often enough that a connection outlives its timeout by half of it at most
+        interval = min([REAP_INTERVAL] + [timeout / 2 for timeout in timeouts])
+        swept = None
+        while True:
+            await asyncio.sleep(interval)
+            now = self._loop.time()
+            for conn in list(self.connections):
+                if conn.reaped:
+                    conn.task.cancel()
+                    continue
+                reason = conn.stalled(now, self.read_timeout, self.write_timeout, self.idle_timeout)
+                if reason:
+                    conn.reaped = reason
+                    self.reaped += 1
+                    logger.info("Reaping the session of %s, its %s timeout expired.", conn.address, reason)
+                    conn.reap()
+            if self.partial_max_age and (swept is None or now - swept >= SWEEP_INTERVAL):
+                swept = now
+                try:
+                    removed = await self._loop.run_in_executor(self.disk_executor, self.store.sweep_partials,
+                                                               self.partial_max_age)
+                except OSError as e:
+                    logger.error("Error sweeping unfinished uploads: %s", e)
+                    continue
+                self.partials_removed += removed
+                if removed:
+                    logger.info("Removed %d abandoned unfinished uploads.", removed)
+
+    async def watch_catalog(self):
+        """Check the catalog for changes made by other processes on the disk executor.
+
+        Its lock is held through every commit, so a lookup on the event loop that
+        checked the catalog itself could stall every session behind a slow disk.
+        """
+        index = self.store.index
+        index.watched = True
+        try:
+            while True:
+                await asyncio.sleep(max(index.poll_interval, CATALOG_CHECK_INTERVAL))
+                try:
+                    await self._loop.run_in_executor(self.disk_executor, index.check)
+                except (OSError, sqlite3.Error) as e:
+                    logger.error("Error checking the catalog: %s", e)
+        finally:
+            index.watched = False
+
+    async def accept_connections(self):
+        while True:
+            # Accept a client connection
+            client_socket, address = await self._loop.sock_accept(self.listen_socket)
+            if not self.admission.admit(address):
+                if len(self.rejections) >= MAX_REJECTIONS:
+                    # Too many busy replies in flight already, drop the connection outright
+                    client_socket.close()
+                    continue
+                task = asyncio.create_task(self.turn_away(Connection(client_socket, address)))
+                self.rejections.add(task)
+                task.add_done_callback(self.rejections.discard)
+                continue
+            logger.info("Client %s connected.", address)
+            configure_socket(client_socket, self.nodelay, self.keepalive)
+            # Serve the client as a task on the event loop instead of a thread
+            conn = Connection(client_socket, address, self.shaper.open(address))
+            task = asyncio.create_task(self.handle_client(conn))
+            self.sessions.add(task)
+            task.add_done_callback(self.sessions.discard)
+
+    async def turn_away(self, conn):
+        """Tell a client over the connection limits to retry later, in the protocol it speaks."""
+        try:
+            first = await asyncio.wait_for(conn.recv(BUFFER_SIZE), BUSY_READ_TIMEOUT)
+            retry_after = self.admission.retry_after
+            if first and MAGIC.startswith(first[:len(MAGIC)]):
+                await conn.sendall(encode_busy(retry_after))
+            elif first:
+                await conn.sendall(f"Server busy, retry after {retry_after} seconds".encode())
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            conn.close()
+
+    async def handle_client(self, conn):
+        self.metrics.connection_opened()
+        conn.task = asyncio.current_task()
+        self.connections.add(conn)
+        try:
+            # The first bytes tell framed clients apart from legacy text commands
+            first = await conn.recv(BUFFER_SIZE)
+            if not first:
+                return
+            conn.unread(first)
+            if MAGIC.startswith(first[:len(MAGIC)]):
+                session = await self.negotiate(conn)
+            else:
+                session = LegacySession(self, conn)
+            if session:
+                await session.run()
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Error: %s", e)
+        finally:
+            # Close the client socket and free its place for another client
+            self.connections.discard(conn)
+            conn.close()
+            self.admission.release(conn.address)
+            self.shaper.close(conn.address)
+            self.metrics.connection_closed()
+
+    async def negotiate(self, conn):
+        """Agree on a protocol version with a framed client."""
+        offered = decode_handshake(await conn.recv_exactly(HANDSHAKE_SIZE))
+        # Use the highest version both sides speak, 0 means there is none
+        version = min(offered, PROTOCOL_VERSION)
+        if version < COMPRESSION_VERSION:
+            await conn.sendall(encode_handshake(version))
+            return Session(self, conn, version) if version else None
+        # Offer our codecs, the client answers with the ones it will use
+        await conn.sendall(encode_handshake(version) + CODECS.pack(self.codecs))
+        (codecs,) = CODECS.unpack(await conn.recv_exactly(CODECS.size))
+        if version >= MUX_VERSION:
+            # Many streams over the connection, each a session of its own
+            return MuxSession(self, conn, version, codecs & self.codecs)
+        return Session(self, conn, version, codecs & self.codecs)
+
+    async def receive_file(self, conn, path, size, offset=0, codec=0, transfer=None):
+        """Receive an upload body into path at offset, returning the number of bytes received."""
+        if codec:
+            return await receive_compressed(conn, path, size, codec, self.disk_executor, offset, transfer)
+        return await receive_file(conn, path, size, self.chunk_size, self.disk_executor, offset, transfer)
+
+    def render_metrics(self):
+        """Return the server's metrics in the Prometheus text format."""
+        return self.metrics.render([
+            ("connections_rejected_total", "counter", "Connections turned away as over a limit.",
+             self.admission.rejected),
+            ("files", "gauge", "Files in the store.", len(self.store.index)),
+            ("cache_hits_total", "counter", "Downloads served from the hot-file cache.", self.cache.hits),
+            ("cache_misses_total", "counter", "Downloads that missed the hot-file cache.", self.cache.misses),
+            ("cache_bytes", "gauge", "Bytes of file contents held by the hot-file cache.", self.cache.used),
+            ("cache_files", "gauge", "Files held by the hot-file cache.", len(self.cache.entries)),
+            ("downloads_not_modified_total", "counter", "Conditional downloads answered without the file.",
+             self.not_modified),
+            ("sessions_reaped_total", "counter", "Sessions closed as stalled on their client or idle.", self.reaped),
+            ("partials_removed_total", "counter", "Abandoned unfinished uploads removed.", self.partials_removed),
+        ])
+
+    async def commit_upload(self, filename, sha256=None):
+        """Move a finished upload into the blob store, returning its hash."""
+        # Hashing reads the whole file, keep it off the event loop
+        return await self._loop.run_in_executor(self.disk_executor, self.store.commit, filename, sha256)
+
+    async def link_upload(self, filename, sha256):
+        """Store filename as already stored contents, returning False if they are unknown."""
+        return await self._loop.run_in_executor(self.disk_executor, self.store.link, filename, sha256)
+
+    async def migrate_store(self):
+        """Bring files found in the directory itself into the blob store."""
+        try:
+            migrated = await self._loop.run_in_executor(self.disk_executor, self.store.migrate, self.migration_failed)
+        except OSError as e:
+            logger.error("Error migrating stored files: %s", e)
+            return
+        if migrated:
+            logger.info("Moved %d files into the store.", migrated)
+
+    @staticmethod
+    def migration_failed(path, error):
+        if error:
+            logger.warning("Cannot move %s into the store: %s", path, error)
+
+    def file_uploaded(self, filename):
+        """Report a completed upload."""
+        logger.info("File %s uploaded successfully.", filename)
+        if self.on_upload:
+            self.on_upload(filename)
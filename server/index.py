@@ -0,0 +1,224 @@
+import bisect  # Import bisect to keep the names sorted without re-sorting
+import threading  # Import threading because the GUI and the event loop share the index
+import time  # Import time to space out catalog checks
+from collections import namedtuple  # Import namedtuple for the index entries
+
+from common.paths import SEPARATOR
+
+from .catalog import subtree
+
+# Metadata of one stored file
+FileMeta = namedtuple("FileMeta", ["name", "size", "mtime", "sha256"])
+
+SORT_KEYS = ("name", "size", "mtime")  # Fields a listing can be sorted by
+
+
+class FileIndex:
+    """In-memory metadata of the stored files and folders, kept up to date by uploads and deletes.
+
+    The catalog is read once when the index is built; after that listings are
+    served from memory and only the changed entry is touched on every update.
+    Changes another process commits to the catalog are noticed on the next lookup,
+    which then rereads it. A server sets watched and calls check() off its event
+    loop instead, so a lookup never waits for the catalog.
+
+    Callables in listeners are called with the name of every file or folder that
+    changed or was removed, and with None after a rescan.
+
+    When several processes serve the same store, each one tells the others about
+    its changes, which apply them with refresh(). Setting poll_interval then
+    limits the catalog checks to one every so many seconds, so a sibling's
+    upload doesn't make every process reread the catalog before the news arrives.
+    """
+
+    def __init__(self, catalog):
+        # Catalog the index describes
+        self.catalog = catalog
+        # Metadata by file path
+        self.entries = {}
+        # All file paths in sorted order, for prefix lookups and name-ordered pages
+        self.names = []
+        # Folders created on their own in sorted order; the others show in the file paths
+        self.folders = []
+        # Entries sorted by size or mtime, rebuilt lazily after a change
+        self._sorted = {}
+        # Catalog version as of the last scan
+        self._version = None
+        # Seconds between catalog checks, 0 checks on every lookup
+        self.poll_interval = 0
+        self._checked = 0.0
+        # Set while someone else calls check(), lookups then leave the catalog alone
+        self.watched = False
+        # Told about every change, e.g. to drop cached contents
+        self.listeners = []
+        self._lock = threading.RLock()
+        self.rescan()
+
+    def check(self):
+        """Rescan if another process changed the catalog."""
+        if self.catalog.version() != self._version:
+            self.rescan()
+
+    def _check(self):
+        if self.watched:
+            return
+        if self.poll_interval:
+            now = time.monotonic()
+            if now - self._checked < self.poll_interval:
+                return
+            self._checked = now
+        self.check()
+
+    def rescan(self):
+        """Rebuild the index from the catalog."""
+        version = self.catalog.version()
+        entries = {path: FileMeta(path, size, mtime, sha256) for path, sha256, size, mtime in self.catalog.files()}
+        folders = sorted(self.catalog.folders())
+        with self._lock:
+            self.entries = entries
+            self.names = sorted(entries)
+            self.folders = folders
+            self._sorted.clear()
+            self._version = version
+        self._changed(None)
+
+    def _changed(self, name):
+        for listener in self.listeners:
+            listener(name)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        self._check()
+        return name in self.entries
+
+    def get(self, name):
+        """Return the metadata of a file, or None if it isn't indexed."""
+        self._check()
+        return self.entries.get(name)
+
+    def update(self, name, sha256, size, mtime):
+        """Record the new contents of a file after it was stored."""
+        with self._lock:
+            if name not in self.entries:
+                bisect.insort(self.names, name)
+            self.entries[name] = FileMeta(name, size, mtime, sha256)
+            self._sorted.clear()
+        self._changed(name)
+
+    def refresh(self, name):
+        """Bring the entry of name in line with the catalog after another process changed it."""
+        row = self.catalog.file(name)
+        if row:
+            self.update(name, row[1], row[2], row[3])
+        elif self.catalog.has_folder(name):
+            self.add_folder(name)
+        else:
+            self.remove(name)
+
+    def remove(self, name):
+        """Drop the entry of a deleted file."""
+        with self._lock:
+            if self.entries.pop(name, None) is None:
+                return
+            del self.names[bisect.bisect_left(self.names, name)]
+            self._sorted.clear()
+        self._changed(name)
+
+    def add_folder(self, name):
+        """Record a folder created on its own."""
+        with self._lock:
+            position = bisect.bisect_left(self.folders, name)
+            if position < len(self.folders) and self.folders[position] == name:
+                return
+            self.folders.insert(position, name)
+        self._changed(name)
+
+    def remove_folder(self, name):
+        """Drop a deleted folder and the folders inside it."""
+        low, high = subtree(name)
+        with self._lock:
+            start = bisect.bisect_left(self.folders, name)
+            stop = bisect.bisect_left(self.folders, high, start)
+            if start == stop:
+                return
+            del self.folders[start:stop]
+        self._changed(name)
+
+    def is_folder(self, name):
+        """Check whether name is a folder, created on its own or holding files."""
+        self._check()
+        low, high = subtree(name)
+        with self._lock:
+            position = bisect.bisect_left(self.folders, name)
+            if position < len(self.folders) and self.folders[position] == name:
+                return True
+            for names in (self.folders, self.names):
+                position = bisect.bisect_left(names, low)
+                if position < len(names) and names[position] < high:
+                    return True
+        return False
+
+    def children(self, folder):
+        """Return (entries, folders): the files directly in folder and the names of its subfolders."""
+        self._check()
+        prefix = folder + SEPARATOR if folder else ""
+        entries, folders = [], set()
+        with self._lock:
+            for names in (self.names, self.folders):
+                position = bisect.bisect_left(names, prefix)
+                while position < len(names) and names[position].startswith(prefix):
+                    name, separator, _ = names[position][len(prefix):].partition(SEPARATOR)
+                    if separator:
+                        # Something deeper down, skip the rest of that subfolder in one go
+                        folders.add(name)
+                        position = bisect.bisect_left(names, subtree(prefix + name)[1], position)
+                        continue
+                    if names is self.names:
+                        entries.append(self.entries[names[position]])
+                    else:
+                        folders.add(name)
+                    position += 1
+        return entries, sorted(folders)
+
+    def folder_page(self, folder, sort="name", reverse=False, offset=0, limit=None):
+        """Return (entries, total, folders) for one page of the files directly in folder, and its subfolders."""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Cannot sort by {sort!r}")
+        entries, folders = self.children(folder)
+        if sort != "name" or reverse:
+            entries.sort(key=lambda meta: (getattr(meta, sort), meta.name), reverse=reverse)
+        return entries[offset:None if limit is None else offset + limit], len(entries), folders
+
+    def page(self, prefix="", sort="name", reverse=False, offset=0, limit=None):
+        """Return (entries, total) for one page of the files whose names start with prefix."""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Cannot sort by {sort!r}")
+        self._check()
+        with self._lock:
+            # The names matching a prefix form one contiguous run of the sorted list
+            lo = bisect.bisect_left(self.names, prefix)
+            hi = bisect.bisect_left(self.names, prefix + "\U0010ffff") if prefix else len(self.names)
+            total = hi - lo
+            if sort == "name":
+                if reverse:
+                    start, stop = hi - offset, hi - offset - (total if limit is None else limit)
+                    names = self.names[max(stop, lo):max(start, lo)][::-1]
+                else:
+                    start = lo + offset
+                    names = self.names[start:hi if limit is None else min(hi, start + limit)]
+                return [self.entries[name] for name in names], total
+
+            if prefix:
+                # A prefix usually selects few files, sort just those
+                ordered = sorted((self.entries[name] for name in self.names[lo:hi]),
+                                 key=lambda meta: (getattr(meta, sort), meta.name), reverse=reverse)
+            else:
+                # Sorting everything is cached until the next change
+                ordered = self._sorted.get((sort, reverse))
+                if ordered is None:
+                    ordered = sorted(self.entries.values(), key=lambda meta: (getattr(meta, sort), meta.name),
+                                     reverse=reverse)
+                    self._sorted[(sort, reverse)] = ordered
+            return ordered[offset:None if limit is None else offset + limit], total
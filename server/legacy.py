@@ -0,0 +1,117 @@
+import os  # Import os module for file system operations
+import time  # Import time to measure how long commands take
+
+from common.paths import clean_path
+
+from .storage import PathConflict
+
+BUFFER_SIZE = 4096  # Size of the buffer for receiving data
+SEPARATOR = "<SEPARATOR>"  # Separator used for splitting command strings
+
+
+class LegacySession:
+    """Serve a client that speaks the original SEPARATOR text commands."""
+
+    def __init__(self, server, conn):
+        # Server the session belongs to
+        self.server = server
+        # Connection to the client
+        self.conn = conn
+
+    async def run(self):
+        while not self.server.draining:
+            # Receive command from the client
+            with self.server.idle(self.conn):
+                command = (await self.conn.recv(BUFFER_SIZE)).decode()
+            if not command:
+                # If no command is received, the client has disconnected
+                break
+
+            started = time.perf_counter()
+            received, sent = self.conn.bytes_received, self.conn.bytes_sent
+            # Legacy clients can't be told to retry, so they wait for a worker as long as it takes
+            async with self.server.admission.worker():
+                if command.startswith("UPLOAD"):
+                    await self.upload(command)
+                elif command == "LIST_FILES":
+                    await self.list_files()
+                elif command.startswith("DOWNLOAD"):
+                    await self.download(command)
+                else:
+                    continue
+            op = command.split(SEPARATOR)[0].lower()
+            self.server.metrics.request(op, time.perf_counter() - started, self.conn.bytes_received - received,
+                                        self.conn.bytes_sent - sent)
+
+    async def upload(self, command):
+        # Split the command into filename and filesize
+        _, filename, filesize = command.split(SEPARATOR)
+        # Convert filesize to integer
+        filesize = int(filesize)
+        try:
+            # Get the basename of the file, refusing names that can't be stored
+            filename = clean_path(os.path.basename(filename))
+        except ValueError as e:
+            await self.conn.sendall(f"{filename} upload failed: {e}".encode())
+            # The client sends the file anyway; drop it so the next command is read cleanly
+            await self.discard(filesize)
+            return
+
+        # Receive the file contents, stopping early if the client disconnects
+        store = self.server.store
+        received = await self.server.receive_file(self.conn, store.partial_path(filename), filesize)
+        if received < filesize:
+            # Keep what arrived as a partial upload instead of a truncated file
+            return
+        try:
+            await self.server.commit_upload(filename)
+        except PathConflict as e:
+            await self.conn.sendall(f"{filename} upload failed: {e}".encode())
+            return
+        # Send upload complete message to the client
+        await self.conn.sendall(f"{filename} upload complete".encode())
+        self.server.file_uploaded(filename)
+
+    async def discard(self, size):
+        """Read and drop size bytes sent by the client."""
+        while size:
+            chunk = await self.conn.recv(min(size, BUFFER_SIZE))
+            if not chunk:
+                break
+            size -= len(chunk)
+
+    async def list_files(self):
+        # Get the list of files in the directory
+        files = self.server.store.list_names()
+        if files:
+            # Join the filenames with the separator
+            response = SEPARATOR.join(files)
+        else:
+            # If no files are found
+            response = "No files found"
+        # Send the response to the client
+        await self.conn.sendall(response.encode())
+
+    async def download(self, command):
+        # Split the command to get the filename
+        _, filename = command.split(SEPARATOR)
+        store = self.server.store
+        if not store.exists(filename):
+            # If the file is not found, send error message
+            await self.conn.sendall("File not found".encode())
+            return
+
+        # Send the filename and filesize to the client
+        filesize = store.size(filename)
+        await self.conn.sendall(f"{filename}{SEPARATOR}{filesize}".encode())
+
+        # Open the file in binary read mode
+        with open(store.path(filename), "rb") as f:
+            while True:
+                # Read bytes from the file
+                bytes_read = f.read(BUFFER_SIZE)
+                if not bytes_read:
+                    # If no more bytes are read, stop
+                    break
+                # Send the bytes to the client
+                await self.conn.sendall(bytes_read)
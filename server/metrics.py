@@ -0,0 +1,305 @@
+import asyncio  # Import asyncio to serve the metrics endpoint and watch the event loop
+import bisect  # Import bisect to find histogram buckets
+import collections  # Import collections for the windows of recent samples
+import concurrent.futures  # Import concurrent.futures to time the disk worker threads
+import socket  # Import socket to bind the metrics endpoint
+import threading  # Import threading because the GUI reads metrics the event loop writes
+import time  # Import time to measure durations
+
+# Upper bounds in seconds of the duration histogram buckets
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Upper bounds in bytes per second of the throughput histogram buckets
+RATE_BUCKETS = tuple(2 ** n for n in range(16, 36, 2))
+WINDOW = 1024  # Recent samples kept per histogram for the percentiles
+RECENT_TRANSFERS = 20  # Finished transfers listed in the GUI panel
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event loop lag measurements
+PERCENTILES = (0.5, 0.95, 0.99)  # Percentiles reported for every histogram
+METRICS_HOST = "127.0.0.1"  # The metrics endpoint only listens locally
+PREFIX = "fileserver"  # Prefix of every exported metric name
+# Gauges every server process reports the same value of, merged by taking the largest
+SHARED_GAUGES = {f"{PREFIX}_files"}
+
+
+class Histogram:
+    """Bucketed distribution of observations, plus a window of recent ones for percentiles."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Observations per bucket, the last one counting those above every bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def percentile(self, p):
+        """Return the p-th percentile (0..1) of the recent observations, None if there are none."""
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class Metrics:
+    """Counters and histograms describing what the server is doing.
+
+    The event loop records, the GUI and the metrics endpoint read; a lock keeps
+    the two sides consistent.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Per operation: requests, failed requests, bytes in and out, and durations
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes_received = collections.Counter()
+        self.bytes_sent = collections.Counter()
+        self.durations = collections.defaultdict(lambda: Histogram(DURATION_BUCKETS))
+        # Per direction: throughput of finished transfers
+        self.rates = collections.defaultdict(lambda: Histogram(RATE_BUCKETS))
+        self.recent_transfers = collections.deque(maxlen=RECENT_TRANSFERS)
+        # Transfers running right now
+        self.active_transfers = set()
+        # Connections accepted and currently open
+        self.connections = 0
+        self.active = 0
+        # How late the event loop wakes up, a sign of blocking work on it
+        self.loop_lag = Histogram(DURATION_BUCKETS)
+        # Time disk jobs spend waiting for a worker thread and running on it
+        self.disk_wait = Histogram(DURATION_BUCKETS)
+        self.disk_run = Histogram(DURATION_BUCKETS)
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.active += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.active -= 1
+
+    def request(self, op, duration, received, sent, error=False):
+        """Record one handled request of operation op."""
+        with self._lock:
+            self.requests[op] += 1
+            if error:
+                self.errors[op] += 1
+            self.bytes_received[op] += received
+            self.bytes_sent[op] += sent
+            self.durations[op].observe(duration)
+
+    def transfer_started(self, transfer):
+        with self._lock:
+            self.active_transfers.add(transfer)
+
+    def transfer_ended(self, transfer):
+        with self._lock:
+            self.active_transfers.discard(transfer)
+
+    def transfer(self, transfer):
+        """Record a finished Transfer."""
+        with self._lock:
+            self.rates[transfer.direction].observe(transfer.rate)
+            self.recent_transfers.append((transfer.direction, transfer.filename, transfer.bytes, transfer.elapsed,
+                                          transfer.rate, transfer.method))
+
+    def observe(self, histogram, value):
+        """Record value in one of the shared histograms."""
+        with self._lock:
+            histogram.observe(value)
+
+    def snapshot(self):
+        """Return a plain summary for display: totals and percentiles per operation."""
+        with self._lock:
+            ops = {}
+            for op in sorted(self.requests):
+                histogram = self.durations[op]
+                ops[op] = {
+                    "requests": self.requests[op],
+                    "errors": self.errors[op],
+                    "bytes_received": self.bytes_received[op],
+                    "bytes_sent": self.bytes_sent[op],
+                    "percentiles": [histogram.percentile(p) for p in PERCENTILES],
+                }
+            return {
+                "active": self.active,
+                "connections": self.connections,
+                "ops": ops,
+                "rates": {direction: [h.percentile(p) for p in PERCENTILES] for direction, h in self.rates.items()},
+                "loop_lag": [self.loop_lag.percentile(p) for p in PERCENTILES],
+                "disk_wait": [self.disk_wait.percentile(p) for p in PERCENTILES],
+                "disk_run": [self.disk_run.percentile(p) for p in PERCENTILES],
+                "transfers": list(self.recent_transfers),
+                "active_transfers": [(id(t), t.direction, t.filename, t.address, t.bytes, t.total)
+                                     for t in sorted(self.active_transfers, key=lambda t: t.started)],
+            }
+
+    def render(self, extra=()):
+        """Return every metric in the Prometheus text exposition format.
+
+        extra holds additional (name, type, help, value) gauges or counters.
+        """
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+        def histogram(name, label, h):
+            cumulative = 0
+            for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                cumulative += count
+                lines.append(f'{PREFIX}_{name}_bucket{{{label + "," if label else ""}le="{bound}"}} {cumulative}')
+            label = f"{{{label}}}" if label else ""
+            lines.append(f"{PREFIX}_{name}_sum{label} {h.sum}")
+            lines.append(f"{PREFIX}_{name}_count{label} {h.count}")
+
+        with self._lock:
+            family("connections_active", "gauge", "Open client connections.")
+            lines.append(f"{PREFIX}_connections_active {self.active}")
+            family("connections_total", "counter", "Client connections accepted.")
+            lines.append(f"{PREFIX}_connections_total {self.connections}")
+            for name, kind, help_text, value in extra:
+                family(name, kind, help_text)
+                lines.append(f"{PREFIX}_{name} {value}")
+
+            for name, counter, help_text in (
+                    ("requests_total", self.requests, "Requests handled, by operation."),
+                    ("request_errors_total", self.errors, "Requests answered with an error, by operation."),
+                    ("received_bytes_total", self.bytes_received, "Bytes received, by operation."),
+                    ("sent_bytes_total", self.bytes_sent, "Bytes sent, by operation.")):
+                family(name, "counter", help_text)
+                for op in sorted(counter):
+                    lines.append(f'{PREFIX}_{name}{{op="{op}"}} {counter[op]}')
+
+            family("request_duration_seconds", "histogram", "Time spent handling a request, by operation.")
+            for op in sorted(self.durations):
+                histogram("request_duration_seconds", f'op="{op}"', self.durations[op])
+            family("request_latency_seconds", "summary", "Recent request duration percentiles, by operation.")
+            for op in sorted(self.durations):
+                for p in PERCENTILES:
+                    value = self.durations[op].percentile(p)
+                    if value is not None:
+                        lines.append(f'{PREFIX}_request_latency_seconds{{op="{op}",quantile="{p}"}} {value}')
+
+            family("transfer_rate_bytes_per_second", "histogram", "Throughput of finished transfers, by direction.")
+            for direction in sorted(self.rates):
+                histogram("transfer_rate_bytes_per_second", f'direction="{direction}"', self.rates[direction])
+
+            for name, h, help_text in (
+                    ("loop_lag_seconds", self.loop_lag, "How late the event loop wakes from a timed sleep."),
+                    ("disk_wait_seconds", self.disk_wait, "Time disk jobs wait for a worker thread."),
+                    ("disk_run_seconds", self.disk_run, "Time disk jobs run on a worker thread.")):
+                family(name, "histogram", help_text)
+                histogram(name, "", h)
+        return "\n".join(lines) + "\n"
+
+
+class TimedExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Thread pool that records how long each job waited for a thread and ran on it."""
+
+    def __init__(self, metrics, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def submit(self, fn, /, *args, **kwargs):
+        queued = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            self.metrics.observe(self.metrics.disk_wait, started - queued)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.metrics.observe(self.metrics.disk_run, time.perf_counter() - started)
+
+        return super().submit(timed)
+
+
+async def watch_loop_lag(metrics):
+    """Measure how late the event loop wakes up, until cancelled."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe(metrics.loop_lag, max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+def merge_metrics(texts):
+    """Combine the Prometheus text of several server processes into one exposition.
+
+    Counters, histograms and gauges are summed sample by sample. Quantiles of a
+    summary can't be added, so the largest is kept, and so is the value of a
+    gauge in SHARED_GAUGES, which describes state the processes share.
+    """
+    # Header lines and merged samples of each metric family, in the order first seen
+    families = {}
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# "):
+                _, keyword, name = line.split(" ", 3)[:3]
+                family = families.setdefault(name, {"headers": [], "kind": "untyped", "samples": {}})
+                if line not in family["headers"]:
+                    family["headers"].append(line)
+                if keyword == "TYPE":
+                    family["kind"] = line.rsplit(" ", 1)[1]
+                continue
+            if not line or family is None:
+                continue
+            sample, value = line.rsplit(" ", 1)
+            value = float(value) if any(c in value for c in ".eEn") else int(value)
+            samples = family["samples"]
+            if sample not in samples:
+                samples[sample] = value
+            elif "quantile=" in sample or sample.split("{")[0] in SHARED_GAUGES:
+                samples[sample] = max(samples[sample], value)
+            else:
+                samples[sample] += value
+    lines = []
+    for family in families.values():
+        lines.extend(family["headers"])
+        lines.extend(f"{sample} {value}" for sample, value in family["samples"].items())
+    return "\n".join(lines) + "\n"
+
+
+def bind_metrics(port, host=METRICS_HOST):
+    """Return a listening socket for the metrics endpoint."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen()
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+async def serve_metrics(render, sock):
+    """Serve render() as Prometheus text at /metrics on a socket from bind_metrics(); returns the asyncio server."""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Skip the request headers
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (OSError, UnicodeError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, sock=sock)
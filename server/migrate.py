@@ -0,0 +1,62 @@
+"""Move an existing store into the sharded, catalogued layout.
+
+Stores written before the catalog kept every file directly in the files
+directory, linked to blobs sharded a single level deep. The server migrates
+such a store in the background when it starts; run this first to migrate a
+large store before serving it, with a progress report:
+
+    python -m server.migrate --files-dir "server/server files"
+"""
+
+import argparse  # Import argparse to read the command line options
+import sys  # Import sys to report errors and set the exit status
+import time  # Import time to space out the progress reports
+
+from .engine import FILES_DIR
+from .storage import FileStore
+
+PROGRESS_INTERVAL = 1  # Seconds between two progress reports
+
+
+def main(argv=None):
+    """Migrate a files directory and print what was moved."""
+    parser = argparse.ArgumentParser(prog="python -m server.migrate",
+                                     description="Move the files of an older store into the sharded layout.")
+    parser.add_argument("--files-dir", default=FILES_DIR, help="directory that holds the served files")
+    parser.add_argument("--verbose", "-v", action="store_true", help="print the path of every file moved")
+    args = parser.parse_args(argv)
+
+    failed = []
+    reported = time.monotonic()
+    count = 0
+
+    def progress(path, error):
+        nonlocal reported, count
+        if error:
+            failed.append(path)
+            print(f"{path}: {error}", file=sys.stderr)
+            return
+        count += 1
+        if args.verbose:
+            print(path)
+        elif time.monotonic() - reported >= PROGRESS_INTERVAL:
+            reported = time.monotonic()
+            print(f"{count} files moved...", flush=True)
+
+    store = FileStore(args.files_dir)
+    try:
+        migrated = store.migrate(progress)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        store.close()
+    print(f"Moved {migrated} files into the store, {len(store.index)} files stored in all.")
+    if failed:
+        print(f"{len(failed)} files could not be moved and were left where they are.", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+import asyncio  # Import asyncio to serve the streams of a connection as tasks
+import collections  # Import collections for the queues of streams waiting to write
+import logging  # Import logging to report streams that fail
+import socket  # Import socket module to send small mux frames without delay
+
+from common.framing import MUX_CHUNK, MUX_HEADER, STREAM_WINDOW, WINDOW, Mux, ProtocolError, decode_mux, encode_mux
+
+from .connection import Connection
+from .session import Session
+from .shaping import Throttle
+
+MAX_STREAMS = 64  # Streams a client may have open on one connection at once
+
+logger = logging.getLogger(__name__)
+
+
+class WriteTurns:
+    """Turns at writing one mux frame to the connection.
+
+    Waiting priority writers always go first, the others take turns in the order
+    they asked, so bulk streams share the connection chunk by chunk.
+    """
+
+    def __init__(self):
+        self.busy = False
+        # Futures of the writers waiting, priority first
+        self.waiting = (collections.deque(), collections.deque())
+
+    async def acquire(self, priority):
+        if not self.busy:
+            self.busy = True
+            return
+        future = asyncio.get_running_loop().create_future()
+        queue = self.waiting[0 if priority else 1]
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The turn arrived just as the writer gave up, hand it on
+                self.release()
+            elif future in queue:
+                queue.remove(future)
+            raise
+
+    def release(self):
+        for queue in self.waiting:
+            while queue:
+                future = queue.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self.busy = False
+
+
+class StreamConnection(Connection):
+    """One stream of a multiplexed connection, used by a Session like a whole Connection.
+
+    Data the client sends on the stream is buffered until the session reads it;
+    the client may only send STREAM_WINDOW bytes ahead of what was read. Data the
+    session sends goes out as DATA frames of at most MUX_CHUNK bytes, each waiting
+    for a turn at the connection and for the client to allow more.
+    """
+
+    def __init__(self, mux, stream_id, throttle=None):
+        # Multiplexed connection the stream belongs to
+        self.mux = mux
+        self.stream_id = stream_id
+        self.address = mux.conn.address
+        self.loop = mux.conn.loop
+        # Bytes received on the stream but not consumed yet
+        self.buffer = bytearray()
+        # Bandwidth limits of this stream, pacing the connection's buckets on its own priority
+        self.throttle = throttle
+        # Set by the session while the current request belongs in the priority lane
+        self.priority = False
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # DATA bytes we may still send, and set whenever the client allows more
+        self.send_window = STREAM_WINDOW
+        self.window_open = asyncio.Event()
+        # DATA bytes the client may still send, and bytes consumed since we last allowed more
+        self.recv_window = STREAM_WINDOW
+        self.consumed = 0
+        # Set whenever data, END or RESET arrives
+        self.readable = asyncio.Event()
+        # Set once the client sent END, or the stream was reset
+        self.ended = False
+        self.reset = False
+        # Set by the session while it waits for the next request, and since when the stream waits on the client
+        self._idle = False
+        self.busy = False
+        self.read_since = None
+        self.read_partial = False
+        self.write_since = None
+        self.last_active = self.loop.time()
+        # Task running the stream's session, and why it was reaped if it was
+        self.task = None
+        self.reaped = None
+
+    def feed(self, data):
+        """Buffer DATA the client sent on the stream."""
+        if len(data) > self.recv_window:
+            raise ProtocolError(f"Stream {self.stream_id} sent more than its window")
+        self.recv_window -= len(data)
+        self.buffer += data
+        self.bytes_received += len(data)
+        self.readable.set()
+
+    def end(self):
+        """Note that the client will send nothing more on the stream."""
+        self.ended = True
+        self.readable.set()
+
+    def abort(self):
+        """Fail every read and write waiting on the stream."""
+        self.ended = self.reset = True
+        self.readable.set()
+        self.window_open.set()
+
+    def allow(self, n):
+        """Let the stream send n more DATA bytes."""
+        self.send_window += n
+        self.window_open.set()
+
+    @property
+    def idle(self):
+        return self._idle
+
+    @idle.setter
+    def idle(self, idle):
+        self._idle = idle
+        self.mux.update_busy()
+
+    def stalled(self, now, read_timeout=None, write_timeout=None, idle_timeout=None):
+        # An idle stream costs nothing; the connection carrying it is reaped once that is idle
+        return super().stalled(now, read_timeout, write_timeout)
+
+    def reap(self):
+        self.mux.reap(self)
+
+    async def _wait_readable(self):
+        while not self.buffer and not self.ended:
+            self.readable.clear()
+            await self._reading(self.readable.wait())
+
+    async def _consumed(self, n):
+        if self.throttle:
+            await self.throttle.received(n)
+        self.consumed += n
+        if self.consumed >= STREAM_WINDOW // 2 and not self.ended:
+            # Let the client send as much again as the session has read
+            n, self.consumed = self.consumed, 0
+            self.recv_window += n
+            await self.mux.send_frame(self, Mux.WINDOW, WINDOW.pack(n))
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def recv(self, size):
+        await self._wait_readable()
+        data = self._take(size)
+        await self._consumed(len(data))
+        return data
+
+    async def recv_into(self, view):
+        await self._wait_readable()
+        n = min(len(view), len(self.buffer))
+        view[:n] = self.buffer[:n]
+        del self.buffer[:n]
+        await self._consumed(n)
+        return n
+
+    async def recv_exactly(self, size):
+        while len(self.buffer) < size:
+            if self.ended:
+                raise ConnectionError("Stream closed by client")
+            self.readable.clear()
+            await self._reading(self.readable.wait())
+        data = self._take(size)
+        await self._consumed(size)
+        return data
+
+    async def at_eof(self):
+        await self._wait_readable()
+        return not self.buffer
+
+    async def _credit(self, wanted):
+        """Wait until the client allows more data; return how much of wanted fits in the next frame."""
+        while self.send_window <= 0 and not self.reset:
+            self.window_open.clear()
+            # The client reads too slowly, if at all
+            await self._writing(self.window_open.wait())
+        if self.reset or self.mux.closed:
+            raise ConnectionError("Stream reset by client")
+        n = min(wanted, self.send_window, MUX_CHUNK)
+        self.send_window -= n
+        return n
+
+    async def sendall(self, data):
+        view = memoryview(data).cast("B")
+        if self.throttle:
+            await self.throttle.sent(len(view))
+        while view:
+            n = await self._credit(len(view))
+            await self.mux.send_frame(self, Mux.DATA, view[:n])
+            view = view[n:]
+            self.bytes_sent += n
+
+    async def sendfile(self, file, offset, count, transfer=None):
+        """Send count bytes of file starting at offset as DATA frames, zero-copy where the platform allows."""
+        sent = 0
+        while sent < count:
+            n = await self._credit(count - sent)
+            if self.throttle:
+                await self.throttle.sent(n)
+            await self.mux.send_file_frame(self, file, offset + sent, n)
+            sent += n
+            self.bytes_sent += n
+            if transfer:
+                transfer.bytes = sent
+        return sent, "sendfile"
+
+    def close(self):
+        # The multiplexed connection ends the stream once its session is done
+        pass
+
+
+class MuxSession:
+    """Serve a client that multiplexes streams over one connection, protocol version 4 on.
+
+    Every stream runs a Session of its own, so a listing never waits behind a
+    download on the same connection. Frames of requests in the priority lane,
+    and the END, WINDOW and RESET frames, are written before bulk DATA.
+    """
+
+    def __init__(self, server, conn, version, codecs=0):
+        self.server = server
+        self.conn = conn
+        self.version = version
+        self.codecs = codecs
+        # Bandwidth limits apply per stream, so each paces the connection's buckets on its own priority
+        self.throttle, conn.throttle = conn.throttle, None
+        # Open streams by id, and the highest id opened so far
+        self.streams = {}
+        self.last_id = 0
+        self.turns = WriteTurns()
+        # Set once the connection is done and nothing more can be written
+        self.closed = False
+        # Task reading the connection
+        self.task = None
+        # Stalls of a request show on its stream, the connection only ever waits for its next frame
+        conn.idle = True
+        # WINDOW frames are tiny and must not wait for more data to fill a packet
+        try:
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    async def run(self):
+        self.task = asyncio.current_task()
+        try:
+            while not (self.server.draining and not self.streams):
+                if self.streams:
+                    at_eof = await self.conn.at_eof()
+                else:
+                    with self.server.idle(self.conn):
+                        at_eof = await self.conn.at_eof()
+                if at_eof:
+                    break
+                stream_id, kind, length = decode_mux(await self.conn.recv_exactly(MUX_HEADER.size))
+                payload = await self.conn.recv_exactly(length) if length else b""
+                await self.dispatch(stream_id, kind, payload)
+        finally:
+            self.closed = True
+            for stream in self.streams.values():
+                stream.abort()
+                stream.task.cancel()
+            await asyncio.gather(*(stream.task for stream in list(self.streams.values())), return_exceptions=True)
+
+    async def dispatch(self, stream_id, kind, payload):
+        stream = self.streams.get(stream_id)
+        if kind == Mux.DATA:
+            if stream is None:
+                if stream_id <= self.last_id:
+                    # Data that crossed a RESET of a finished stream
+                    return
+                if len(self.streams) >= MAX_STREAMS:
+                    self.last_id = stream_id
+                    await self._write(stream_id, Mux.RESET, b"", True)
+                    return
+                stream = self.open(stream_id)
+            stream.feed(payload)
+        elif stream is None:
+            return
+        elif kind == Mux.WINDOW:
+            if len(payload) != WINDOW.size:
+                raise ProtocolError("Malformed WINDOW frame")
+            stream.allow(WINDOW.unpack(payload)[0])
+        elif kind == Mux.END:
+            stream.end()
+        elif kind == Mux.RESET:
+            stream.abort()
+            stream.task.cancel()
+
+    def open(self, stream_id):
+        """Start serving a new stream."""
+        throttle = Throttle(self.throttle.send_buckets, self.throttle.recv_buckets) if self.throttle else None
+        stream = StreamConnection(self, stream_id, throttle)
+        self.streams[stream_id] = stream
+        self.conn.busy = True
+        self.last_id = stream_id
+        stream.task = asyncio.create_task(self.serve_stream(stream))
+        self.server.connections.add(stream)
+        return stream
+
+    def update_busy(self):
+        """Mark the connection busy while a stream is in the middle of a request."""
+        self.conn.busy = not all(stream.idle for stream in self.streams.values())
+
+    def reap(self, stream):
+        """Abandon a stream stalled on the client, whose session stops as if the client reset it."""
+        stream.abort()
+
+    async def serve_stream(self, stream):
+        try:
+            await Session(self.server, stream, self.version, self.codecs).run()
+            # The client is told a reaped stream is gone
+            await self.send_frame(stream, Mux.RESET if stream.reaped else Mux.END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not self.closed and (stream.reaped or not stream.reset):
+                if not stream.reaped:
+                    logger.error("Error on stream %d of %s: %s", stream.stream_id, self.conn.address, e)
+                try:
+                    await self.send_frame(stream, Mux.RESET)
+                except OSError:
+                    pass
+        finally:
+            self.streams.pop(stream.stream_id, None)
+            self.server.connections.discard(stream)
+            self.update_busy()
+            if self.server.draining and not self.streams and not self.closed:
+                # Nothing left to finish on this connection
+                self.task.cancel()
+
+    async def send_frame(self, stream, kind, payload=b""):
+        """Write one mux frame of stream, waiting for its turn at the connection."""
+        await self._write(stream.stream_id, kind, payload, kind != Mux.DATA or stream.priority)
+
+    async def _write(self, stream_id, kind, payload, priority):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        await self.turns.acquire(priority)
+        # A frame cut short would garble the connection, so a cancelled writer still finishes its frame
+        await asyncio.shield(self._send(encode_mux(stream_id, kind, len(payload)) + payload))
+
+    async def _send(self, data):
+        try:
+            await self.conn.sendall(data)
+        finally:
+            self.turns.release()
+
+    async def send_file_frame(self, stream, file, offset, count):
+        """Write count bytes of file starting at offset as one DATA frame of stream."""
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        await self.turns.acquire(stream.priority)
+        send = asyncio.ensure_future(self._send_file(stream.stream_id, file, offset, count))
+        try:
+            await asyncio.shield(send)
+        except asyncio.CancelledError:
+            # The send still reads from file, which the caller closes as soon as this returns
+            while not send.done():
+                try:
+                    await asyncio.wait([send])
+                except asyncio.CancelledError:
+                    pass
+            if not send.cancelled():
+                send.exception()
+            raise
+
+    async def _send_file(self, stream_id, file, offset, count):
+        try:
+            await self.conn.sendall(encode_mux(stream_id, Mux.DATA, count))
+            sent = await self.conn._writing(self.conn.loop.sock_sendfile(self.conn.sock, file, offset, count))
+            self.conn.bytes_sent += sent
+            if sent < count:
+                raise ConnectionError("File shrank while it was being sent")
+        finally:
+            self.turns.release()
@@ -1,19 +1,48 @@
-import socket  # Import socket module to handle network connections
-import threading  # Import threading module to handle multiple clients simultaneously
 import os  # Import os module for file system operations
+import sys  # Import sys module to make the server package importable
 import tkinter as tk  # Import tkinter module for creating the graphical user interface (GUI)
 from tkinter import messagebox, PhotoImage  # Import messagebox from tkinter for showing dialog boxes
 from tkinter import Scrollbar  # Import Scrollbar from tkinter for creating scrollbars
 
-# Define default server address and port
-DEFAULT_SERVER_HOST = '127.0.0.1'  # Listen on all available network interfaces
-DEFAULT_SERVER_PORT = 5001  # Default port to listen on
-BUFFER_SIZE = 4096  # Size of the buffer for receiving data
-SEPARATOR = "<SEPARATOR>"  # Separator used for splitting command strings
+# Make the project root importable when this file is run directly as a script
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
 
-# Directory to store files if the user agrees to download
-FILES_DIR = os.path.join(os.path.dirname(__file__), 'files')  # Path to the 'files' directory
-os.makedirs(FILES_DIR, exist_ok=True)  # Create the directory if it doesn't exist
+from common.gui import EventBridge, TransferPanel, format_bytes
+from server.engine import DEFAULT_SERVER_HOST, DEFAULT_SERVER_PORT, FILES_DIR, FileServer
+from server.storage import FileStore
+
+# Storage for the served files
+store = FileStore(FILES_DIR)
+
+METRICS_REFRESH_MS = 500  # How often the metrics and transfer panels are redrawn
+
+
+def format_ms(seconds):
+    """Format a duration in seconds as milliseconds, or a dash if there is none."""
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def format_metrics(snapshot):
+    """Return the text of the metrics panel for a Metrics.snapshot()."""
+    lines = [f"Active connections: {snapshot['active']}   Total: {snapshot['connections']}", "",
+             f"{'Command':<11}{'Count':>7}{'Errors':>7}{'In':>11}{'Out':>11}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"]
+    for op, stats in snapshot["ops"].items():
+        p50, p95, p99 = stats["percentiles"]
+        lines.append(f"{op:<11}{stats['requests']:>7}{stats['errors']:>7}{format_bytes(stats['bytes_received']):>11}"
+                     f"{format_bytes(stats['bytes_sent']):>11}{format_ms(p50):>9}{format_ms(p95):>9}{format_ms(p99):>9}")
+    lines.append("")
+    for label, key in (("Event loop lag", "loop_lag"), ("Disk queue wait", "disk_wait"), ("Disk job time", "disk_run")):
+        lines.append(f"{label + ' p50/p95/p99 ms:':<34}" + " / ".join(format_ms(v) for v in snapshot[key]))
+    for direction, percentiles in sorted(snapshot["rates"].items()):
+        lines.append(f"{direction.capitalize() + ' rate p50/p95/p99:':<34}"
+                     + " / ".join("-" if v is None else format_bytes(v) + "/s" for v in percentiles))
+    if snapshot["transfers"]:
+        lines += ["", "Recent transfers:"]
+        for direction, filename, count, elapsed, rate, method in reversed(snapshot["transfers"][-5:]):
+            lines.append(f"  {direction:<9}{filename[:24]:<25}{format_bytes(count):>11} in {elapsed:.2f}s, "
+                         f"{format_bytes(rate)}/s via {method}")
+    return "\n".join(lines)
 
 
 class ServerGUI:
@@ -65,12 +94,23 @@ class ServerGUI:
         # Pack the listbox with padding
         self.file_listbox.pack(pady=20)
 
+        # Progress bars of the uploads and downloads running right now
+        self.transfer_panel = TransferPanel(root)
+        self.transfer_panel.pack(padx=10, pady=5, fill=tk.X)
+
+        # Live view of the server's metrics
+        self.metrics_frame = tk.LabelFrame(root, text="Metrics")
+        self.metrics_frame.pack(padx=10, pady=5, fill=tk.BOTH)
+        self.metrics_label = tk.Label(self.metrics_frame, text="Server not running", font=("Courier", 9),
+                                      justify=tk.LEFT, anchor="w")
+        self.metrics_label.pack(padx=5, pady=5, fill=tk.BOTH)
+
         # List to keep track of received files
         self.files_received = []
-        # Server socket, initially None
-        self.server_socket = None
-        # Thread for accepting connections, initially None
-        self.accept_thread = None
+        # Headless server engine, initially None
+        self.server = None
+        # The server's event loop thread reports uploads through this, never touching widgets itself
+        self.events = EventBridge(root)
 
     def add_file(self, filename):
         # Add the filename to the listbox
@@ -78,111 +118,8 @@ class ServerGUI:
         # Add the filename to the received files list
         self.files_received.append(filename)
 
-    def handle_client(self, client_socket):
-        # Assign the client socket to an instance variable
-        self.client_socket = client_socket
-        try:
-            while True:
-                # Receive command from the client
-                command = client_socket.recv(BUFFER_SIZE).decode()
-                if not command:
-                    # If no command is received, break the loop
-                    break
-
-                if command.startswith("UPLOAD"):
-                    # Split the command into filename and filesize
-                    _, filename, filesize = command.split(SEPARATOR)
-                    # Get the basename of the file
-                    filename = os.path.basename(filename)
-                    # Convert filesize to integer
-                    filesize = int(filesize)
-
-                    # Get the full path of the file
-                    filepath = os.path.join(FILES_DIR, filename)
-                    
-                    # Open the file in binary write mode
-                    with open(filepath, "wb") as f:
-                        # Initialize bytes received counter
-                        bytes_received = 0
-                        # While the file is not completely received
-                        while bytes_received < filesize:
-                            # Receive bytes from the client
-                            bytes_read = client_socket.recv(BUFFER_SIZE)
-                            if not bytes_read:
-                                # If no more bytes are received, break the loop
-                                break
-                            # Write the received bytes to the file
-                            f.write(bytes_read)
-                            # Update bytes received counter
-                            bytes_received += len(bytes_read)
-                    # Send upload complete message to the client
-                    client_socket.send(f"{filename} upload complete".encode())
-                    # Add the file to the listbox
-                    self.add_file(filename)
-                    # Print success message
-                    print(f"File {filename} uploaded successfully.")
-
-                elif command == "LIST_FILES":
-                    # Get the list of files in the directory
-                    files = os.listdir(FILES_DIR)
-                    if files:
-                        # Join the filenames with the separator
-                        response = SEPARATOR.join(files)
-                    else:
-                        # If no files are found
-                        response = "No files found"
-                    # Send the response to the client
-                    client_socket.send(response.encode())
-
-                elif command.startswith("DOWNLOAD"):
-                    # Split the command to get the filename
-                    _, filename = command.split(SEPARATOR)
-                    # Get the full path of the file
-                    filepath = os.path.join(FILES_DIR, filename)
-                    if os.path.exists(filepath):
-                        # If the file exists, get the size of the file
-                        filesize = os.path.getsize(filepath)
-                        # Send the filename and filesize to the client
-                        client_socket.send(f"{filename}{SEPARATOR}{filesize}".encode())
-
-                        # Open the file in binary read mode
-                        with open(filepath, "rb") as f:
-                            while True:
-                                # Read bytes from the file
-                                bytes_read = f.read(BUFFER_SIZE)
-                                if not bytes_read:
-                                    # If no more bytes are read, break the loop
-                                    break
-                                # Send the bytes to the client
-                                client_socket.sendall(bytes_read)
-                    else:
-                        # If the file is not found, send error message
-                        client_socket.send("File not found".encode())
-
-        except Exception as e:
-            # Print any exceptions
-            print(f"Error: {e}")
-        finally:
-            # Close the client socket
-            client_socket.close()
-
-    def accept_connections(self):
-        while self.server_socket:
-            try:
-                # Accept a client connection
-                client_socket, address = self.server_socket.accept()
-                # Print client address
-                print(f"Client {address} connected.")
-                # Create a thread to handle the client
-                client_handler = threading.Thread(target=self.handle_client, args=(client_socket,))
-                # Start the thread
-                client_handler.start()
-            except:
-                # Break the loop if there is an exception
-                break
-
     def start_server(self):
-        if self.server_socket:
+        if self.server:
             # If the server is already running, return
             return
 
@@ -191,19 +128,17 @@ class ServerGUI:
         server_port = int(self.port_entry.get()) if self.port_entry.get() else DEFAULT_SERVER_PORT
 
         try:
-            # This line creates a new socket object using the socket module.
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # This line binds the socket to a specific IP address and port number.
-            self.server_socket.bind((server_host, server_port))
-
-            self.server_socket.listen(5)
+            # Create the server engine, reporting uploads back to the listbox
+            self.server = FileServer(server_host, server_port, FILES_DIR, store=store,
+                                     on_upload=lambda filename: self.events.post(self.add_file, filename))
+            # Bind the address and serve clients on a background event loop
+            self.server.start()
             print(f"Server listening on {server_host}:{server_port}")
 
-            self.accept_thread = threading.Thread(target=self.accept_connections)
-            self.accept_thread.start()
-
             self.start_btn.config(state=tk.DISABLED)
             self.stop_btn.config(state=tk.NORMAL)
+            # Start redrawing the metrics panel
+            self.refresh_metrics()
 
         except OSError as e:
             # Handle invalid IP address or port error
@@ -211,21 +146,40 @@ class ServerGUI:
                 messagebox.showerror("Server Error", "The requested address is not valid in its context.")
             else:
                 messagebox.showerror("Server Error", f"An error occurred: {str(e)}")
-            self.server_socket = None  # Reset server socket if an error occurs
+            self.server = None  # Reset server if an error occurs
 
         except Exception as e:
             messagebox.showerror("Server Error", f"An unexpected error occurred: {str(e)}")
-            self.server_socket = None  # Reset server socket if an error occurs
+            self.server = None  # Reset server if an error occurs
+
+    def refresh_metrics(self):
+        if not self.server:
+            # The server was stopped, leave the last figures on screen
+            return
+        # Redraw the panels from a consistent copy of the metrics, then schedule the next redraw
+        snapshot = self.server.metrics.snapshot()
+        self.metrics_label.config(text=format_metrics(snapshot))
+        self.show_transfers(snapshot["active_transfers"])
+        self.root.after(METRICS_REFRESH_MS, self.refresh_metrics)
+
+    def show_transfers(self, transfers):
+        # Update the progress bar of every running transfer and drop those that ended
+        running = set()
+        for key, direction, filename, address, done, total in transfers:
+            running.add(key)
+            self.transfer_panel.update(key, f"{direction.capitalize()} {filename} ({address[0]})", done, total)
+        for key in self.transfer_panel.keys():
+            if key not in running:
+                self.transfer_panel.remove(key)
 
     def stop_server(self):
-        if self.server_socket:
-            # If the server is running, close the server socket
-            self.server_socket.close()
-            # Set the server socket to None
-            self.server_socket = None
-
-        # Wait for the accept thread to finish
-        self.accept_thread.join()
+        if self.server:
+            # If the server is running, stop it and wait for it to shut down
+            self.server.stop()
+            # Set the server to None
+            self.server = None
+            self.show_transfers([])
+
         # Enable the start button
         self.start_btn.config(state=tk.NORMAL)
         # Disable the stop button
@@ -254,7 +208,7 @@ class ServerGUI:
         scrollbar.config(command=file_listbox.yview)
 
         # Get the list of files in the directory
-        files = os.listdir(FILES_DIR)
+        files = store.list_names()
 
         # Add files to the listbox
         for file in files:
@@ -277,14 +231,12 @@ class ServerGUI:
             index = selection[0]
             # Get the filename from the list
             filename = file_listbox.get(index)
-            # Get the full path of the file
-            filepath = os.path.join(FILES_DIR, filename)
             # Confirm deletion
             response = messagebox.askyesno("Delete File", f"Do you want to delete '{filename}'?")
             if response:
                 try:
                     # Delete the file
-                    os.remove(filepath)
+                    store.delete(filename)
                     # Remove the file from the listbox
                     file_listbox.delete(index)
 
@@ -0,0 +1,627 @@
+import hashlib  # Import hashlib to hash files rebuilt from a delta
+import time  # Import time to measure how long requests take
+import os  # Import os module for file system operations
+
+from common.bundle import (END_OF_ARCHIVE, EXTENDED, FILE, INLINE_SIZE, TAR_BLOCK, decode_member, decode_pax,
+                           encode_member, member_length, padding)
+from common.compression import BLOCK, block_length, choose_codec, compressible, frame_codec
+from common.delta import COPY, INSTRUCTION, LITERAL, MAX_LITERAL_SIZE, block_size_for, signatures
+from common.framing import HEADER, Frame, Op, ProtocolError, decode_header, decode_meta, encode_frame
+from common.paths import clean_folder, clean_path
+
+from .admission import ServerBusy
+from .shaping import SMALL_TRANSFER
+from .storage import ChecksumError, PathConflict
+from .transfer import Transfer
+
+BUFFER_SIZE = 4096  # Size of the buffer for streaming file data
+DEFAULT_PAGE_SIZE = 1000  # Files per LIST_FILES reply unless the client asks otherwise
+MAX_PAGE_SIZE = 10000  # Most files a single LIST_FILES reply may carry
+BUNDLE_DEPTH = 16  # Small bundle members written to disk at once while the next ones arrive
+
+
+class RequestError(Exception):
+    """Raised by a handler to answer the current frame with an ERROR frame."""
+
+
+class Session:
+    """Serve a client that speaks the length-prefixed framed protocol."""
+
+    def __init__(self, server, conn, version, codecs=0):
+        # Server the session belongs to
+        self.server = server
+        # Connection to the client
+        self.conn = conn
+        # Protocol version agreed during negotiation
+        self.version = version
+        # Compression codecs agreed during negotiation
+        self.codecs = codecs
+        # Client-chosen id of the request being handled, echoed in its reply
+        self.request_id = None
+        # Handler for each request operation
+        self.handlers = {
+            Op.UPLOAD: self.upload,
+            Op.LIST_FILES: self.list_files,
+            Op.DOWNLOAD: self.download,
+            Op.STAT: self.stat,
+            Op.DELETE: self.delete,
+            Op.HAVE: self.have,
+            Op.SIGNATURE: self.signature,
+            Op.DELTA: self.delta,
+            Op.BUNDLE_UPLOAD: self.bundle_upload,
+            Op.BUNDLE_DOWNLOAD: self.bundle_download,
+            Op.MKDIR: self.mkdir,
+        }
+
+    async def run(self):
+        while not self.server.draining:
+            # Receive the next request; frames are self-delimiting so pipelined requests never mix
+            with self.server.idle(self.conn):
+                frame = await self.read_frame()
+            if frame is None:
+                # The client has disconnected
+                break
+
+            handler = self.handlers.get(frame.op)
+            self.request_id = frame.meta.get("id")
+            admission = self.server.admission
+            started = time.perf_counter()
+            received, sent = self.conn.bytes_received, self.conn.bytes_sent
+            error = False
+            # Listings and small files skip the queues that bulk transfers wait in
+            priority = self.conn.priority = self.priority(frame)
+            if self.conn.throttle:
+                self.conn.throttle.priority = priority
+            try:
+                if handler is None:
+                    await self.skip_body(frame)
+                    raise RequestError(f"Unexpected operation {frame.op.name}")
+                # Wait for a free worker, but only so long; a quick busy reply beats a stall
+                async with admission.worker(admission.queue_timeout, priority):
+                    await handler(frame)
+            except ServerBusy as e:
+                error = True
+                await self.skip_body(frame)
+                await self.send(Op.ERROR, {"error": str(e), "retry_after": e.retry_after})
+            except RequestError as e:
+                error = True
+                await self.send(Op.ERROR, {"error": str(e)})
+            self.server.metrics.request(frame.op.name.lower(), time.perf_counter() - started,
+                                        self.conn.bytes_received - received, self.conn.bytes_sent - sent, error)
+
+    def priority(self, frame):
+        """Return True if a request belongs in the priority lane: listings, lookups and small files."""
+        if frame.op in (Op.SIGNATURE, Op.DELTA):
+            # Small on the wire, but they read and write whole files
+            return False
+        if frame.op in (Op.BUNDLE_UPLOAD, Op.BUNDLE_DOWNLOAD):
+            # However small each file, a bundle moves many of them
+            return False
+        if frame.op == Op.DOWNLOAD:
+            try:
+                meta = self.server.store.index.get(clean_path(frame.meta.get("name")))
+            except ValueError:
+                meta = None
+            if meta and meta.sha256 and frame.meta.get("if_none_match") == meta.sha256:
+                # Answered "not modified", without the file
+                return True
+            size = meta.size if meta else 0
+            length = frame.meta.get("length")
+            if isinstance(length, int):
+                size = min(size, length)
+            return size <= SMALL_TRANSFER
+        return frame.body_length <= SMALL_TRANSFER
+
+    async def read_frame(self):
+        """Return the next frame from the client, or None once it disconnects."""
+        if await self.conn.at_eof():
+            return None
+        op, flags, meta_length, body_length = decode_header(await self.conn.recv_exactly(HEADER.size))
+        meta = decode_meta(await self.conn.recv_exactly(meta_length))
+        return Frame(op, flags, meta, body_length)
+
+    async def send(self, op, meta=None, body_length=0, flags=0):
+        """Send a reply frame header and metadata to the client."""
+        if self.request_id is not None:
+            # Tag the reply so a client with many requests in flight can match it up
+            meta = dict(meta or {}, id=self.request_id)
+        await self.conn.sendall(encode_frame(op, meta, body_length, flags))
+
+    async def discard(self, size):
+        """Read and drop size bytes of a frame body."""
+        while size:
+            chunk = await self.conn.recv(min(size, BUFFER_SIZE))
+            if not chunk:
+                raise ConnectionError("Connection closed by client")
+            size -= len(chunk)
+
+    async def skip_body(self, frame):
+        """Read and drop the body of a frame, compressed or not."""
+        if not frame_codec(frame.flags, self.codecs):
+            await self.discard(frame.body_length)
+            return
+        while True:
+            length = block_length(await self.conn.recv_exactly(BLOCK.size))
+            if not length:
+                break
+            await self.discard(length)
+
+    def filename(self, frame):
+        """Return the validated file path carried by a request frame."""
+        name = frame.meta.get("name")
+        if name is None:
+            raise ProtocolError("Request is missing a file name")
+        try:
+            # Normalised so that clients can't escape the store, whatever their platform's separator
+            return clean_path(name)
+        except ValueError as e:
+            raise ProtocolError(str(e)) from None
+
+    def offset(self, frame):
+        """Return the validated byte offset carried by a request frame, 0 if there is none."""
+        offset = frame.meta.get("offset", 0)
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            raise ProtocolError("Request has an invalid offset")
+        return offset
+
+    def sha256(self, frame):
+        """Return the content hash carried by a request frame, None if there is none."""
+        sha256 = frame.meta.get("sha256")
+        if sha256 is not None and not isinstance(sha256, str):
+            raise ProtocolError("Request has an invalid SHA-256")
+        return sha256.lower() if sha256 else None
+
+    async def upload(self, frame):
+        filename = self.filename(frame)
+        sha256 = self.sha256(frame)
+        store = self.server.store
+        # A non-zero offset continues an interrupted upload of the same file
+        offset = self.offset(frame)
+        partial = store.partial_size(filename)
+        codec = frame_codec(frame.flags, self.codecs)
+        if offset > partial:
+            await self.skip_body(frame)
+            raise RequestError(f"Cannot resume {filename} at byte {offset}, only {partial} bytes are stored")
+
+        # The header says exactly how many bytes of file data follow
+        with Transfer("upload", filename, self.conn.address, self.server.metrics, frame.body_length) as transfer:
+            transfer.method = codec.name.lower() if codec else "recv_into"
+            transfer.bytes = await self.server.receive_file(self.conn, store.partial_path(filename),
+                                                            frame.body_length, offset, codec, transfer)
+            if transfer.bytes < frame.body_length:
+                # What arrived stays in the partial directory so the client can resume later
+                raise ConnectionError(f"Connection closed during upload of {filename}")
+            transfer.finish()
+        try:
+            sha256 = await self.server.commit_upload(filename, sha256)
+        except (ChecksumError, PathConflict) as e:
+            raise RequestError(str(e)) from None
+        # Acknowledge the upload
+        await self.send(Op.OK, {"name": filename, "size": offset + frame.body_length, "sha256": sha256})
+        self.server.file_uploaded(filename)
+
+    async def have(self, frame):
+        filename = self.filename(frame)
+        sha256 = self.sha256(frame)
+        # Contents the server already stores are linked under the new name, no upload needed
+        try:
+            have = bool(sha256) and await self.server.link_upload(filename, sha256)
+        except PathConflict as e:
+            raise RequestError(str(e)) from None
+        store = self.server.store
+        await self.send(Op.OK, {"name": filename, "have": have, "size": store.size(filename) if have else None})
+        if have:
+            self.server.file_uploaded(filename)
+
+    async def signature(self, frame):
+        filename = self.filename(frame)
+        try:
+            f = open(self.server.store.path(filename), "rb")
+        except FileNotFoundError:
+            raise RequestError("File not found") from None
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            block_size = block_size_for(size)
+            # Reading and hashing every block is disk and CPU work, keep it off the event loop
+            packed, sha256 = await self.conn.loop.run_in_executor(self.server.disk_executor, signatures,
+                                                                   f, block_size)
+        await self.send(Op.OK, {"name": filename, "size": size, "sha256": sha256, "block_size": block_size},
+                        len(packed))
+        await self.conn.sendall(packed)
+
+    async def delta(self, frame):
+        filename = self.filename(frame)
+        sha256 = self.sha256(frame)
+        base_sha256 = frame.meta.get("base")
+        store = self.server.store
+        try:
+            base = open(store.path(filename), "rb")
+        except FileNotFoundError:
+            base = None
+        if base is None or store.sha256(filename) != base_sha256:
+            # The signatures the client worked from no longer describe the stored file
+            if base:
+                base.close()
+            await self.discard(frame.body_length)
+            raise RequestError(f"{filename} changed on the server, upload it again")
+
+        transfer = Transfer("upload", filename, self.conn.address, self.server.metrics, frame.body_length)
+        transfer.method = "delta"
+        loop = self.conn.loop
+        executor = self.server.disk_executor
+        temp = store.delta_path(filename)
+        with transfer, base, open(temp, "wb") as out:
+            base_size = os.fstat(base.fileno()).st_size
+            block_size = block_size_for(base_size)
+            digest = hashlib.sha256()
+            try:
+                remaining = frame.body_length
+                while remaining:
+                    if remaining < INSTRUCTION.size:
+                        raise ProtocolError("Delta instruction runs past the end of the body")
+                    kind, first, length = INSTRUCTION.unpack(await self.conn.recv_exactly(INSTRUCTION.size))
+                    remaining -= INSTRUCTION.size
+                    if kind == COPY:
+                        if first + length > -(-base_size // block_size):
+                            raise ProtocolError(f"Delta copies past the end of {filename}")
+                        await loop.run_in_executor(executor, self._copy_blocks, base, out, digest,
+                                                   first * block_size, length * block_size)
+                    elif kind == LITERAL and length <= min(remaining, MAX_LITERAL_SIZE):
+                        data = await self.conn.recv_exactly(length)
+                        remaining -= length
+                        await loop.run_in_executor(executor, self._write_literal, out, digest, data)
+                    else:
+                        raise ProtocolError("Invalid delta instruction")
+                    transfer.bytes = frame.body_length - remaining
+                transfer.bytes = frame.body_length
+                out.close()
+                sha256 = await loop.run_in_executor(executor, store.commit_file, temp, filename, sha256,
+                                                    digest.hexdigest())
+            except (ChecksumError, PathConflict) as e:
+                raise RequestError(str(e)) from None
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+        transfer.finish()
+        await self.send(Op.OK, {"name": filename, "size": store.size(filename), "sha256": sha256})
+        self.server.file_uploaded(filename)
+
+    @staticmethod
+    def _copy_blocks(base, out, digest, offset, length):
+        base.seek(offset)
+        while length:
+            data = base.read(min(length, MAX_LITERAL_SIZE))
+            if not data:
+                break
+            out.write(data)
+            digest.update(data)
+            length -= len(data)
+
+    @staticmethod
+    def _write_literal(out, digest, data):
+        out.write(data)
+        digest.update(data)
+
+    async def stat(self, frame):
+        filename = self.filename(frame)
+        store = self.server.store
+        # Report the stored size and how much of an unfinished upload can be resumed
+        size = store.size(filename) if store.exists(filename) else None
+        await self.send(Op.OK, {"name": filename, "size": size, "sha256": store.sha256(filename),
+                                "partial": store.partial_size(filename)})
+
+    async def list_files(self, frame):
+        meta = frame.meta
+        folder = meta.get("folder")
+        prefix = meta.get("prefix", "")
+        sort = meta.get("sort", "name")
+        reverse = meta.get("reverse", False)
+        offset = self.offset(frame)
+        limit = meta.get("limit", DEFAULT_PAGE_SIZE)
+        if not isinstance(prefix, str) or not isinstance(reverse, bool):
+            raise ProtocolError("Invalid listing request")
+        if not isinstance(limit, int) or isinstance(limit, bool) or not 0 < limit <= MAX_PAGE_SIZE:
+            raise RequestError(f"Page size must be between 1 and {MAX_PAGE_SIZE}")
+        index = self.server.store.index
+        reply = {}
+        try:
+            # Served from the in-memory index; the catalog is only checked for changes, off the event loop
+            if folder is None:
+                entries, total = index.page(prefix, sort, reverse, offset, limit)
+            else:
+                # Only what is directly in one folder: its files, a page at a time, and all its subfolders
+                folder = clean_folder(folder)
+                if folder and not index.is_folder(folder):
+                    raise RequestError("Folder not found")
+                entries, total, reply["folders"] = index.folder_page(folder, sort, reverse, offset, limit)
+        except ValueError as e:
+            raise RequestError(str(e)) from None
+
+        files = [{"name": e.name, "size": e.size, "mtime": e.mtime, "sha256": e.sha256} for e in entries]
+        # Offset of the next page, or None when this was the last one
+        following = offset + len(files)
+        reply.update(files=files, total=total, next=following if following < total else None)
+        await self.send(Op.OK, reply)
+
+    async def delete(self, frame):
+        filename = self.filename(frame)
+        try:
+            await self.conn.loop.run_in_executor(self.server.disk_executor, self.server.store.delete, filename)
+        except FileNotFoundError:
+            raise RequestError("File not found") from None
+        except PathConflict as e:
+            raise RequestError(str(e)) from None
+        await self.send(Op.OK, {"name": filename})
+
+    async def mkdir(self, frame):
+        name = self.filename(frame)
+        try:
+            await self.conn.loop.run_in_executor(self.server.disk_executor, self.server.store.mkdir, name)
+        except PathConflict as e:
+            raise RequestError(str(e)) from None
+        await self.send(Op.OK, {"name": name})
+
+    async def cached(self, filename, meta):
+        """Return the cached contents of a file being downloaded, loading it if it has become hot."""
+        cache = self.server.cache
+        entry = cache.lookup(filename, meta)
+        if entry is None and cache.wanted(filename, meta.size):
+            try:
+                entry = await self.conn.loop.run_in_executor(self.server.disk_executor, cache.load, filename,
+                                                             self.server.store.path(filename), meta)
+            except FileNotFoundError:
+                raise RequestError("File not found") from None
+        return entry
+
+    async def download(self, frame):
+        filename = self.filename(frame)
+        store = self.server.store
+        meta = store.index.get(filename)
+        if meta is None:
+            raise RequestError("File not found")
+
+        # The client holds a copy with this hash and wants the file only if it differs
+        if_none_match = frame.meta.get("if_none_match")
+        if if_none_match is not None and not isinstance(if_none_match, str):
+            raise ProtocolError("Request has an invalid if_none_match")
+        if meta.sha256 and if_none_match == meta.sha256:
+            self.server.not_modified += 1
+            await self.send(Op.OK, {"name": filename, "size": meta.size, "sha256": meta.sha256, "offset": 0,
+                                    "not_modified": True})
+            return
+
+        offset = self.offset(frame)
+        # An optional length limits the reply to the byte range offset..offset+length
+        length = frame.meta.get("length")
+        if length is not None and (not isinstance(length, int) or isinstance(length, bool) or length < 0):
+            raise ProtocolError("Request has an invalid length")
+        # Hot files are served from memory, without touching the disk
+        entry = await self.cached(filename, meta)
+        try:
+            f = entry.reader() if entry else open(store.path(filename), "rb")
+        except FileNotFoundError:
+            raise RequestError("File not found") from None
+        with f:
+            filesize = entry.size if entry else os.fstat(f.fileno()).st_size
+            if offset > filesize:
+                if length is not None:
+                    raise RequestError(f"Range starts past the end of {filename}")
+                # The client's partial copy is of an older, longer file; start over
+                offset = 0
+            # Announce the file size and where the body starts, then stream the body
+            count = filesize - offset if length is None else min(length, filesize - offset)
+            # Compress only if the client agreed to and a sample of the file shrinks
+            codec = choose_codec(self.codecs) if count else 0
+            if codec and (entry is None or entry.compressible is None):
+                worth = await self.conn.loop.run_in_executor(self.server.disk_executor, compressible,
+                                                             f, filesize, filename)
+                if entry:
+                    entry.compressible = worth
+            else:
+                worth = entry.compressible if entry else True
+            if codec and not worth:
+                codec = 0
+            # The hash lets the client ask for the file conditionally next time
+            await self.send(Op.OK, {"name": filename, "size": filesize, "offset": offset,
+                                    "sha256": meta.sha256 if meta.size == filesize else None}, count, codec)
+            with Transfer("download", filename, self.conn.address, self.server.metrics, count) as transfer:
+                if codec:
+                    transfer.method = codec.name.lower()
+                    transfer.bytes = await self.conn.send_compressed(f, offset, count, codec,
+                                                                     self.server.disk_executor, transfer)
+                elif entry:
+                    # A view of the cached bytes or mapping, nothing is copied
+                    transfer.method = "cache"
+                    with memoryview(entry.data) as view:
+                        transfer.bytes = await self.conn.send_buffer(view[offset:offset + count], transfer)
+                else:
+                    transfer.bytes, transfer.method = await self.conn.sendfile(f, offset, count, transfer)
+                if transfer.bytes < count:
+                    raise ProtocolError(f"{filename} shrank while it was being sent")
+                transfer.finish()
+
+    async def bundle_upload(self, frame):
+        if frame_codec(frame.flags, self.codecs):
+            await self.skip_body(frame)
+            raise RequestError("Bundles are sent uncompressed")
+        store = self.server.store
+        loop = self.conn.loop
+        remaining = frame.body_length
+        # Small members being written on the disk threads while later ones arrive, by name
+        pending = {}
+        stored = 0
+        errors = {}
+
+        async def read(size):
+            nonlocal remaining
+            if size > remaining:
+                raise ProtocolError("Bundle member runs past the end of the body")
+            remaining -= size
+            return await self.conn.recv_exactly(size)
+
+        async def settle(name):
+            nonlocal stored
+            try:
+                await pending.pop(name)
+            except (OSError, PathConflict) as e:
+                errors[name] = str(e)
+            else:
+                stored += 1
+                self.server.file_uploaded(name)
+
+        transfer = Transfer("upload", "bundle", self.conn.address, self.server.metrics, frame.body_length)
+        transfer.method = "bundle"
+        with transfer:
+            try:
+                extended = None
+                while remaining:
+                    member = decode_member(await read(TAR_BLOCK), extended)
+                    extended = None
+                    if member is None:
+                        # End of the archive; anything after it is padding
+                        await self.discard(remaining)
+                        remaining = 0
+                        break
+                    stored_length = member.size + -member.size % TAR_BLOCK
+                    if member.kind == EXTENDED:
+                        extended = decode_pax((await read(stored_length))[:member.size])
+                        continue
+                    name = ""
+                    if member.kind == FILE:
+                        try:
+                            name = clean_path(member.name)
+                        except ValueError as e:
+                            errors[member.name] = str(e)
+                    if name in pending:
+                        # A later copy of a file replaces the earlier one, so it must land last
+                        await settle(name)
+                    if not name:
+                        # Directories, links and the like carry nothing to store, nor do invalid names
+                        if stored_length > remaining:
+                            raise ProtocolError("Bundle member runs past the end of the body")
+                        remaining -= stored_length
+                        await self.discard(stored_length)
+                    elif member.size <= INLINE_SIZE:
+                        data = (await read(stored_length))[:member.size]
+                        pending[name] = loop.run_in_executor(self.server.disk_executor, store.store_bytes, name, data)
+                        if len(pending) >= BUNDLE_DEPTH:
+                            await settle(next(iter(pending)))
+                    else:
+                        if stored_length > remaining:
+                            raise ProtocolError("Bundle member runs past the end of the body")
+                        remaining -= stored_length
+                        received = await self.server.receive_file(self.conn, store.partial_path(name), member.size)
+                        if received < member.size:
+                            raise ConnectionError(f"Connection closed during upload of {name}")
+                        await self.discard(stored_length - member.size)
+                        try:
+                            await self.server.commit_upload(name)
+                        except (OSError, PathConflict) as e:
+                            errors[name] = str(e)
+                        else:
+                            stored += 1
+                            self.server.file_uploaded(name)
+                    transfer.bytes = frame.body_length - remaining
+            finally:
+                # Members that arrived whole are kept even if the rest of the bundle never does
+                while pending:
+                    await settle(next(iter(pending)))
+            transfer.finish()
+        await self.send(Op.OK, {"count": stored, "errors": errors})
+
+    async def bundle_download(self, frame):
+        index = self.server.store.index
+        names = frame.meta.get("names")
+        missing = []
+        if names is not None:
+            if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+                raise ProtocolError("Invalid bundle request")
+            metas = []
+            for name in names:
+                try:
+                    meta = index.get(clean_path(name))
+                except ValueError:
+                    meta = None
+                if meta:
+                    metas.append(meta)
+                else:
+                    missing.append(name)
+        else:
+            prefix = frame.meta.get("prefix", "")
+            if not isinstance(prefix, str):
+                raise ProtocolError("Invalid bundle request")
+            metas, _ = index.page(prefix)
+
+        # Every header is built up front, so the length of the archive is known before it is sent
+        members = [(meta, encode_member(meta.name, meta.size, meta.mtime)) for meta in metas]
+        length = sum(member_length(header, meta.size) for meta, header in members) + len(END_OF_ARCHIVE)
+        # Runs of small members go out together, large ones on their own
+        runs = []
+        run_bytes = 0
+        for member in members:
+            size = member[0].size
+            if size <= INLINE_SIZE and runs and runs[-1][-1][0].size <= INLINE_SIZE and run_bytes < INLINE_SIZE:
+                runs[-1].append(member)
+                run_bytes += size
+            else:
+                runs.append([member])
+                run_bytes = size
+
+        await self.send(Op.OK, {"count": len(members), "missing": missing}, length)
+        loop = self.conn.loop
+        store = self.server.store
+
+        def read_ahead(i):
+            # The next run of small members is read on a disk thread while this one is sent
+            if i < len(runs) and runs[i][0][0].size <= INLINE_SIZE:
+                return loop.run_in_executor(self.server.disk_executor, self._read_run, store, runs[i])
+            return None
+
+        with Transfer("download", "bundle", self.conn.address, self.server.metrics, length) as transfer:
+            transfer.method = "bundle"
+            ahead = read_ahead(0)
+            try:
+                for i, run in enumerate(runs):
+                    reading, ahead = ahead, read_ahead(i + 1)
+                    if reading:
+                        data = await reading
+                        await self.conn.sendall(data)
+                        transfer.bytes += len(data)
+                        continue
+                    meta, header = run[0]
+                    try:
+                        f = open(store.path(meta.name), "rb")
+                    except FileNotFoundError:
+                        raise ProtocolError(f"{meta.name} was deleted while it was being sent") from None
+                    with f:
+                        if os.fstat(f.fileno()).st_size != meta.size:
+                            raise ProtocolError(f"{meta.name} changed while it was being sent")
+                        await self.conn.sendall(header)
+                        sent, _ = await self.conn.sendfile(f, 0, meta.size)
+                        if sent < meta.size:
+                            raise ProtocolError(f"{meta.name} shrank while it was being sent")
+                        await self.conn.sendall(padding(meta.size))
+                    transfer.bytes += member_length(header, meta.size)
+            finally:
+                if ahead:
+                    ahead.cancel()
+            await self.conn.sendall(END_OF_ARCHIVE)
+            transfer.bytes = length
+            transfer.finish()
+
+    @staticmethod
+    def _read_run(store, run):
+        """Return the archive bytes of a run of small members: headers, contents and padding."""
+        out = bytearray()
+        for meta, header in run:
+            try:
+                with open(store.path(meta.name), "rb") as f:
+                    data = f.read(meta.size + 1)
+            except FileNotFoundError:
+                raise ProtocolError(f"{meta.name} was deleted while it was being sent") from None
+            if len(data) != meta.size:
+                raise ProtocolError(f"{meta.name} changed while it was being sent")
+            out += header
+            out += data
+            out += padding(meta.size)
+        return out
@@ -0,0 +1,114 @@
+import asyncio  # Import asyncio to pace transfers without blocking the event loop
+import time  # Import time for the token bucket clock
+
+SMALL_TRANSFER = 1024 * 1024  # Requests moving at most this many bytes take the priority lane
+SHAPED_CHUNK = 128 * 1024  # Bytes sent per turn by a transfer that is being shaped
+BURST_SECONDS = 0.5  # Seconds of traffic a bucket lets through at once after being idle
+
+
+class TokenBucket:
+    """Pace a byte stream to rate bytes per second.
+
+    Bulk transfers wait in a first-come first-served queue for the bucket to be out
+    of debt before each chunk, so transfers sharing a bucket take turns and split
+    its rate evenly. Priority traffic is charged without waiting; the debt it leaves
+    is paid by the bulk transfers that come after it.
+    """
+
+    def __init__(self, rate, burst=None):
+        # Sustained rate in bytes per second
+        self.rate = rate
+        # Most tokens that can build up while the bucket is idle
+        self.burst = burst or max(rate * BURST_SECONDS, SHAPED_CHUNK)
+        # Bytes that may be sent right now; negative while in debt
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # Queue of bulk transfers waiting for their turn, created on the event loop
+        self._turn = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, n):
+        """Take n bytes without waiting."""
+        self._refill()
+        self.tokens -= n
+
+    async def consume(self, n):
+        """Wait for this transfer's turn and for the bucket to be out of debt, then take n bytes."""
+        if self._turn is None:
+            # asyncio.Lock wakes its waiters in the order they arrived
+            self._turn = asyncio.Lock()
+        async with self._turn:
+            self._refill()
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+                self._refill()
+            self.tokens -= n
+
+
+class Throttle:
+    """The buckets one connection's traffic is paced by, per direction."""
+
+    def __init__(self, send_buckets, recv_buckets):
+        self.send_buckets = send_buckets
+        self.recv_buckets = recv_buckets
+        # Set while the current request belongs in the priority lane
+        self.priority = False
+
+    async def sent(self, n):
+        """Account for n bytes about to be sent, waiting if they are over the limits."""
+        await self._take(self.send_buckets, n)
+
+    async def received(self, n):
+        """Account for n bytes just received, waiting if they are over the limits."""
+        await self._take(self.recv_buckets, n)
+
+    async def _take(self, buckets, n):
+        for bucket in buckets:
+            if self.priority:
+                bucket.charge(n)
+            else:
+                await bucket.consume(n)
+
+
+class Shaper:
+    """Bandwidth limits for the whole server, per client address and per connection.
+
+    Each limit is in bytes per second, None meaning unlimited, and applies to each
+    direction separately: uploads and downloads have buckets of their own.
+    """
+
+    def __init__(self, rate=None, ip_rate=None, client_rate=None):
+        self.rate = rate
+        self.ip_rate = ip_rate
+        self.client_rate = client_rate
+        # Server-wide buckets for sending and receiving
+        self._global = (TokenBucket(rate), TokenBucket(rate)) if rate else None
+        # Per-address buckets and the number of connections using them
+        self._ips = {}
+
+    def open(self, address):
+        """Return the Throttle for a new connection from address, None if nothing is limited."""
+        if not (self.rate or self.ip_rate or self.client_rate):
+            return None
+        pairs = []
+        if self.client_rate:
+            pairs.append((TokenBucket(self.client_rate), TokenBucket(self.client_rate)))
+        if self.ip_rate:
+            entry = self._ips.setdefault(address[0], [(TokenBucket(self.ip_rate), TokenBucket(self.ip_rate)), 0])
+            entry[1] += 1
+            pairs.append(entry[0])
+        if self._global:
+            pairs.append(self._global)
+        return Throttle([send for send, _ in pairs], [recv for _, recv in pairs])
+
+    def close(self, address):
+        """Release the per-address buckets of a connection opened with open()."""
+        entry = self._ips.get(address[0])
+        if entry:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._ips[address[0]]
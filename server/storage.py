@@ -0,0 +1,359 @@
+import errno  # Import errno to report stored files that don't exist
+import hashlib  # Import hashlib to hash contents that arrive whole
+import os  # Import os module for file system operations
+import tempfile  # Import tempfile to name files written straight from memory
+import threading  # Import threading to serialise changes to the blob store
+import time  # Import time to date stored files
+
+if os.name != "nt":
+    import fcntl  # Import fcntl to serialise changes to the blob store across processes
+else:
+    fcntl = None
+
+from common.hashing import file_sha256
+from common.paths import SEPARATOR, clean_path
+
+from .catalog import Catalog, subtree
+from .index import FileIndex
+
+PARTIAL_DIR = ".partial"  # Subdirectory holding uploads that have not finished yet
+BLOB_DIR = ".blobs"  # Subdirectory holding file contents named after their SHA-256
+LOCK_FILE = ".lock"  # File in the blob directory locked while the blob store changes
+CATALOG_FILE = ".catalog.sqlite"  # Database naming the stored files and folders
+# Entries of the directory that belong to the store itself rather than being stored files
+INTERNAL_NAMES = {PARTIAL_DIR, BLOB_DIR, CATALOG_FILE, CATALOG_FILE + "-wal", CATALOG_FILE + "-shm",
+                  CATALOG_FILE + "-journal"}
+HEX_DIGITS = "0123456789abcdef"  # Characters of a hash in the blob store
+PARTIAL_MAX_AGE = 24 * 60 * 60  # Seconds an unfinished upload nobody writes to is kept for resuming
+
+
+class ChecksumError(Exception):
+    """Raised when an upload does not match the hash the client announced."""
+
+
+class PathConflict(Exception):
+    """Raised when a file would be stored where a folder is, or the other way round."""
+
+
+class StoreLock:
+    """Lock held while the blob store changes, by threads and by processes sharing the directory.
+
+    Threads of one process take a threading.Lock; where fcntl is available the
+    holder also takes an flock on a file in the blob directory, so server
+    processes started by the supervisor never link and collect a blob at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Opened on first use, in the process that uses it
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if fcntl:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "ab")
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except OSError:
+                self._lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class FileStore:
+    """Files and folders served to clients, backed by a content-addressed blob store.
+
+    The contents of every stored file are a blob under BLOB_DIR named after their
+    SHA-256 and sharded two directory levels deep by its first four hex digits, so
+    no directory holds more than a few hundred entries however many files are
+    stored. Identical files share one blob, and a client can store a file the server
+    already has by sending only its hash. The catalog maps each stored path, e.g.
+    "reports/june.xlsx", to its blob; folders exist as long as something is stored
+    in them, or once created with mkdir().
+    """
+
+    def __init__(self, root):
+        # Directory that holds the store
+        self.root = root
+        # Directory that holds unfinished uploads until they are complete
+        self.partial_root = os.path.join(root, PARTIAL_DIR)
+        # Directory that holds the blobs
+        self.blob_root = os.path.join(root, BLOB_DIR)
+        # Create the directories if they don't exist
+        os.makedirs(self.partial_root, exist_ok=True)
+        os.makedirs(self.blob_root, exist_ok=True)
+        # Serialises changes to the catalog and the blobs
+        self._lock = StoreLock(os.path.join(self.blob_root, LOCK_FILE))
+        # Paths of the stored files and folders, shared with the other processes serving the store
+        self.catalog = Catalog(os.path.join(root, CATALOG_FILE))
+        # Metadata of the stored files, so listings never query the catalog
+        self.index = FileIndex(self.catalog)
+
+    def close(self):
+        self.catalog.close()
+
+    def path(self, name):
+        """Return the path of the blob holding the contents of a stored file."""
+        meta = self.index.get(name)
+        if meta is None:
+            raise FileNotFoundError(errno.ENOENT, "No such stored file", name)
+        return self.blob_path(meta.sha256)
+
+    def exists(self, name):
+        """Check whether a file is stored under the given name."""
+        return name in self.index
+
+    def size(self, name):
+        """Return the size of a stored file in bytes."""
+        return self.index.get(name).size
+
+    def sha256(self, name):
+        """Return the content hash of a stored file, None if it is not stored."""
+        meta = self.index.get(name)
+        return meta.sha256 if meta else None
+
+    def list_names(self):
+        """Return the paths of all stored files."""
+        return list(self.index.names)
+
+    def partial_path(self, name):
+        """Return the path an unfinished upload of name is written to."""
+        # Unfinished uploads sit side by side, whatever folder they are for
+        return os.path.join(self.partial_root, name.replace("%", "%25").replace(SEPARATOR, "%2F"))
+
+    def partial_size(self, name):
+        """Return how many bytes of an unfinished upload are stored, 0 if there is none."""
+        try:
+            return os.path.getsize(self.partial_path(name))
+        except OSError:
+            return 0
+
+    def delta_path(self, name):
+        """Return the path a delta upload of name is rebuilt in."""
+        directory, base = os.path.split(self.partial_path(name))
+        return os.path.join(directory, f".{base}.delta")
+
+    def sweep_partials(self, max_age=PARTIAL_MAX_AGE):
+        """Remove unfinished uploads nothing was written to for max_age seconds; returns how many went."""
+        cutoff = time.time() - max_age
+        removed = 0
+        with os.scandir(self.partial_root) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    # Finished or swept by another process meanwhile
+                    continue
+        return removed
+
+    def blob_path(self, sha256):
+        """Return the path of the blob holding the contents with the given hash."""
+        return os.path.join(self.blob_root, sha256[:2], sha256[2:4], sha256)
+
+    def commit(self, name, sha256=None):
+        """Move a finished upload from the partial directory into the blob store.
+
+        If sha256 is given and the upload doesn't match it, the upload is dropped and
+        ChecksumError is raised. Returns the hash of the stored contents.
+        """
+        return self.commit_file(self.partial_path(name), name, sha256)
+
+    def commit_file(self, partial, name, sha256=None, digest=None, mtime=None):
+        """Move the file at partial into the blob store and store it as name.
+
+        digest is the SHA-256 of the file if the caller computed it while writing it.
+        Raises PathConflict, dropping the file, if name is a folder or inside a file.
+        """
+        digest = digest or file_sha256(partial)
+        if sha256 and digest != sha256:
+            os.remove(partial)
+            raise ChecksumError(f"{name} does not match its SHA-256, upload it again")
+        with self._lock:
+            try:
+                self._check_free(name)
+            except PathConflict:
+                os.remove(partial)
+                raise
+            blob = self.blob_path(digest)
+            if os.path.exists(blob):
+                # The same contents are stored already, keep a single copy
+                os.remove(partial)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(partial, blob)
+            self._link(name, digest, os.path.getsize(blob), mtime)
+        return digest
+
+    def store_bytes(self, name, data):
+        """Store data, e.g. a small file unpacked from a bundle, as name; returns its hash."""
+        fd, temp = tempfile.mkstemp(prefix=".bundle-", dir=self.partial_root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except OSError:
+            os.remove(temp)
+            raise
+        return self.commit_file(temp, name, digest=hashlib.sha256(data).hexdigest())
+
+    def link(self, name, sha256):
+        """Store name as the blob with the given hash, returning False if there is no such blob."""
+        if not isinstance(sha256, str) or len(sha256) != 64 or not all(c in HEX_DIGITS for c in sha256):
+            return False
+        with self._lock:
+            blob = self.blob_path(sha256)
+            if not os.path.isfile(blob):
+                return False
+            self._check_free(name)
+            self._link(name, sha256, os.path.getsize(blob))
+        return True
+
+    def _check_free(self, name, folder=False):
+        """Raise PathConflict unless a file, or with folder a folder, can be stored as name."""
+        above = self.catalog.file_above(name)
+        if above:
+            raise PathConflict(f"{above} is a file, not a folder")
+        if folder and self.catalog.file(name):
+            raise PathConflict(f"{name} is a file")
+        if not folder and self.catalog.is_folder(name):
+            raise PathConflict(f"{name} is a folder")
+
+    def _link(self, name, sha256, size, mtime=None):
+        """Point name at a blob; the caller holds the lock."""
+        previous = self.catalog.file(name)
+        mtime = time.time() if mtime is None else mtime
+        self.catalog.put(name, sha256, size, mtime)
+        self.index.update(name, sha256, size, mtime)
+        if previous and previous[1] != sha256:
+            self._collect(previous[1])
+
+    def _collect(self, sha256):
+        """Delete a blob once no stored file has its contents any more."""
+        if self.catalog.links(sha256):
+            return
+        blob = self.blob_path(sha256)
+        try:
+            os.remove(blob)
+        except FileNotFoundError:
+            return
+        # Drop the shard directories once they are empty
+        for directory in (os.path.dirname(blob), os.path.dirname(os.path.dirname(blob))):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+
+    def delete(self, name):
+        """Delete a stored file, or a folder that holds no files."""
+        with self._lock:
+            row = self.catalog.file(name)
+            if row is None:
+                self._delete_folder(name)
+                return
+            self.catalog.remove(name)
+            self.index.remove(name)
+            self._collect(row[1])
+
+    def _delete_folder(self, name):
+        if not self.catalog.is_folder(name):
+            raise FileNotFoundError(errno.ENOENT, "No such stored file", name)
+        if self.index.page(subtree(name)[0], limit=0)[1]:
+            raise PathConflict(f"{name} is not empty")
+        self.catalog.remove_folder(name)
+        self.index.remove_folder(name)
+
+    def mkdir(self, name):
+        """Create a folder and the folders above it, which is no error if they exist already."""
+        parts = name.split(SEPARATOR)
+        with self._lock:
+            self._check_free(name, folder=True)
+            # Created on their own, the folders above stay when this one is deleted
+            for depth in range(1, len(parts) + 1):
+                folder = SEPARATOR.join(parts[:depth])
+                self.catalog.add_folder(folder)
+                self.index.add_folder(folder)
+
+    def migrate(self, progress=None):
+        """Bring a store an older server wrote, or files copied in by hand, into the blob store.
+
+        Blobs sharded a single level deep move to their place two levels deep, and
+        every file found in the directory itself moves into the blob store under its
+        path from the root, keeping its modification time; empty directories become
+        folders. progress, if given, is called with the path of every file moved in
+        and an error message if it could not be. Returns how many files moved in.
+        """
+        self._reshard()
+        hashes = None
+        migrated = 0
+        directories = []
+        for directory, folders, files in os.walk(self.root):
+            if directory == self.root:
+                # Leave the store's own files alone
+                folders[:] = [name for name in folders if name not in INTERNAL_NAMES]
+                files = [name for name in files if name not in INTERNAL_NAMES]
+            else:
+                directories.append(directory)
+            for name in files:
+                local = os.path.join(directory, name)
+                relative = os.path.relpath(local, self.root)
+                try:
+                    path = clean_path(relative.replace(os.sep, SEPARATOR))
+                    stat = os.lstat(local)
+                    if not os.path.isfile(local) or os.path.islink(local):
+                        raise ValueError("not a regular file")
+                    with self._lock:
+                        # Checked before committing, which would drop the file on a conflict
+                        self._check_free(path)
+                    digest = None
+                    if stat.st_nlink > 1:
+                        # Older servers kept every file as a hard link to its blob, no need to hash it again
+                        if hashes is None:
+                            hashes = self._blob_hashes()
+                        digest = hashes.get(stat.st_ino)
+                    self.commit_file(local, path, digest=digest, mtime=stat.st_mtime)
+                except (OSError, ValueError, PathConflict) as e:
+                    if progress:
+                        progress(relative, str(e))
+                    continue
+                migrated += 1
+                if progress:
+                    progress(path, None)
+        # Deepest first, so a directory is empty once everything below it moved in
+        for directory in reversed(directories):
+            try:
+                if not os.listdir(directory):
+                    self.mkdir(clean_path(os.path.relpath(directory, self.root).replace(os.sep, SEPARATOR)))
+                    os.rmdir(directory)
+            except (OSError, ValueError, PathConflict):
+                pass
+        return migrated
+
+    def _reshard(self):
+        """Move blobs sharded a single level deep, as older servers kept them, to their place."""
+        with self._lock, os.scandir(self.blob_root) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if len(entry.name) == 64 and entry.is_file() and all(c in HEX_DIGITS for c in entry.name):
+                            blob = self.blob_path(entry.name)
+                            os.makedirs(os.path.dirname(blob), exist_ok=True)
+                            os.replace(entry.path, blob)
+
+    def _blob_hashes(self):
+        """Return the hash of every blob keyed by its inode number."""
+        hashes = {}
+        for directory, _, blobs in os.walk(self.blob_root):
+            for name in blobs:
+                if len(name) == 64:
+                    hashes[os.stat(os.path.join(directory, name)).st_ino] = name
+        return hashes
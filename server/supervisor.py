@@ -0,0 +1,371 @@
+import asyncio  # Import asyncio to watch the worker processes from a single thread
+import logging  # Import logging to report worker starts, exits and reloads
+import multiprocessing  # Import multiprocessing to start the worker processes
+import os  # Import os module to count the CPU cores
+import signal  # Import signal to reload on SIGHUP and stop on SIGTERM
+import socket  # Import socket module to hold the port the workers listen on
+import threading  # Import threading to read the worker pipes without blocking the event loop
+
+from .engine import DEFAULT_SERVER_HOST, DEFAULT_SERVER_PORT, LISTEN_BACKLOG
+from .metrics import PREFIX, bind_metrics, merge_metrics, serve_metrics
+
+DRAIN_TIMEOUT = 30  # Seconds a replaced worker may spend finishing its requests
+READY_TIMEOUT = 30  # Seconds a new worker may take to start listening
+RESTART_DELAY = 1  # Seconds before a worker that died is started again
+INDEX_POLL_INTERVAL = 1  # Seconds between a worker's checks of the directory for changes made by hand
+METRICS_PUSH_INTERVAL = 1  # Seconds between the metrics each worker sends to the supervisor
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_count():
+    """Return the number of CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class Pipe:
+    """One end of a worker's pipe to the supervisor, read on a thread of its own.
+
+    Every message is handed to on_message(message) on the event loop, followed by
+    None once the other end is gone. send() may be called from any thread.
+    """
+
+    def __init__(self, conn, loop, on_message):
+        self.conn = conn
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._read, args=(loop, on_message), daemon=True)
+        self._thread.start()
+
+    def _read(self, loop, on_message):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                message = None
+            try:
+                loop.call_soon_threadsafe(on_message, message)
+            except RuntimeError:
+                # The event loop is closed already
+                return
+            if message is None:
+                return
+
+    def send(self, *message):
+        """Send a message, returning False if the other end is gone."""
+        try:
+            with self._lock:
+                self.conn.send(message)
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def close(self):
+        self.conn.close()
+
+
+def run_worker(factory, number, address, sock, conn, push_metrics):
+    """Entry point of a worker process: serve clients with factory() until told to stop."""
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s [worker {number}] %(message)s")
+    # Ctrl+C reaches the whole process group; the supervisor decides how the workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = factory()
+    # Only the first worker migrates files copied in by hand, the others hear about them
+    server.migrate = number == 0
+    server.store.index.poll_interval = INDEX_POLL_INTERVAL
+    if sock is not None:
+        sock.setblocking(False)
+        server.listen_socket = sock
+        server.port = sock.getsockname()[1]
+    else:
+        # Bind the port the supervisor holds, which it resolved if it was 0
+        server.host, server.port = address
+        server.reuse_port = True
+        server.bind()
+    asyncio.run(Worker(server, conn, push_metrics).run())
+
+
+class Worker:
+    """Runs a FileServer in a worker process and keeps it in touch with the supervisor."""
+
+    def __init__(self, server, conn, push_metrics):
+        self.server = server
+        self.conn = conn
+        self.push_metrics = push_metrics
+        self.pipe = None
+        # Set on the event loop thread while applying a change another worker made
+        self._applying = threading.local()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        serving = asyncio.create_task(self.server.serve())
+        # serve() is listening once it first yields
+        await asyncio.sleep(0)
+        if serving.done():
+            await serving
+            return
+        index = self.server.store.index
+        index.listeners.append(self.changed)
+        self.pipe = Pipe(self.conn, loop, self.received)
+        self.pipe.send("ready", os.getpid())
+        pushing = asyncio.create_task(self.push()) if self.push_metrics else None
+        try:
+            await serving
+        finally:
+            index.listeners.remove(self.changed)
+            if pushing:
+                pushing.cancel()
+            self.pipe.close()
+
+    def changed(self, name):
+        """Index listener: tell the other workers about a file this one changed."""
+        if name is None or getattr(self._applying, "name", None) == name:
+            return
+        self.pipe.send("changed", name)
+
+    def received(self, message):
+        if message is None:
+            # The supervisor is gone, there is nobody left to stop us gracefully
+            self.server.stop()
+            return
+        kind, *args = message
+        if kind == "changed":
+            name, = args
+            self._applying.name = name
+            try:
+                self.server.store.index.refresh(name)
+            finally:
+                self._applying.name = None
+        elif kind == "drain":
+            asyncio.create_task(self.server.drain(*args))
+        elif kind == "stop":
+            self.server.stop()
+
+    async def push(self):
+        while True:
+            self.pipe.send("metrics", self.server.render_metrics())
+            await asyncio.sleep(METRICS_PUSH_INTERVAL)
+
+
+class WorkerProcess:
+    """The supervisor's view of one worker process."""
+
+    def __init__(self, number, process, pipe):
+        self.number = number
+        self.process = process
+        self.pipe = pipe
+        # Set once the worker listens for clients
+        self.ready = asyncio.Event()
+        # Latest Prometheus text the worker sent
+        self.metrics = ""
+
+
+class Supervisor:
+    """Serve one port from several processes, so the server uses every CPU core.
+
+    Each worker process runs a FileServer of its own, built by the picklable
+    factory. Where the platform has SO_REUSEPORT every worker binds the port
+    itself and the kernel spreads new connections among them; elsewhere, or
+    with reuse_port=False, the supervisor binds one listening socket that all
+    workers accept from.
+
+    The workers serve the same directory. A worker that uploads or deletes a
+    file tells the supervisor, which passes the news on to the others so their
+    indexes and caches stay current without rescanning. With metrics_port set,
+    the supervisor serves the metrics of all workers merged into one page.
+
+    SIGHUP reloads gracefully: a fresh set of workers, running the code as it is
+    on disk now, starts listening before the old ones stop accepting and get
+    DRAIN_TIMEOUT seconds to finish their requests. SIGTERM and Ctrl+C stop
+    everything. A worker that dies is started again after RESTART_DELAY seconds.
+    """
+
+    def __init__(self, factory, processes=None, host=DEFAULT_SERVER_HOST, port=DEFAULT_SERVER_PORT,
+                 backlog=LISTEN_BACKLOG, reuse_port=None, metrics_port=None, drain_timeout=DRAIN_TIMEOUT):
+        self.factory = factory
+        self.processes = processes or cpu_count()
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        if reuse_port is None or not hasattr(socket, "SO_REUSEPORT"):
+            # Without the option, e.g. on Windows, the workers share one socket
+            reuse_port = hasattr(socket, "SO_REUSEPORT")
+        self.reuse_port = reuse_port
+        self.metrics_port = metrics_port
+        self.drain_timeout = drain_timeout
+        # Workers serving now, and replaced ones still finishing their requests
+        self.workers = []
+        self.retiring = []
+        # Workers started again after dying, and reloads done
+        self.restarts = 0
+        self.reloads = 0
+        # Listening socket shared by the workers, or the bound socket reserving the port for SO_REUSEPORT
+        self.socket = None
+        self._context = multiprocessing.get_context("spawn")
+        self._loop = None
+        self._stopping = None
+        self._reloading = None
+        # Numbers given to the workers, counting up across reloads
+        self._numbers = 0
+
+    def bind(self):
+        """Create the socket that holds the port for the workers."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if os.name != "nt":
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            if not self.reuse_port:
+                sock.listen(self.backlog)
+        except OSError:
+            sock.close()
+            raise
+        # A socket that is bound but not listening keeps the port without being handed connections
+        self.socket = sock
+        self.port = sock.getsockname()[1]
+
+    def run(self):
+        """Run the workers until SIGTERM or Ctrl+C."""
+        asyncio.run(self.supervise())
+
+    async def supervise(self):
+        if self.socket is None:
+            self.bind()
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        if hasattr(signal, "SIGHUP"):
+            self._loop.add_signal_handler(signal.SIGHUP, self.reload)
+            self._loop.add_signal_handler(signal.SIGTERM, self._stopping.set)
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_socket = bind_metrics(self.metrics_port)
+            self.metrics_port = metrics_socket.getsockname()[1]
+            metrics_server = await serve_metrics(self.render_metrics, metrics_socket)
+            logger.info("Metrics on http://127.0.0.1:%s/metrics", self.metrics_port)
+        mode = "SO_REUSEPORT" if self.reuse_port else "a shared socket"
+        logger.info("Starting %d workers on %s:%s with %s", self.processes, self.host, self.port, mode)
+        try:
+            self.workers = [self.spawn() for _ in range(self.processes)]
+            await self._stopping.wait()
+        finally:
+            if metrics_server:
+                metrics_server.close()
+            if self._reloading:
+                self._reloading.cancel()
+            await self.stop_workers(self.workers + self.retiring)
+            self.socket.close()
+            logger.info("Server stopped.")
+
+    def stop(self):
+        """Ask the supervisor to stop its workers; safe from any thread."""
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def spawn(self):
+        """Start one worker process."""
+        number = self._numbers
+        self._numbers += 1
+        parent_conn, child_conn = self._context.Pipe()
+        shared = None if self.reuse_port else self.socket
+        process = self._context.Process(target=run_worker, name=f"worker-{number}",
+                                        args=(self.factory, number, (self.host, self.port), shared, child_conn,
+                                              self.metrics_port is not None))
+        process.start()
+        child_conn.close()
+        worker = WorkerProcess(number, process, None)
+        worker.pipe = Pipe(parent_conn, self._loop, lambda message: self.received(worker, message))
+        return worker
+
+    def received(self, worker, message):
+        if message is None:
+            self._loop.create_task(self.exited(worker))
+            return
+        kind, *args = message
+        if kind == "ready":
+            logger.info("Worker %d (pid %d) is listening.", worker.number, args[0])
+            worker.ready.set()
+        elif kind == "changed":
+            for other in self.workers + self.retiring:
+                if other is not worker:
+                    other.pipe.send(kind, *args)
+        elif kind == "metrics":
+            worker.metrics = args[0]
+
+    async def exited(self, worker):
+        """Clean up after a worker whose pipe closed, starting a replacement if it died."""
+        # Nobody should wait for a worker that is gone to become ready
+        worker.ready.set()
+        worker.pipe.close()
+        await self._loop.run_in_executor(None, worker.process.join)
+        if worker in self.retiring:
+            self.retiring.remove(worker)
+            logger.info("Worker %d finished.", worker.number)
+            return
+        if worker not in self.workers or self._stopping.is_set():
+            return
+        logger.error("Worker %d exited with code %s, starting another in %s seconds.", worker.number,
+                     worker.process.exitcode, RESTART_DELAY)
+        self.restarts += 1
+        self._loop.call_later(RESTART_DELAY, self.replace, worker)
+
+    def replace(self, worker):
+        if worker in self.workers and not self._stopping.is_set():
+            self.workers[self.workers.index(worker)] = self.spawn()
+
+    def reload(self):
+        """Replace every worker without turning clients away; safe to call repeatedly."""
+        if self._reloading and not self._reloading.done():
+            logger.info("Reload already in progress.")
+            return
+        self._reloading = self._loop.create_task(self._reload())
+
+    async def _reload(self):
+        logger.info("Reloading: starting %d new workers.", self.processes)
+        fresh = [self.spawn() for _ in range(self.processes)]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(worker.ready.wait() for worker in fresh)), READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        if not all(worker.process.is_alive() and worker.ready.is_set() for worker in fresh):
+            # Keep serving with the old workers rather than with a broken set
+            logger.error("Reload failed: the new workers did not start, keeping the old ones.")
+            await self.stop_workers(fresh)
+            return
+        old, self.workers = self.workers, fresh
+        self.retiring.extend(old)
+        for worker in old:
+            worker.pipe.send("drain", self.drain_timeout)
+        self.reloads += 1
+        logger.info("Reloaded, %d old workers are finishing their requests.", len(old))
+
+    async def stop_workers(self, workers):
+        """Stop workers and wait for them to exit, killing the ones that won't."""
+        for worker in workers:
+            worker.pipe.send("stop")
+        for worker in workers:
+            await self._loop.run_in_executor(None, worker.process.join, self.drain_timeout)
+            if worker.process.is_alive():
+                logger.error("Worker %d did not stop, killing it.", worker.number)
+                worker.process.kill()
+                await self._loop.run_in_executor(None, worker.process.join)
+            for group in (self.workers, self.retiring):
+                if worker in group:
+                    group.remove(worker)
+
+    def render_metrics(self):
+        """Return the metrics of every worker merged, plus the supervisor's own."""
+        text = merge_metrics(worker.metrics for worker in self.workers + self.retiring)
+        lines = []
+        for name, kind, help_text, value in (
+                ("processes", "gauge", "Worker processes serving clients.", len(self.workers)),
+                ("processes_retiring", "gauge", "Replaced worker processes finishing their requests.",
+                 len(self.retiring)),
+                ("process_restarts_total", "counter", "Worker processes started again after dying.", self.restarts),
+                ("reloads_total", "counter", "Graceful reloads completed.", self.reloads)):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            lines.append(f"{PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n" + text
@@ -0,0 +1,54 @@
+import logging  # Import logging to report transfer rates
+import time  # Import time to measure transfer durations
+
+logger = logging.getLogger(__name__)
+
+
+class Transfer:
+    """Measure the duration and rate of a single file transfer.
+
+    Used as a context manager, the transfer is listed in the metrics as running
+    until the with block ends; bytes is kept up to date while it runs.
+    """
+
+    def __init__(self, direction, filename, address, metrics=None, total=None):
+        # "upload" or "download"
+        self.direction = direction
+        # Name of the transferred file
+        self.filename = filename
+        # Address of the client on the other end
+        self.address = address
+        # Metrics the finished transfer is recorded in, if any
+        self.metrics = metrics
+        # Number of bytes moved so far, and expected in total if known
+        self.bytes = 0
+        self.total = total
+        # How the bytes were moved, e.g. "sendfile" or "buffered"
+        self.method = None
+        # Start time of the transfer
+        self.started = time.perf_counter()
+        # Duration in seconds, set by finish()
+        self.elapsed = None
+
+    def __enter__(self):
+        if self.metrics:
+            self.metrics.transfer_started(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.metrics:
+            self.metrics.transfer_ended(self)
+
+    @property
+    def rate(self):
+        """Return the transfer rate in bytes per second."""
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def finish(self):
+        """Stop the clock, log the transfer rate and record it in the metrics."""
+        self.elapsed = time.perf_counter() - self.started
+        if self.metrics:
+            self.metrics.transfer(self)
+        logger.info("%s %s %s: %d bytes in %.3fs, %.0f bytes/s via %s", self.address, self.direction,
+                    self.filename, self.bytes, self.elapsed, self.rate, self.method)
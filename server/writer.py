@@ -0,0 +1,219 @@
+import asyncio  # Import asyncio to overlap disk writes with network reads
+import collections  # Import collections for the queue of pending writes
+import ctypes  # Import ctypes to reserve disk space with Linux fallocate(), which os does not expose
+import os  # Import os module for low-level file operations
+import threading  # Import threading to serialise seek+write where pwrite is missing
+
+from common.compression import BLOCK, Decoder, block_length
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # Bytes received into a buffer before it is written out
+WRITE_DEPTH = 4  # Buffers per upload, so up to this many writes can be in flight
+
+
+FALLOC_FL_KEEP_SIZE = 1  # fallocate() mode reserving space without changing the file size
+
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate64
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    # Not Linux, or no C library to load it from
+    _fallocate = None
+
+
+def preallocate(fd, size):
+    """Reserve size bytes of disk space for a file, where the platform supports it.
+
+    The file keeps its size, so after a crash it still tells how much of an upload
+    arrived. posix_fallocate() would extend it with zeros, so platforms without
+    Linux fallocate() skip preallocation.
+    """
+    if size <= 0 or _fallocate is None:
+        return
+    # Some file systems can't preallocate; the writes will still extend the file
+    _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size)
+
+
+class FileWriter:
+    """Write received chunks to a file on worker threads, at explicit offsets.
+
+    Network code fills a buffer from buffer(), hands it to submit() and carries on
+    receiving into the next one while the disk write runs on the executor.
+    """
+
+    def __init__(self, path, size, chunk_size=DEFAULT_CHUNK_SIZE, executor=None, depth=WRITE_DEPTH, offset=0):
+        # Destination file and its declared final size
+        self.path = path
+        self.size = size
+        # Bytes before offset are kept from an earlier, interrupted upload
+        self.offset = offset
+        # Size of each reusable receive buffer
+        self.chunk_size = chunk_size
+        # Executor running the blocking writes, None means the loop's default
+        self.executor = executor
+        # Maximum number of buffers, and so of writes in flight
+        self.depth = depth
+        # Buffers ready to be filled again
+        self.free = []
+        # Number of buffers created so far
+        self.allocated = 0
+        # Writes in submission order, as (future, buffer) pairs
+        self.pending = collections.deque()
+        # File descriptor, set by open()
+        self.fd = None
+        # Used instead of pwrite on platforms that don't have it
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+
+    async def open(self):
+        """Create the file and preallocate its declared size."""
+        self.fd = await self._loop.run_in_executor(self.executor, self._open)
+
+    def _open(self):
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        fd = os.open(self.path, flags, 0o666)
+        try:
+            # Drop anything past the resume offset, then reserve space for the rest of the file
+            os.ftruncate(fd, self.offset)
+            preallocate(fd, self.size)
+        except OSError:
+            os.close(fd)
+            raise
+        return fd
+
+    async def buffer(self):
+        """Return an empty receive buffer, waiting for a write to finish if all are busy."""
+        if self.free:
+            return self.free.pop()
+        if self.allocated < self.depth:
+            self.allocated += 1
+            return bytearray(self.chunk_size)
+        # Reuse the buffer of the oldest write once it has reached the disk
+        future, buf = self.pending.popleft()
+        await future
+        return buf
+
+    def submit(self, buf, length, offset):
+        """Write the first length bytes of buf at offset in the background."""
+        view = memoryview(buf)[:length]
+        future = self._loop.run_in_executor(self.executor, self.write, view, offset)
+        self.pending.append((future, buf))
+
+    def write(self, data, offset):
+        """Write data at offset now, blocking; for code already running on the executor."""
+        view = memoryview(data)
+        if hasattr(os, "pwrite"):
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self._lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(self.fd, view):]
+
+    async def close(self, length=None):
+        """Wait for every pending write and close the file.
+
+        If length is given the file is truncated to it, dropping preallocated space
+        that was never written, e.g. after an interrupted upload.
+        """
+        error = None
+        while self.pending:
+            future, buf = self.pending.popleft()
+            try:
+                await future
+            except Exception as e:
+                error = error or e
+            self.free.append(buf)
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            if length is not None and length < self.size:
+                os.ftruncate(fd, length)
+            os.close(fd)
+        if error:
+            raise error
+
+
+async def receive_file(conn, path, size, chunk_size=DEFAULT_CHUNK_SIZE, executor=None, offset=0, transfer=None):
+    """Receive size bytes from conn into the file at path, starting at offset.
+
+    Returns the number of bytes received, which is less than size if the client
+    disconnected early. The file is left holding offset plus the received bytes.
+    The bytes of transfer, if given, follow the progress.
+    """
+    writer = FileWriter(path, offset + size, chunk_size, executor, offset=offset)
+    await writer.open()
+    received = 0
+    try:
+        while received < size:
+            buf = await writer.buffer()
+            # Fill the whole buffer before writing it, so each write is one large chunk
+            view = memoryview(buf)[:min(size - received, len(buf))]
+            filled = 0
+            while filled < len(view):
+                n = await conn.recv_into(view[filled:])
+                if not n:
+                    break
+                filled += n
+            if filled:
+                writer.submit(buf, filled, offset + received)
+                received += filled
+                if transfer:
+                    transfer.bytes = received
+            else:
+                writer.free.append(buf)
+            if filled < len(view):
+                # The client disconnected
+                break
+    finally:
+        await writer.close(offset + received)
+    return received
+
+
+async def receive_compressed(conn, path, size, codec, executor=None, offset=0, transfer=None):
+    """Receive a compressed body that decodes to size bytes into the file at path, starting at offset.
+
+    Blocks are decompressed and written on executor while the next one is received.
+    Returns the number of decoded bytes written, less than size if the client
+    disconnected early.
+    """
+    writer = FileWriter(path, offset + size, 0, executor, offset=offset)
+    await writer.open()
+    decoder = Decoder(codec, size)
+    loop = asyncio.get_running_loop()
+
+    def write(block):
+        # Decoding is stateful, so at most one block is in flight at a time
+        position = offset + size - decoder.remaining
+        data = decoder.decode(block)
+        writer.write(data, position)
+        return len(data)
+
+    received = 0
+    pending = None
+    try:
+        while True:
+            try:
+                length = block_length(await conn.recv_exactly(BLOCK.size))
+                block = await conn.recv_exactly(length) if length else None
+            except ConnectionError:
+                # The client disconnected, keep what was decoded
+                break
+            if pending:
+                future, pending = pending, None
+                received += await future
+                if transfer:
+                    transfer.bytes = received
+            if block is None:
+                decoder.finish()
+                break
+            pending = loop.run_in_executor(executor, write, block)
+    finally:
+        try:
+            if pending:
+                received += await pending
+        finally:
+            # Close the file even when the last block fails to decode or write
+            await writer.close(offset + received)
+    return received
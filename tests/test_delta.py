@@ -0,0 +1,71 @@
+import io  # Import io to compute signatures of in-memory files
+import random  # Import random for reproducible test data
+
+import pytest  # Import pytest for the test runner
+
+from common.delta import (COPY, LITERAL, block_size_for, compute_delta, delta_length, parse_signatures,
+                          signatures)
+
+SIZE = 1024 * 1024  # Size of the server's copy in every test
+
+
+def apply_delta(base, block_size, data, instructions):
+    """Rebuild the new file from the server's copy, as the server does."""
+    out = bytearray()
+    for kind, first, count in instructions:
+        if kind == COPY:
+            out += base[first * block_size:(first + count) * block_size]
+        else:
+            assert kind == LITERAL
+            out += data[first:first + count]
+    return bytes(out)
+
+
+def delta(base, data, max_literal=None):
+    block_size = block_size_for(len(base))
+    packed, _ = signatures(io.BytesIO(base), block_size)
+    instructions = compute_delta(data, len(base), block_size, parse_signatures(packed), max_literal)
+    if instructions is not None:
+        assert apply_delta(base, block_size, data, instructions) == data
+    return instructions
+
+
+@pytest.fixture
+def base():
+    return random.Random(1).randbytes(SIZE)
+
+
+def test_identical_file_is_all_copies(base):
+    instructions = delta(base, base)
+    assert all(kind == COPY for kind, _, _ in instructions)
+
+
+def test_append(base):
+    extra = random.Random(2).randbytes(100_000)
+    instructions = delta(base, base + extra)
+    assert delta_length(instructions) < len(extra) + 1024
+
+
+def test_insert(base):
+    extra = random.Random(3).randbytes(5000)
+    instructions = delta(base, base[:300_000] + extra + base[300_000:])
+    assert delta_length(instructions) < len(extra) + 2 * block_size_for(SIZE) + 1024
+
+
+def test_scattered_edits(base):
+    data = bytearray(base)
+    rng = random.Random(4)
+    for _ in range(20):
+        position = rng.randrange(len(data))
+        data[position:position + 10] = rng.randbytes(10)
+    instructions = delta(base, bytes(data))
+    assert delta_length(instructions) < 20 * 2 * block_size_for(SIZE)
+
+
+def test_truncated_and_empty_files(base):
+    delta(base, base[:SIZE // 2 + 17])
+    assert delta(base, b"") == []
+
+
+def test_unrelated_file_gives_up_past_max_literal(base):
+    assert delta(base, random.Random(5).randbytes(SIZE), SIZE // 2) is None
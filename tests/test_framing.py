@@ -0,0 +1,59 @@
+import struct  # Import struct to build malformed headers
+
+import pytest  # Import pytest for the test runner
+
+from common.framing import (FRAME_VERSION, HEADER, MAGIC, MAX_META_SIZE, MUX_CHUNK, MUX_HEADER, Mux, Op, ProtocolError,
+                            decode_handshake, decode_header, decode_meta, decode_mux, encode_busy, encode_frame,
+                            encode_handshake, encode_mux)
+
+
+def decode_frame(data):
+    """Split an encoded frame back into its op, flags, metadata and body length."""
+    op, flags, meta_length, body_length = decode_header(data[:HEADER.size])
+    meta = decode_meta(data[HEADER.size:HEADER.size + meta_length])
+    assert len(data) == HEADER.size + meta_length
+    return op, flags, meta, body_length
+
+
+@pytest.mark.parametrize("op, meta, body_length, flags", [
+    (Op.UPLOAD, {"name": "reports/june.xlsx", "offset": 0}, 123456789, 0),
+    (Op.DOWNLOAD, {"name": "caf\u00e9.txt", "if_none_match": "ab" * 32}, 0, 1),
+    (Op.LIST_FILES, None, 0, 0),
+])
+def test_frame_round_trip(op, meta, body_length, flags):
+    assert decode_frame(encode_frame(op, meta, body_length, flags)) == (op, flags, meta or {}, body_length)
+
+
+def test_frame_body_length_beyond_32_bits():
+    assert decode_frame(encode_frame(Op.UPLOAD, {}, 5 << 32))[3] == 5 << 32
+
+
+def test_decode_header_rejects_bad_headers():
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(FRAME_VERSION + 1, Op.UPLOAD, 0, 0, 0))
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(FRAME_VERSION, 250, 0, 0, 0))
+    with pytest.raises(ProtocolError):
+        decode_header(HEADER.pack(FRAME_VERSION, Op.UPLOAD, 0, MAX_META_SIZE + 1, 0))
+
+
+@pytest.mark.parametrize("data", [b"{", b"[1, 2]", b'"name"'])
+def test_decode_meta_rejects_anything_but_an_object(data):
+    with pytest.raises(ProtocolError):
+        decode_meta(data)
+
+
+def test_handshake_round_trip():
+    assert decode_handshake(encode_handshake(3)) == 3
+    assert encode_busy(70000).endswith(struct.pack("!H", 0xFFFF))
+    with pytest.raises(ProtocolError):
+        decode_handshake(b"HTTP/")
+    assert encode_handshake().startswith(MAGIC)
+
+
+def test_mux_round_trip():
+    assert decode_mux(encode_mux(7, Mux.DATA, MUX_CHUNK)) == (7, Mux.DATA, MUX_CHUNK)
+    with pytest.raises(ProtocolError):
+        decode_mux(encode_mux(7, Mux.DATA, MUX_CHUNK + 1))
+    with pytest.raises(ProtocolError):
+        decode_mux(MUX_HEADER.pack(7, 250, 0))
@@ -0,0 +1,28 @@
+import pytest  # Import pytest for the test runner
+
+from common.paths import clean_folder, clean_path
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("june.xlsx", "june.xlsx"),
+    ("reports\\june.xlsx", "reports/june.xlsx"),
+    ("/reports//./june.xlsx", "reports/june.xlsx"),
+    ("console.txt", "console.txt"),
+    ("com10", "com10"),
+])
+def test_clean_path_normalises(name, expected):
+    assert clean_path(name) == expected
+
+
+@pytest.mark.parametrize("name", [
+    "", ".", "/", "..", "../etc/passwd", "a/../../b", "a\\..\\b", "a\0b", None, 42,
+    "C:x", "C:/Windows/win.ini", "a/b:c", "con", "CON.txt", "a/nul", "lpt1.log", "Com3.tar.gz",
+])
+def test_clean_path_rejects(name):
+    with pytest.raises(ValueError):
+        clean_path(name)
+
+
+def test_clean_folder_allows_the_top_folder():
+    assert clean_folder("") == ""
+    assert clean_folder("/reports/") == "reports"
@@ -0,0 +1,76 @@
+import os  # Import os to check the files on both sides
+import socket  # Import socket to cut an upload short
+
+import pytest  # Import pytest for the test runner
+
+from client.session import PARTIAL_SUFFIX, TransferSession
+from common.framing import SINGLE_STREAM_VERSION, Op, encode_frame, negotiate
+from server.engine import FileServer
+
+SIZE = 3 * 1024 * 1024  # Size of the transferred file
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = FileServer("127.0.0.1", 0, str(tmp_path / "files"), metrics_port=None)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def session(server):
+    session = TransferSession("127.0.0.1", server.port)
+    yield session
+    session.close()
+
+
+def test_upload_resume_download(server, session, tmp_path):
+    data = os.urandom(SIZE)
+    source = tmp_path / "big.bin"
+    source.write_bytes(data)
+
+    # An upload cut off part way keeps what arrived
+    with socket.create_connection(("127.0.0.1", server.port)) as sock:
+        negotiate(sock, SINGLE_STREAM_VERSION)
+        sock.sendall(encode_frame(Op.UPLOAD, {"name": "big.bin"}, SIZE) + data[:SIZE // 3])
+        sock.shutdown(socket.SHUT_WR)
+        sock.recv(1)
+    assert server.store.partial_size("big.bin") == SIZE // 3
+
+    # and is continued from there
+    assert session.upload_batch([str(source)], dedup=False) == [("big.bin", None)]
+    with open(server.store.path("big.bin"), "rb") as f:
+        assert f.read() == data
+
+    # A download continues from its partial file too
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    (dest / ("big.bin" + PARTIAL_SUFFIX)).write_bytes(data[:SIZE // 2])
+    assert session.download_batch(["big.bin"], str(dest)) == [("big.bin", None)]
+    assert (dest / "big.bin").read_bytes() == data
+    assert not (dest / ("big.bin" + PARTIAL_SUFFIX)).exists()
+
+
+def test_resumed_download_of_another_version_is_discarded(server, session, tmp_path):
+    data = os.urandom(SIZE)
+    server.store.store_bytes("big.bin", data)
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    (dest / ("big.bin" + PARTIAL_SUFFIX)).write_bytes(os.urandom(SIZE // 2))
+    [(_, error)] = session.download_batch(["big.bin"], str(dest))
+    assert error
+    assert not os.listdir(dest)
+    assert session.download_batch(["big.bin"], str(dest)) == [("big.bin", None)]
+    assert (dest / "big.bin").read_bytes() == data
+
+
+def test_delta_upload(server, session, tmp_path):
+    data = os.urandom(SIZE)
+    server.store.store_bytes("big.bin", data)
+    changed = data[:SIZE // 2] + b"inserted" + data[SIZE // 2:]
+    source = tmp_path / "big.bin"
+    source.write_bytes(changed)
+    assert session.upload_batch([str(source)]) == [("big.bin", None)]
+    with open(server.store.path("big.bin"), "rb") as f:
+        assert f.read() == changed